@@ -1,7 +1,7 @@
 from functools import lru_cache
 
 from fastapi import HTTPException
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
 
 from app.core.config import settings
 from app.chat.schemas import (
@@ -25,6 +25,18 @@ def get_openai_client() -> OpenAI:
     )
 
 
+@lru_cache(maxsize=1)
+def get_async_openai_client() -> AsyncOpenAI:
+    """Async singleton used by the asyncio WhatsApp pipeline."""
+    if not settings.openai_api_key:
+        raise HTTPException(status_code=500, detail="OPEN_AI_KEY is not set")
+    return AsyncOpenAI(
+        api_key=settings.openai_api_key,
+        timeout=30.0,
+        max_retries=3,
+    )
+
+
 def create_customer_ticket(request: CreateCustomerTicketRequest) -> str:
     return (
         f"Created customer ticket for {request.name} "
@@ -25,6 +25,88 @@ class Settings:
         }
         self.cron_secret = os.getenv("CRON_SECRET")
         self.api_secret = os.getenv("API_SECRET")
+        # "async" (default) or "sync" — pipeline used by /api/whatsapp/process
+        self.process_queue_mode = os.getenv("PROCESS_QUEUE_MODE", "async").lower()
+        self.org_cache_ttl_seconds = float(os.getenv("ORG_CACHE_TTL_SECONDS", "300"))
+        self.org_cache_max_size = int(os.getenv("ORG_CACHE_MAX_SIZE", "256"))
+        # Conversation history window (per-org overrides in organizations.ai_settings)
+        self.history_fetch_limit = int(os.getenv("HISTORY_FETCH_LIMIT", "60"))
+        self.history_max_messages = int(os.getenv("HISTORY_MAX_MESSAGES", "30"))
+        self.history_max_tokens = int(os.getenv("HISTORY_MAX_TOKENS", "6000"))
+        # Pooled Graph API client (see app/whatsapp/graph_client.py)
+        self.whatsapp_http2 = os.getenv("WHATSAPP_HTTP2", "true").lower() in {
+            "1",
+            "true",
+            "yes",
+        }
+        self.whatsapp_pool_size = int(os.getenv("WHATSAPP_POOL_SIZE", "20"))
+        self.whatsapp_rate_limit_per_second = float(
+            os.getenv("WHATSAPP_RATE_LIMIT_PER_SECOND", "20")
+        )
+        self.whatsapp_max_retries = int(os.getenv("WHATSAPP_MAX_RETRIES", "3"))
+        # Inbound debounce: "local" (in-process scheduler) or "edge" (Supabase function)
+        self.debounce_backend = os.getenv("DEBOUNCE_BACKEND", "local").lower()
+        self.debounce_min_ms = int(os.getenv("DEBOUNCE_MIN_MS", "2500"))
+        self.debounce_typing_ms = int(os.getenv("DEBOUNCE_TYPING_MS", "8000"))
+        self.debounce_max_ms = int(os.getenv("DEBOUNCE_MAX_MS", "15000"))
+        self.debounce_lease_seconds = int(os.getenv("DEBOUNCE_LEASE_SECONDS", "120"))
+        # Re-queue batches stranded by a restart inside the window (0 = off)
+        self.debounce_sweep_seconds = float(os.getenv("DEBOUNCE_SWEEP_SECONDS", "30"))
+        # Durable chat_jobs queue (see app/whatsapp/jobs.py)
+        self.chat_jobs_enabled = os.getenv("CHAT_JOBS_ENABLED", "true").lower() in {
+            "1",
+            "true",
+            "yes",
+        }
+        self.chat_jobs_concurrency = int(os.getenv("CHAT_JOBS_CONCURRENCY", "8"))
+        self.chat_jobs_lease_seconds = int(os.getenv("CHAT_JOBS_LEASE_SECONDS", "120"))
+        self.chat_jobs_max_attempts = int(os.getenv("CHAT_JOBS_MAX_ATTEMPTS", "5"))
+        self.chat_jobs_backoff_seconds = int(os.getenv("CHAT_JOBS_BACKOFF_SECONDS", "5"))
+        self.chat_jobs_poll_seconds = float(os.getenv("CHAT_JOBS_POLL_SECONDS", "2"))
+        # Concurrent tool calls within one model response (1 = sequential)
+        self.tool_max_workers = int(os.getenv("TOOL_MAX_WORKERS", "8"))
+        # Threads shared by the tool calls of all chats
+        self.tool_pool_size = int(os.getenv("TOOL_POOL_SIZE", "32"))
+        # Stream Responses API output in the async pipeline (see async_pipeline.py)
+        self.responses_streaming = os.getenv("RESPONSES_STREAMING", "false").lower() in {
+            "1",
+            "true",
+            "yes",
+        }
+        # Re-send the WhatsApp typing indicator while a turn runs (0 = off)
+        self.typing_refresh_seconds = float(os.getenv("TYPING_REFRESH_SECONDS", "20"))
+        # In-memory availability calendar (see app/whatsapp/slot_calendar.py)
+        self.slot_cache_enabled = os.getenv("SLOT_CACHE_ENABLED", "true").lower() in {
+            "1",
+            "true",
+            "yes",
+        }
+        self.slot_cache_days = int(os.getenv("SLOT_CACHE_DAYS", "60"))
+        self.slot_cache_poll_seconds = float(os.getenv("SLOT_CACHE_POLL_SECONDS", "10"))
+        # One turn at a time per chat (see app/whatsapp/chat_lock.py)
+        self.chat_lock_enabled = os.getenv("CHAT_LOCK_ENABLED", "true").lower() in {
+            "1",
+            "true",
+            "yes",
+        }
+        self.chat_lock_wait_seconds = float(os.getenv("CHAT_LOCK_WAIT_SECONDS", "5"))
+        self.chat_lock_lease_seconds = int(os.getenv("CHAT_LOCK_LEASE_SECONDS", "180"))
+        # Chats of one webhook processed in parallel (edge/direct fallback)
+        self.chat_fanout_concurrency = int(os.getenv("CHAT_FANOUT_CONCURRENCY", "4"))
+        # Inbound media transfers running at once (0 = download inline)
+        self.media_pipeline_concurrency = int(os.getenv("MEDIA_PIPELINE_CONCURRENCY", "4"))
+        # Reuse WhatsApp media ids of Storage documents (0 disables the cache)
+        self.whatsapp_media_cache_days = float(
+            os.getenv("WHATSAPP_MEDIA_CACHE_DAYS", "25")
+        )
+        # Token/latency records of model calls (see app/whatsapp/ai_logs.py)
+        self.ai_logs_enabled = os.getenv("AI_LOGS_ENABLED", "true").lower() in {
+            "1",
+            "true",
+            "yes",
+        }
+        self.ai_logs_batch_size = int(os.getenv("AI_LOGS_BATCH_SIZE", "50"))
+        self.ai_logs_flush_seconds = float(os.getenv("AI_LOGS_FLUSH_SECONDS", "5"))
 
 
 settings = Settings()
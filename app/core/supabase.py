@@ -1,8 +1,9 @@
+import asyncio
 import time
 from typing import Any, Optional
 
 from fastapi import HTTPException
-from supabase import Client, create_client
+from supabase import AsyncClient, Client, acreate_client, create_client
 
 from app.core.config import settings
 
@@ -111,6 +112,92 @@ def _close_client(client: Optional[Client]) -> None:
         pass
 
 
+# ── Async singleton (used by the asyncio message pipeline) ──────────
+_async_supabase_client: Optional[AsyncClient] = None
+_async_client_created_at: float = 0.0
+_async_client_lock: Optional[asyncio.Lock] = None
+
+
+async def _create_fresh_async_client() -> AsyncClient:
+    """Async counterpart of ``_create_fresh_client`` with the same pool rules."""
+    if not settings.supabase_url:
+        raise HTTPException(status_code=500, detail="SUPABASE_URL is not configured")
+    if not settings.supabase_service_key:
+        raise HTTPException(
+            status_code=500, detail="SUPABASE_SERVICE_ROLE_KEY is not configured"
+        )
+
+    from supabase.lib.client_options import AsyncClientOptions
+
+    opts = AsyncClientOptions(
+        postgrest_client_timeout=30,
+    )
+    client = await acreate_client(
+        settings.supabase_url, settings.supabase_service_key, options=opts
+    )
+
+    timeout = Timeout(10.0, connect=5.0, read=30.0, write=10.0)
+    if hasattr(client, "postgrest") and hasattr(client.postgrest, "session"):
+        session = client.postgrest.session
+        session.timeout = timeout
+        session._transport = httpx.AsyncHTTPTransport(
+            http2=False,
+            retries=1,
+            limits=httpx.Limits(
+                max_connections=50,
+                max_keepalive_connections=20,
+                keepalive_expiry=30,
+            ),
+        )
+
+    print("[supabase] fresh async client created (HTTP/1.1, pool limits enforced)")
+    return client
+
+
+async def get_async_supabase_client() -> AsyncClient:
+    """Return the singleton async Supabase client, creating/refreshing as needed."""
+    global _async_supabase_client, _async_client_created_at, _async_client_lock
+
+    if _async_client_lock is None:
+        _async_client_lock = asyncio.Lock()
+
+    async with _async_client_lock:
+        now = time.monotonic()
+        if (
+            _async_supabase_client is not None
+            and (now - _async_client_created_at) > _CLIENT_TTL_SECONDS
+        ):
+            print("[supabase] async client TTL expired, refreshing")
+            await _aclose_client(_async_supabase_client)
+            _async_supabase_client = None
+
+        if _async_supabase_client is None:
+            _async_supabase_client = await _create_fresh_async_client()
+            _async_client_created_at = now
+
+        return _async_supabase_client
+
+
+async def reset_async_supabase_client() -> None:
+    """Discard the current async client so the next call creates a fresh one."""
+    global _async_supabase_client
+    old = _async_supabase_client
+    _async_supabase_client = None
+    await _aclose_client(old)
+    print("[supabase] async client reset — next call will create a fresh connection")
+
+
+async def _aclose_client(client: Optional[AsyncClient]) -> None:
+    """Best-effort close of the old async httpx transport."""
+    if client is None:
+        return
+    try:
+        if hasattr(client, "postgrest") and hasattr(client.postgrest, "session"):
+            await client.postgrest.session.aclose()
+    except Exception:
+        pass
+
+
 def supabase_retry(fn, *args, max_retries: int = 1, **kwargs):
     """Run *fn* with automatic Supabase client recreation on connection errors.
 
@@ -1,14 +1,46 @@
+import asyncio
+from contextlib import asynccontextmanager
+
 from fastapi import Depends, FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
 from app.chat.router import router as chat_router
 from app.core.auth import require_api_key
+from app.core.config import settings
 from app.core.supabase import get_supabase_client
+from app.whatsapp.admin_router import router as whatsapp_admin_router
+from app.whatsapp.ai_logs import ai_log_writer
+from app.whatsapp.async_pipeline import drain_streams
+from app.whatsapp.debounce import debounce_scheduler
+from app.whatsapp.fanout import chat_fanout
+from app.whatsapp.graph_client import close_graph_clients
+from app.whatsapp.history import history_summarizer
+from app.whatsapp.jobs import chat_job_worker
+from app.whatsapp.media_pipeline import media_pipeline
 from app.whatsapp.outbound_router import router as whatsapp_outbound_router
 from app.whatsapp.process_router import router as whatsapp_process_router
 from app.whatsapp.webhook import router as whatsapp_router
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    loop = asyncio.get_running_loop()
+    debounce_scheduler.start(loop)
+    media_pipeline.start(loop)
+    if settings.chat_jobs_enabled:
+        chat_job_worker.start(loop)
+    yield
+    await debounce_scheduler.stop()
+    await chat_job_worker.stop()
+    await media_pipeline.stop()
+    chat_fanout.shutdown()
+    history_summarizer.shutdown()
+    await drain_streams()
+    await asyncio.to_thread(ai_log_writer.stop)
+    await close_graph_clients()
+
+
+app = FastAPI(lifespan=lifespan)
 
 # ── CORS — restrict to known origins ──────────────────────────────
 app.add_middleware(
@@ -28,6 +60,7 @@ app.include_router(chat_router)
 app.include_router(whatsapp_router)
 app.include_router(whatsapp_outbound_router)
 app.include_router(whatsapp_process_router)
+app.include_router(whatsapp_admin_router)
 
 
 @app.get("/")
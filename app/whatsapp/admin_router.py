@@ -0,0 +1,106 @@
+from typing import Any, Dict, Optional
+
+from fastapi import APIRouter, Depends
+from pydantic import BaseModel
+
+from app.core.auth import require_api_key
+from app.whatsapp.ai_logs import ai_log_writer
+from app.whatsapp.chat_lock import chat_turn_lock
+from app.whatsapp.debounce import debounce_scheduler
+from app.whatsapp.fanout import chat_fanout
+from app.whatsapp.graph_client import graph_metrics
+from app.whatsapp.jobs import chat_job_worker
+from app.whatsapp.lead_repository import lead_repository_totals
+from app.whatsapp.media_pipeline import media_pipeline
+from app.whatsapp.org_cache import org_cache
+from app.whatsapp.slot_calendar import slot_calendar
+from app.whatsapp.tools.registry import tool_metrics
+
+router = APIRouter(
+    prefix="/api/whatsapp/admin",
+    tags=["whatsapp-admin"],
+    dependencies=[Depends(require_api_key)],
+)
+
+
+class InvalidateOrgCacheRequest(BaseModel):
+    org_id: Optional[str] = None
+    phone_number_id: Optional[str] = None
+
+
+@router.post("/org-cache/invalidate")
+def invalidate_org_cache(request: InvalidateOrgCacheRequest) -> Dict[str, Any]:
+    """Drop cached organization config (all entries when no key is sent)."""
+    removed = org_cache.invalidate(
+        org_id=request.org_id, phone_number_id=request.phone_number_id
+    )
+    return {"removed": removed, "stats": org_cache.stats()}
+
+
+@router.get("/org-cache/stats")
+def org_cache_stats() -> Dict[str, Any]:
+    return org_cache.stats()
+
+
+class InvalidateSlotCalendarRequest(BaseModel):
+    org_id: Optional[str] = None
+
+
+@router.post("/slot-calendar/invalidate")
+def invalidate_slot_calendar(request: InvalidateSlotCalendarRequest) -> Dict[str, Any]:
+    """Drop cached availability calendars (all organizations when no id is sent)."""
+    removed = slot_calendar.invalidate(request.org_id)
+    return {"removed": removed, "stats": slot_calendar.stats()}
+
+
+@router.get("/slot-calendar/stats")
+def slot_calendar_stats() -> Dict[str, Any]:
+    return slot_calendar.stats()
+
+
+@router.get("/graph/metrics")
+def graph_api_metrics() -> Dict[str, Any]:
+    """Graph API latency/retry counters per operation since process start."""
+    return graph_metrics.snapshot()
+
+
+@router.get("/debounce/stats")
+def debounce_stats() -> Dict[str, Any]:
+    return debounce_scheduler.stats()
+
+
+@router.get("/jobs/stats")
+def chat_jobs_stats() -> Dict[str, Any]:
+    return chat_job_worker.stats()
+
+
+@router.get("/chat-lock/stats")
+def chat_lock_stats() -> Dict[str, Any]:
+    return chat_turn_lock.stats()
+
+
+@router.get("/fanout/stats")
+def chat_fanout_stats() -> Dict[str, Any]:
+    return chat_fanout.stats()
+
+
+@router.get("/media/stats")
+def media_pipeline_stats() -> Dict[str, Any]:
+    return media_pipeline.stats()
+
+
+@router.get("/ai-logs/stats")
+def ai_logs_stats() -> Dict[str, Any]:
+    return ai_log_writer.stats()
+
+
+@router.get("/tools/metrics")
+def tool_call_metrics() -> Dict[str, Any]:
+    """Latency histogram, errors, timeouts and memo hits per tool."""
+    return tool_metrics.snapshot()
+
+
+@router.get("/leads/stats")
+def lead_repository_stats() -> Dict[str, Any]:
+    """Lead queries issued vs. served from the per-turn lead repository."""
+    return lead_repository_totals.stats()
@@ -0,0 +1,192 @@
+"""
+Token and latency accounting for model calls, written to ``ai_logs``.
+
+Every ``responses.create`` of a turn (first call, booking confirmation,
+tool follow-up rounds), of the background history summary and of the
+session-close summary produces one ``model_call`` row: model, call kind
+and round index, input / cached / output tokens, requested tool names,
+wall-clock latency and error.
+
+Recording only appends to an in-memory buffer; a daemon thread inserts
+the buffered rows in batches of ``AI_LOGS_BATCH_SIZE`` at least every
+``AI_LOGS_FLUSH_SECONDS``, so logging adds no latency to the turn.  When the
+database is unreachable the buffer is capped (oldest rows are dropped) and
+a failed batch is discarded.
+"""
+
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+from typing import Any, Deque, Dict, List, Optional
+
+from app.core.config import settings
+from app.core.supabase import get_supabase_client, get_supabase_error
+
+# Rows kept while the database is unreachable.
+MAX_BUFFERED = 5000
+
+
+def _usage(response: Any) -> Dict[str, Optional[int]]:
+    usage = getattr(response, "usage", None)
+    input_details = getattr(usage, "input_tokens_details", None)
+    output_details = getattr(usage, "output_tokens_details", None)
+    return {
+        "input_tokens": getattr(usage, "input_tokens", None),
+        "cached_tokens": getattr(input_details, "cached_tokens", None),
+        "output_tokens": getattr(usage, "output_tokens", None),
+        "reasoning_tokens": getattr(output_details, "reasoning_tokens", None),
+    }
+
+
+def _tool_names(response: Any) -> List[str]:
+    return [
+        item.name
+        for item in getattr(response, "output", None) or []
+        if getattr(item, "type", None) == "function_call"
+    ]
+
+
+class AiLogWriter:
+    def __init__(self, batch_size: int, flush_seconds: float) -> None:
+        self.batch_size = max(batch_size, 1)
+        self.flush_seconds = flush_seconds
+        self._buffer: Deque[Dict[str, Any]] = deque(maxlen=MAX_BUFFERED)
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = False
+        self.recorded = 0
+        self.written = 0
+        self.dropped = 0
+        self.flushes = 0
+
+    # ── Recording ────────────────────────────────────────────────
+
+    def log_model_call(
+        self,
+        *,
+        organization_id: Optional[str],
+        chat_id: Optional[str],
+        session_id: Optional[str],
+        model: Optional[str],
+        kind: str,
+        round_index: int,
+        latency_ms: float,
+        response: Any = None,
+        error: Optional[BaseException] = None,
+    ) -> None:
+        """Queue one ``model_call`` row (never raises, never blocks on I/O)."""
+        if not settings.ai_logs_enabled:
+            return
+        try:
+            payload: Dict[str, Any] = {
+                "model": model,
+                "kind": kind,
+                "round": round_index,
+                **_usage(response),
+                "tools": _tool_names(response),
+                "latency_ms": round(latency_ms, 1),
+                "streaming": settings.responses_streaming,
+                "response_id": getattr(response, "id", None),
+                "error": str(error) if error is not None else None,
+            }
+            self._append(
+                {
+                    "organization_id": organization_id,
+                    "chat_id": chat_id,
+                    "conversation_id": session_id,
+                    "event_type": "model_call",
+                    "payload": payload,
+                    "created_at": datetime.now(timezone.utc).isoformat(),
+                }
+            )
+        except Exception as exc:
+            print("[ai-logs] record failed", {"error": str(exc)})
+
+    def _append(self, row: Dict[str, Any]) -> None:
+        with self._lock:
+            if len(self._buffer) == self._buffer.maxlen:
+                self.dropped += 1
+            self._buffer.append(row)
+            self.recorded += 1
+            full = len(self._buffer) >= self.batch_size
+            if self._thread is None or not self._thread.is_alive():
+                self._stopping = False
+                self._thread = threading.Thread(
+                    target=self._run, name="ai-logs-writer", daemon=True
+                )
+                self._thread.start()
+        if full:
+            self._wake.set()
+
+    # ── Flushing ─────────────────────────────────────────────────
+
+    def _run(self) -> None:
+        while not self._stopping:
+            self._wake.wait(self.flush_seconds)
+            self._wake.clear()
+            self.flush()
+
+    def _take(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            batch = []
+            while self._buffer and len(batch) < self.batch_size:
+                batch.append(self._buffer.popleft())
+            return batch
+
+    def flush(self) -> int:
+        """Insert everything buffered so far; returns the rows written."""
+        written = 0
+        while True:
+            batch = self._take()
+            if not batch:
+                return written
+            started = time.perf_counter()
+            try:
+                response = get_supabase_client().from_("ai_logs").insert(batch).execute()
+                error = get_supabase_error(response)
+            except Exception as exc:
+                error = exc
+            with self._lock:
+                self.flushes += 1
+                if error:
+                    self.dropped += len(batch)
+                else:
+                    self.written += len(batch)
+            if error:
+                print("[ai-logs] flush failed", {"rows": len(batch), "error": str(error)})
+                return written
+            written += len(batch)
+            print(
+                "[ai-logs] flushed",
+                {"rows": len(batch), "elapsed_ms": round((time.perf_counter() - started) * 1000)},
+            )
+
+    def stop(self) -> None:
+        """Flush the remaining rows (application shutdown)."""
+        self._stopping = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+        self.flush()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "enabled": settings.ai_logs_enabled,
+                "buffered": len(self._buffer),
+                "recorded": self.recorded,
+                "written": self.written,
+                "dropped": self.dropped,
+                "flushes": self.flushes,
+                "batch_size": self.batch_size,
+                "flush_seconds": self.flush_seconds,
+            }
+
+
+ai_log_writer = AiLogWriter(
+    batch_size=settings.ai_logs_batch_size,
+    flush_seconds=settings.ai_logs_flush_seconds,
+)
@@ -0,0 +1,482 @@
+"""Asyncio-native turn pipeline for ``/api/whatsapp/process``.
+
+Mirrors ``process_router._process_queue_impl`` but awaits every network
+call that dominates a turn (OpenAI ``responses.create``, the WhatsApp Graph
+API, the ``get_turn_context`` bootstrap and the record queries), so a single worker can keep hundreds
+of chats in flight.  The database-bound phases shared with the sync path
+(forced flows, tool handlers, post-processing) still use the sync Supabase
+client and run in the threadpool for their short duration.
+
+With ``RESPONSES_STREAMING=true`` model calls consume the Responses API
+event stream, and every turn logs its model and time-to-reply timings.
+The WhatsApp typing indicator is refreshed every ``TYPING_REFRESH_SECONDS``
+until the reply is sent.
+"""
+
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime
+from types import SimpleNamespace
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Set
+
+from fastapi.concurrency import run_in_threadpool
+
+from app.chat.service import get_async_openai_client
+from app.core.config import settings
+from app.core.supabase import (
+    CONN_ERRORS,
+    get_async_supabase_client,
+    get_supabase_client,
+    reset_async_supabase_client,
+    reset_supabase_client,
+)
+from app.whatsapp.chat_state import ChatStateSession, flush_chat_state
+from app.whatsapp.lead_repository import attach_lead_repository
+from app.whatsapp.org_cache import org_cache
+from app.whatsapp.outbound import (
+    SendWhatsAppReadParams,
+    SendWhatsAppTextParams,
+    WhatsAppResponse,
+    send_whatsapp_read_async,
+    send_whatsapp_text_async,
+)
+from app.whatsapp.process_router import (
+    MAX_TOOL_ROUNDS,
+    ProcessQueueRequest,
+    _BOOKING_CONFIRMATION_FALLBACK_TEXT,
+    _TECHNICAL_DIFFICULTIES_TEXT,
+    _TOOL_ROUNDS_DONE_TEXT,
+    _assistant_message_payload,
+    _execute_first_round_tools,
+    _execute_followup_tools,
+    _finalize_assistant_text,
+    _followup_error_text,
+    _function_calls,
+    _log_model_call,
+    _mark_reply_sent,
+    _model_request,
+    _prepare_outbound_text,
+    _prepare_turn,
+    _reply_sent_result,
+    _send_result_summary,
+    _validate_turn_entities,
+)
+from app.whatsapp.turn_context import TurnContext, load_turn_context_async
+
+
+async def process_queue_async_with_retry(
+    payload: ProcessQueueRequest,
+) -> Dict[str, Any]:
+    """Run ``process_queue_async`` with connection-error retry."""
+    for _attempt in range(2):
+        try:
+            return await process_queue_async(payload)
+        except CONN_ERRORS as exc:
+            if _attempt == 0:
+                print(
+                    f"[admissions] connection error in async process_queue, "
+                    f"resetting clients and retrying: {exc}"
+                )
+                reset_supabase_client()
+                await reset_async_supabase_client()
+                await asyncio.sleep(0.5)
+            else:
+                print(f"[admissions] connection error on retry, giving up: {exc}")
+                raise
+
+
+async def send_assistant_message_async(
+    assistant_text: str,
+    org: Dict[str, Any],
+    chat: Dict[str, Any],
+    session_id: str,
+) -> Dict[str, Any]:
+    """Async counterpart of ``process_router._send_assistant_message``."""
+    sanitized_text = _prepare_outbound_text(assistant_text)
+
+    # Checkpoint pending chat state before the reply leaves the process
+    await run_in_threadpool(flush_chat_state, chat)
+
+    send_result = await send_whatsapp_text_async(
+        SendWhatsAppTextParams(
+            phone_number_id=org.get("phone_number_id"),
+            to=chat.get("wa_id"),
+            body=sanitized_text,
+        )
+    )
+    _mark_reply_sent(chat, send_result)
+
+    supabase = await get_async_supabase_client()
+    message_payload = _assistant_message_payload(
+        sanitized_text, send_result, org, chat, session_id
+    )
+    await asyncio.gather(
+        supabase.from_("messages").insert(message_payload).execute(),
+        supabase.from_("chat_sessions")
+        .update(
+            {
+                "last_response_at": datetime.utcnow().isoformat(),
+                "updated_at": datetime.utcnow().isoformat(),
+            }
+        )
+        .eq("id", session_id)
+        .execute(),
+    )
+
+    return _send_result_summary(send_result)
+
+
+async def _mark_read(org: Dict[str, Any], last_inbound_id: Optional[str]) -> WhatsAppResponse:
+    if not last_inbound_id:
+        return WhatsAppResponse()
+    return await send_whatsapp_read_async(
+        SendWhatsAppReadParams(
+            phone_number_id=org.get("phone_number_id"),
+            message_id=last_inbound_id,
+            typing_type="text",
+        )
+    )
+
+
+async def process_queue_async(
+    payload: ProcessQueueRequest,
+) -> Dict[str, Any]:
+    ctx = await load_turn_context_async(payload.chat_id)
+    _validate_turn_entities(ctx.chat, ctx.org)
+    org_cache.prime(ctx.org)
+    chat = ctx.chat
+    chat["_turn_context"] = ctx
+    lead_repo = attach_lead_repository(ctx)
+
+    # Same unit of work as the sync path; flushed off the event loop.
+    state_session = ChatStateSession(get_supabase_client(), chat).__enter__()
+    try:
+        try:
+            result = await _run_turn_async(payload, ctx)
+        except BaseException as exc:
+            await run_in_threadpool(
+                state_session.__exit__, type(exc), exc, exc.__traceback__
+            )
+            raise
+        await run_in_threadpool(state_session.__exit__, None, None, None)
+    except Exception as exc:
+        sent = _reply_sent_result(chat, exc)
+        if sent is None:
+            raise
+        return sent
+    finally:
+        print("[lead-repo] turn", {"chat_id": chat.get("id"), **lead_repo.stats()})
+    return result
+
+
+# ── Model calls ──────────────────────────────────────────────────
+
+
+def _elapsed_ms(started: float) -> int:
+    return int((time.perf_counter() - started) * 1000)
+
+
+def _message_text(item: Any) -> str:
+    return "".join(
+        part.text for part in item.content if getattr(part, "type", None) == "output_text"
+    )
+
+
+# Streams still being read after their answer was returned (see _drain_stream).
+_stream_drains: Set["asyncio.Task[None]"] = set()
+DRAIN_TIMEOUT_SECONDS = 10
+
+
+async def _drain_stream(
+    stream: Any,
+    events: AsyncIterator[Any],
+    on_completed: Callable[..., None],
+) -> None:
+    """Read an early-returned stream up to ``response.completed`` for its usage."""
+    try:
+        async for event in events:
+            if event.type in {"response.completed", "response.incomplete"}:
+                on_completed(response=event.response)
+                return
+            if event.type == "response.failed":
+                raise RuntimeError(f"Response failed: {event.response.error}")
+            if event.type == "error":
+                raise RuntimeError(f"Response stream error: {event.message}")
+        raise RuntimeError("Response stream ended before response.completed")
+    except Exception as exc:
+        print("[admissions] stream drain error", {"error": str(exc)})
+        on_completed(error=exc)
+    finally:
+        await stream.close()
+
+
+async def drain_streams() -> None:
+    """Wait (bounded) for streams still being drained (application shutdown)."""
+    if not _stream_drains:
+        return
+    _done, pending = await asyncio.wait(
+        list(_stream_drains), timeout=DRAIN_TIMEOUT_SECONDS
+    )
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+
+
+async def _create_response(
+    client: Any,
+    request: Dict[str, Any],
+    timings: Dict[str, List[Any]],
+    on_completed: Callable[..., None],
+) -> Any:
+    """``responses.create``; consumes server-sent events when streaming.
+
+    When the request offers no tools the first completed message is the
+    answer, so it is returned without waiting for the rest of the stream.
+    With tools the stream is read up to ``response.completed`` because a
+    message may still be followed by function calls.
+
+    ``on_completed(response=...)`` receives the final response, with its
+    usage.  For an answer returned early the rest of the stream is drained
+    on a background task, which reports the completed response (or the
+    error) once it arrives.
+    """
+    started = time.perf_counter()
+    if not settings.responses_streaming:
+        response = await client.responses.create(**request)
+        timings["model_ms"].append(_elapsed_ms(started))
+        on_completed(response=response)
+        return response
+
+    stream = await client.responses.create(**request, stream=True)
+    events = stream.__aiter__()
+    first_token_ms: Optional[int] = None
+    output_kind: Optional[str] = None
+    draining = False
+    try:
+        async for event in events:
+            if event.type == "response.output_item.added":
+                if output_kind is None and event.item.type in {"message", "function_call"}:
+                    output_kind = "text" if event.item.type == "message" else "tools"
+            elif event.type == "response.output_text.delta":
+                if first_token_ms is None:
+                    first_token_ms = _elapsed_ms(started)
+            elif event.type == "response.output_item.done":
+                if "tools" not in request and event.item.type == "message":
+                    timings["model_ms"].append(_elapsed_ms(started))
+                    timings["first_token_ms"].append(first_token_ms)
+                    task = asyncio.create_task(_drain_stream(stream, events, on_completed))
+                    _stream_drains.add(task)
+                    task.add_done_callback(_stream_drains.discard)
+                    draining = True
+                    return SimpleNamespace(
+                        output=[event.item], output_text=_message_text(event.item)
+                    )
+            elif event.type in {"response.completed", "response.incomplete"}:
+                timings["model_ms"].append(_elapsed_ms(started))
+                timings["first_token_ms"].append(first_token_ms)
+                on_completed(response=event.response)
+                return event.response
+            elif event.type == "response.failed":
+                raise RuntimeError(f"Response failed: {event.response.error}")
+            elif event.type == "error":
+                raise RuntimeError(f"Response stream error: {event.message}")
+    finally:
+        if not draining:
+            await stream.close()
+    raise RuntimeError(f"Response stream ended early (output: {output_kind})")
+
+
+async def _call_model_async(
+    client: Any,
+    request: Dict[str, Any],
+    timings: Dict[str, List[Any]],
+    turn: Dict[str, Any],
+    org: Dict[str, Any],
+    chat: Dict[str, Any],
+    kind: str,
+    round_index: int,
+) -> Any:
+    """``_create_response`` plus its ``ai_logs`` record."""
+    started = time.perf_counter()
+
+    def _record(response: Any = None, error: Optional[BaseException] = None) -> None:
+        _log_model_call(
+            turn, org, chat, kind, round_index, started, response=response, error=error
+        )
+
+    try:
+        return await _create_response(client, request, timings, _record)
+    except Exception as exc:
+        _record(error=exc)
+        raise
+
+
+@asynccontextmanager
+async def _keep_typing(org: Dict[str, Any], last_inbound_id: Optional[str]):
+    """Refresh the typing indicator (it expires after ~25 s) while a turn runs."""
+    interval = settings.typing_refresh_seconds
+    if not last_inbound_id or interval <= 0:
+        yield
+        return
+
+    async def _refresh() -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await _mark_read(org, last_inbound_id)
+            except Exception as exc:
+                print("[admissions] typing refresh error", {"error": str(exc)})
+
+    task = asyncio.create_task(_refresh())
+    try:
+        yield
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+
+# ── Turn ─────────────────────────────────────────────────────────
+
+
+async def _run_turn_async(
+    payload: ProcessQueueRequest,
+    ctx: TurnContext,
+) -> Dict[str, Any]:
+    chat, org = ctx.chat, ctx.org
+    turn_started = time.perf_counter()
+
+    # Mark last message as read / show typing while the turn is prepared
+    _read_result, turn = await asyncio.gather(
+        _mark_read(org, ctx.last_inbound_message_id),
+        run_in_threadpool(_prepare_turn, payload, ctx),
+    )
+    if turn.get("skip_reason"):
+        return {"status": "skipped", "reason": turn["skip_reason"]}
+    session_id = turn["session_id"]
+    if turn.get("forced_text"):
+        return await send_assistant_message_async(
+            turn["forced_text"], org, chat, session_id
+        )
+
+    timings: Dict[str, List[Any]] = {"model_ms": [], "first_token_ms": []}
+    async with _keep_typing(org, ctx.last_inbound_message_id):
+        assistant_text = await _generate_assistant_text(turn, org, chat, timings)
+        if assistant_text is None:
+            assistant_text = _TECHNICAL_DIFFICULTIES_TEXT
+        else:
+            assistant_text = await run_in_threadpool(
+                _finalize_assistant_text, turn, org, chat, assistant_text
+            )
+
+    result = await send_assistant_message_async(assistant_text, org, chat, session_id)
+    print(
+        "[admissions] turn timings",
+        {
+            "chat_id": chat.get("id"),
+            "streaming": settings.responses_streaming,
+            "reply_ms": _elapsed_ms(turn_started),
+            **timings,
+        },
+    )
+    return result
+
+
+async def _generate_assistant_text(
+    turn: Dict[str, Any],
+    org: Dict[str, Any],
+    chat: Dict[str, Any],
+    timings: Dict[str, List[Any]],
+) -> Optional[str]:
+    """Model call plus tool rounds; None when the first model call fails."""
+    client = get_async_openai_client()
+    try:
+        response = await _call_model_async(
+            client,
+            _model_request(turn, turn["input_messages"]),
+            timings,
+            turn,
+            org,
+            chat,
+            "turn",
+            0,
+        )
+        assistant_text = response.output_text or ""
+        tool_calls = _function_calls(response)
+    except Exception as exc:
+        print(
+            "[admissions] OpenAI API error",
+            {"error": str(exc), "chat_id": chat.get("id"), "model": turn["model"]},
+        )
+        return None
+    print(
+        "[admissions] llm response",
+        {"assistant_text": assistant_text, "tool_calls": len(tool_calls)},
+    )
+    if not tool_calls:
+        return assistant_text
+
+    outcome = await run_in_threadpool(
+        _execute_first_round_tools, turn, org, chat, tool_calls, assistant_text
+    )
+    assistant_text = outcome["assistant_text"]
+    accumulated_input = (
+        turn["input_messages"] + list(response.output) + outcome["tool_outputs"]
+    )
+    if outcome["booking_context"]:
+        try:
+            followup = await _call_model_async(
+                client,
+                _model_request(
+                    turn,
+                    accumulated_input,
+                    with_tools=False,
+                    extra_instructions=outcome["booking_context"],
+                ),
+                timings,
+                turn,
+                org,
+                chat,
+                "booking_confirmation",
+                1,
+            )
+            return followup.output_text or ""
+        except Exception:
+            return _BOOKING_CONFIRMATION_FALLBACK_TEXT
+    if outcome["done"]:
+        return assistant_text
+
+    for round_idx in range(MAX_TOOL_ROUNDS):
+        try:
+            followup = await _call_model_async(
+                client,
+                _model_request(turn, accumulated_input),
+                timings,
+                turn,
+                org,
+                chat,
+                "tool_followup",
+                round_idx + 1,
+            )
+        except Exception as exc:
+            print(
+                "[admissions] OpenAI followup error",
+                {"error": str(exc), "round": round_idx, "chat_id": chat.get("id")},
+            )
+            return _followup_error_text(turn["tool_calls"])
+
+        followup_tool_calls = _function_calls(followup)
+        if not followup_tool_calls:
+            return followup.output_text or ""
+
+        print(
+            "[admissions] followup tool round",
+            {"round": round_idx + 1, "tools": [t.name for t in followup_tool_calls]},
+        )
+        followup_outputs = await run_in_threadpool(
+            _execute_followup_tools, turn, org, chat, followup_tool_calls
+        )
+        accumulated_input = accumulated_input + list(followup.output) + followup_outputs
+
+    print("[admissions] WARNING: exhausted tool rounds without text response")
+    return _TOOL_ROUNDS_DONE_TEXT
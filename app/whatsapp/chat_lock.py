@@ -0,0 +1,389 @@
+"""
+Per-chat mutual exclusion for conversation turns.
+
+The debounce scheduler, the ``chat_jobs`` worker, the edge-function direct
+fallback and manual ``/process`` calls can all start a turn for the same
+chat.  Overlapping turns each rewrote ``state_context`` (last write wins)
+and could send duplicate replies.
+
+Two layers:
+
+* in-process: an ``asyncio.Lock`` per chat, awaited for at most
+  ``CHAT_LOCK_WAIT_SECONDS``;
+* across workers: a lease in ``chat_turn_locks`` taken with
+  ``acquire_chat_turn_lock`` (serialized per chat by a transaction-level
+  advisory lock in Postgres), polled for the same bounded wait.  The
+  lease is extended every third of ``CHAT_LOCK_LEASE_SECONDS`` while the
+  turn runs, so a slow turn keeps it.
+
+A turn requested while another one is running is not run again: its text
+is folded into the holder's ``pending_text``, and the holder runs one
+follow-up turn with everything folded while it was busy.  A request for a
+debounced batch (``batch_id``, the queue's ``last_added_at``) that is
+running, folded or was just answered is dropped as a duplicate; equal text
+alone never is.  If the lock functions are unavailable the turn runs
+unlocked (fail open).
+"""
+
+import asyncio
+import threading
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from app.core.config import settings
+from app.core.supabase import (
+    get_async_supabase_client,
+    get_supabase_client,
+    get_supabase_data,
+    get_supabase_error,
+)
+from app.whatsapp.debounce import debounce_scheduler
+
+# Polling interval while another worker holds the lease.
+_POLL_SECONDS = 0.25
+
+TurnResult = Dict[str, Any]
+
+
+def _skipped(reason: str) -> TurnResult:
+    return {"status": "skipped", "reason": reason}
+
+
+def _acquire_params(
+    chat_id: str,
+    owner: str,
+    text: Optional[str],
+    batch_id: Optional[str],
+    fold: bool,
+) -> Dict[str, Any]:
+    return {
+        "p_chat_id": chat_id,
+        "p_owner": owner,
+        "p_text": text,
+        "p_batch_id": batch_id,
+        "p_lease_seconds": settings.chat_lock_lease_seconds,
+        "p_fold": fold,
+    }
+
+
+def _release_params(chat_id: str, owner: str, success: bool) -> Dict[str, Any]:
+    return {
+        "p_chat_id": chat_id,
+        "p_owner": owner,
+        "p_success": success,
+        "p_lease_seconds": settings.chat_lock_lease_seconds,
+    }
+
+
+def _extend_params(chat_id: str, owner: str) -> Dict[str, Any]:
+    return {
+        "p_chat_id": chat_id,
+        "p_owner": owner,
+        "p_lease_seconds": settings.chat_lock_lease_seconds,
+    }
+
+
+def _heartbeat_seconds() -> float:
+    return max(settings.chat_lock_lease_seconds / 3, 1)
+
+
+def _rpc_result(name: str, chat_id: str, response: Any) -> Optional[Dict[str, Any]]:
+    error = get_supabase_error(response)
+    if error:
+        print("[chat-lock] rpc error", {"rpc": name, "chat_id": chat_id, "error": str(error)})
+        return None
+    return get_supabase_data(response) or {}
+
+
+class ChatTurnLock:
+    def __init__(self) -> None:
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._users: Dict[str, int] = {}
+        self.acquired = 0
+        self.coalesced = 0
+        self.duplicates = 0
+        self.followups = 0
+        self.unlocked = 0
+        self.leases_lost = 0
+
+    def _owner(self) -> str:
+        # Unique per acquisition: threads of this process must not share it.
+        return f"{debounce_scheduler.owner}:{uuid.uuid4().hex[:8]}"
+
+    def _outcome(self, status: Optional[str]) -> Optional[TurnResult]:
+        """Result to return without running the turn, if any."""
+        if status == "coalesced":
+            self.coalesced += 1
+            return _skipped("coalesced")
+        if status == "duplicate":
+            self.duplicates += 1
+            return _skipped("duplicate")
+        if status == "acquired":
+            self.acquired += 1
+        else:
+            self.unlocked += 1
+        return None
+
+    # ── Async (debounce, chat_jobs, /process) ────────────────────
+
+    async def run(
+        self,
+        chat_id: str,
+        text: Optional[str],
+        turn: Callable[[Optional[str]], Awaitable[TurnResult]],
+        batch_id: Optional[str] = None,
+    ) -> TurnResult:
+        """Run ``turn(text)`` while holding the chat's lock."""
+        if not settings.chat_lock_enabled:
+            return await turn(text)
+
+        deadline = time.monotonic() + settings.chat_lock_wait_seconds
+        owner = self._owner()
+        local = self._locks.setdefault(chat_id, asyncio.Lock())
+        self._users[chat_id] = self._users.get(chat_id, 0) + 1
+        try:
+            status: Optional[str] = None
+            try:
+                await asyncio.wait_for(
+                    local.acquire(), timeout=max(deadline - time.monotonic(), 0.001)
+                )
+            except asyncio.TimeoutError:
+                # A turn of this process is running: fold into its follow-up.
+                status = await self._acquire_async(chat_id, owner, text, batch_id, fold=True)
+                if status in {"coalesced", "duplicate"}:
+                    return self._outcome(status)
+                # The holder just finished, or the lock table is unavailable.
+                await local.acquire()
+            try:
+                if status != "acquired":
+                    status = await self._acquire_until_async(
+                        chat_id, owner, text, batch_id, deadline
+                    )
+                outcome = self._outcome(status)
+                if outcome is not None:
+                    return outcome
+                return await self._run_locked_async(
+                    chat_id, owner, text, turn, locked=status == "acquired"
+                )
+            finally:
+                local.release()
+        finally:
+            self._users[chat_id] -= 1
+            if not self._users[chat_id]:
+                del self._users[chat_id]
+                self._locks.pop(chat_id, None)
+
+    async def _acquire_async(
+        self,
+        chat_id: str,
+        owner: str,
+        text: Optional[str],
+        batch_id: Optional[str],
+        fold: bool,
+    ) -> Optional[str]:
+        try:
+            supabase = await get_async_supabase_client()
+            response = await supabase.rpc(
+                "acquire_chat_turn_lock", _acquire_params(chat_id, owner, text, batch_id, fold)
+            ).execute()
+        except Exception as exc:
+            print("[chat-lock] acquire failed", {"chat_id": chat_id, "error": str(exc)})
+            return None
+        return (_rpc_result("acquire_chat_turn_lock", chat_id, response) or {}).get("status")
+
+    async def _acquire_until_async(
+        self,
+        chat_id: str,
+        owner: str,
+        text: Optional[str],
+        batch_id: Optional[str],
+        deadline: float,
+    ) -> Optional[str]:
+        while True:
+            fold = time.monotonic() >= deadline
+            status = await self._acquire_async(chat_id, owner, text, batch_id, fold=fold)
+            if status != "busy":
+                return status
+            await asyncio.sleep(min(_POLL_SECONDS, max(deadline - time.monotonic(), 0)))
+
+    def _lease_kept(self, chat_id: str, response: Any) -> bool:
+        """False once ``extend_chat_turn_lock`` reports the lease gone."""
+        error = get_supabase_error(response)
+        if error:
+            print("[chat-lock] heartbeat error", {"chat_id": chat_id, "error": str(error)})
+            return True
+        if get_supabase_data(response):
+            return True
+        self.leases_lost += 1
+        print("[chat-lock] lease lost", {"chat_id": chat_id})
+        return False
+
+    async def _heartbeat_async(self, chat_id: str, owner: str) -> None:
+        while True:
+            await asyncio.sleep(_heartbeat_seconds())
+            try:
+                supabase = await get_async_supabase_client()
+                response = await supabase.rpc(
+                    "extend_chat_turn_lock", _extend_params(chat_id, owner)
+                ).execute()
+            except Exception as exc:
+                print("[chat-lock] heartbeat error", {"chat_id": chat_id, "error": str(exc)})
+                continue
+            if not self._lease_kept(chat_id, response):
+                return
+
+    async def _run_locked_async(
+        self,
+        chat_id: str,
+        owner: str,
+        text: Optional[str],
+        turn: Callable[[Optional[str]], Awaitable[TurnResult]],
+        locked: bool,
+    ) -> TurnResult:
+        while True:
+            error: Optional[BaseException] = None
+            result: TurnResult = {}
+            heartbeat = (
+                asyncio.create_task(self._heartbeat_async(chat_id, owner)) if locked else None
+            )
+            try:
+                result = await turn(text)
+            except Exception as exc:
+                error = exc
+            finally:
+                if heartbeat is not None:
+                    heartbeat.cancel()
+            if not locked:
+                if error is not None:
+                    raise error
+                return result
+
+            release: Dict[str, Any] = {}
+            try:
+                supabase = await get_async_supabase_client()
+                response = await supabase.rpc(
+                    "release_chat_turn_lock",
+                    _release_params(chat_id, owner, error is None),
+                ).execute()
+                release = _rpc_result("release_chat_turn_lock", chat_id, response) or {}
+            except Exception as exc:
+                # The lease expires on its own.
+                print("[chat-lock] release failed", {"chat_id": chat_id, "error": str(exc)})
+
+            if release.get("status") == "rerun":
+                text = release.get("combined_text")
+                self.followups += 1
+                print("[chat-lock] follow-up turn", {"chat_id": chat_id})
+                continue
+            if error is not None:
+                raise error
+            return result
+
+    # ── Sync (edge-function direct fallback) ─────────────────────
+
+    def run_sync(
+        self,
+        chat_id: str,
+        text: Optional[str],
+        turn: Callable[[Optional[str]], TurnResult],
+        batch_id: Optional[str] = None,
+    ) -> TurnResult:
+        """Blocking counterpart of ``run`` (database lease only)."""
+        if not settings.chat_lock_enabled:
+            return turn(text)
+
+        deadline = time.monotonic() + settings.chat_lock_wait_seconds
+        owner = self._owner()
+        while True:
+            fold = time.monotonic() >= deadline
+            status = self._acquire_sync(chat_id, owner, text, batch_id, fold=fold)
+            if status != "busy":
+                break
+            time.sleep(min(_POLL_SECONDS, max(deadline - time.monotonic(), 0)))
+        outcome = self._outcome(status)
+        if outcome is not None:
+            return outcome
+        if status != "acquired":
+            return turn(text)
+
+        while True:
+            error: Optional[BaseException] = None
+            result: TurnResult = {}
+            done = threading.Event()
+            heartbeat = threading.Thread(
+                target=self._heartbeat_sync,
+                args=(chat_id, owner, done),
+                name="chat-lock-heartbeat",
+                daemon=True,
+            )
+            heartbeat.start()
+            try:
+                result = turn(text)
+            except Exception as exc:
+                error = exc
+            finally:
+                done.set()
+            release: Dict[str, Any] = {}
+            try:
+                response = get_supabase_client().rpc(
+                    "release_chat_turn_lock",
+                    _release_params(chat_id, owner, error is None),
+                ).execute()
+                release = _rpc_result("release_chat_turn_lock", chat_id, response) or {}
+            except Exception as exc:
+                print("[chat-lock] release failed", {"chat_id": chat_id, "error": str(exc)})
+            if release.get("status") == "rerun":
+                text = release.get("combined_text")
+                self.followups += 1
+                print("[chat-lock] follow-up turn", {"chat_id": chat_id})
+                continue
+            if error is not None:
+                raise error
+            return result
+
+    def _heartbeat_sync(self, chat_id: str, owner: str, done: threading.Event) -> None:
+        while not done.wait(_heartbeat_seconds()):
+            try:
+                response = get_supabase_client().rpc(
+                    "extend_chat_turn_lock", _extend_params(chat_id, owner)
+                ).execute()
+            except Exception as exc:
+                print("[chat-lock] heartbeat error", {"chat_id": chat_id, "error": str(exc)})
+                continue
+            if not self._lease_kept(chat_id, response):
+                return
+
+    def _acquire_sync(
+        self,
+        chat_id: str,
+        owner: str,
+        text: Optional[str],
+        batch_id: Optional[str],
+        fold: bool,
+    ) -> Optional[str]:
+        try:
+            response = get_supabase_client().rpc(
+                "acquire_chat_turn_lock", _acquire_params(chat_id, owner, text, batch_id, fold)
+            ).execute()
+        except Exception as exc:
+            print("[chat-lock] acquire failed", {"chat_id": chat_id, "error": str(exc)})
+            return None
+        return (_rpc_result("acquire_chat_turn_lock", chat_id, response) or {}).get("status")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": settings.chat_lock_enabled,
+            "active_chats": len(self._users),
+            "acquired": self.acquired,
+            "coalesced": self.coalesced,
+            "duplicates": self.duplicates,
+            "followups": self.followups,
+            "unlocked": self.unlocked,
+            "leases_lost": self.leases_lost,
+            "wait_seconds": settings.chat_lock_wait_seconds,
+            "lease_seconds": settings.chat_lock_lease_seconds,
+        }
+
+
+chat_turn_lock = ChatTurnLock()
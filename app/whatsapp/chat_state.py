@@ -5,6 +5,8 @@ This module contains all stateful helpers that operate on the chat's
 `state_context` dict and lead lookups from Supabase.
 """
 
+import copy
+import threading
 from datetime import datetime
 from typing import Any, Dict, List, Optional
 
@@ -13,6 +15,8 @@ from app.core.supabase import (
     get_supabase_data,
     get_supabase_error,
 )
+from app.whatsapp.lead_repository import get_lead_repository
+from app.whatsapp.turn_context import invalidate_turn_leads
 
 
 # ── Naming helpers ────────────────────────────────────────────────
@@ -26,22 +30,36 @@ def compose_full_name(parts: List[Optional[str]]) -> Optional[str]:
 # ── Chat state accessors ──────────────────────────────────────────
 
 
+# Tool calls of one model response may run concurrently (tool_executor);
+# keep each in-memory state mutation atomic.
+_state_lock = threading.Lock()
+
+
 def get_chat_state(chat: Dict[str, Any]) -> Dict[str, Any]:
     return chat.get("state_context") or {}
 
 
+def _write_chat_state(supabase: Any, chat: Dict[str, Any], state: Dict[str, Any]) -> None:
+    supabase.from_("chats").update(
+        {"state_context": state, "updated_at": datetime.utcnow().isoformat()}
+    ).eq("id", chat.get("id")).execute()
+
+
 def set_chat_state_value(
     supabase: Any,
     chat: Dict[str, Any],
     key: str,
     value: Any,
 ) -> None:
-    state = get_chat_state(chat)
-    state[key] = value
-    supabase.from_("chats").update(
-        {"state_context": state, "updated_at": datetime.utcnow().isoformat()}
-    ).eq("id", chat.get("id")).execute()
-    chat["state_context"] = state
+    with _state_lock:
+        state = get_chat_state(chat)
+        state[key] = value
+        chat["state_context"] = state
+    session = chat.get("_state_session")
+    if session is not None:
+        session.mark_dirty()
+        return
+    _write_chat_state(supabase, chat, state)
 
 
 def pop_chat_state_value(
@@ -49,17 +67,99 @@ def pop_chat_state_value(
     chat: Dict[str, Any],
     key: str,
 ) -> Optional[Any]:
-    state = get_chat_state(chat)
-    if key not in state:
-        return None
-    value = state.pop(key)
-    supabase.from_("chats").update(
-        {"state_context": state, "updated_at": datetime.utcnow().isoformat()}
-    ).eq("id", chat.get("id")).execute()
-    chat["state_context"] = state
+    with _state_lock:
+        state = get_chat_state(chat)
+        if key not in state:
+            return None
+        value = state.pop(key)
+        chat["state_context"] = state
+    session = chat.get("_state_session")
+    if session is not None:
+        session.mark_dirty()
+        return value
+    _write_chat_state(supabase, chat, state)
     return value
 
 
+# ── Per-turn state session (unit of work) ─────────────────────────
+
+
+class ChatStateSession:
+    """Collects ``state_context`` mutations for one turn and writes them once.
+
+    While attached to a chat (``chat["_state_session"]``),
+    ``set_chat_state_value`` / ``pop_chat_state_value`` only mutate the
+    in-memory state.  ``flush()`` persists it with a single UPDATE and is a
+    no-op when the state is unchanged since the last flush.  Use it as a
+    context manager so the final flush happens even on errors::
+
+        with ChatStateSession(supabase, chat):
+            ...
+    """
+
+    def __init__(self, supabase: Any, chat: Dict[str, Any]) -> None:
+        self.supabase = supabase
+        self.chat = chat
+        self.writes = 0
+        self.mutations = 0
+        self._dirty = False
+        self._snapshot = copy.deepcopy(get_chat_state(chat))
+
+    def mark_dirty(self) -> None:
+        self._dirty = True
+        self.mutations += 1
+
+    @property
+    def dirty(self) -> bool:
+        return self._dirty and get_chat_state(self.chat) != self._snapshot
+
+    def flush(self) -> bool:
+        """Write pending state; returns True when an UPDATE was issued."""
+        if not self.dirty:
+            self._dirty = False
+            return False
+        state = get_chat_state(self.chat)
+        _write_chat_state(self.supabase, self.chat, state)
+        self._snapshot = copy.deepcopy(state)
+        self._dirty = False
+        self.writes += 1
+        return True
+
+    def __enter__(self) -> "ChatStateSession":
+        self.chat["_state_session"] = self
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        try:
+            self.flush()
+        except Exception as flush_exc:
+            if exc_type is None:
+                raise
+            print(
+                "[chat_state] flush failed during error handling",
+                {"chat_id": self.chat.get("id"), "error": str(flush_exc)},
+            )
+        finally:
+            self.chat.pop("_state_session", None)
+            if self.mutations:
+                print(
+                    "[chat_state] session closed",
+                    {
+                        "chat_id": self.chat.get("id"),
+                        "mutations": self.mutations,
+                        "writes": self.writes,
+                    },
+                )
+
+
+def flush_chat_state(chat: Dict[str, Any]) -> bool:
+    """Checkpoint: persist pending state if a session is attached."""
+    session = chat.get("_state_session")
+    if session is None:
+        return False
+    return session.flush()
+
+
 # ── Lead lookups ──────────────────────────────────────────────────
 
 _LEAD_SELECT_FIELDS = (
@@ -74,8 +174,16 @@ def get_leads_by_chat(
     org_id: str,
     chat_id: str,
     wa_id: Optional[str] = None,
+    chat: Optional[Dict[str, Any]] = None,
 ) -> List[Dict[str, Any]]:
-    """Return all leads associated with a chat, newest first."""
+    """Return all leads associated with a chat, newest first.
+
+    Served from the turn's lead repository when *chat* carries one.
+    """
+    repo = get_lead_repository(chat)
+    if repo is not None:
+        return repo.leads(supabase)
+
     response = (
         supabase.from_("leads")
         .select(_LEAD_SELECT_FIELDS)
@@ -112,9 +220,10 @@ def get_lead_by_chat(
     org_id: str,
     chat_id: str,
     wa_id: Optional[str] = None,
+    chat: Optional[Dict[str, Any]] = None,
 ) -> Optional[Dict[str, Any]]:
     """Return the most recent (primary) lead for a chat."""
-    leads = get_leads_by_chat(supabase, org_id, chat_id, wa_id)
+    leads = get_leads_by_chat(supabase, org_id, chat_id, wa_id, chat=chat)
     return leads[0] if leads else None
 
 
@@ -205,6 +314,7 @@ def clear_slot_options(
             supabase.from_("leads").update(
                 {"metadata": metadata, "updated_at": datetime.utcnow().isoformat()}
             ).eq("id", lead.get("id")).execute()
+            invalidate_turn_leads(chat)
     pop_chat_state_value(supabase, chat, "slot_options")
 
 
@@ -0,0 +1,292 @@
+"""
+In-process debounce scheduler for inbound WhatsApp messages.
+
+Replaces the fixed 15 s sleep of the ``process-whatsapp-queue`` edge
+function.  Every ingested message (re)arms an asyncio timer for its chat;
+when the timer fires the batch accumulated in ``message_queue`` is handed
+to the durable ``chat_jobs`` queue (``app.whatsapp.jobs``), or, with
+``CHAT_JOBS_ENABLED=false``, claimed with a DB lease
+(``claim_message_queue``) and processed right here.  The window is
+adaptive: a single complete question is answered after ``DEBOUNCE_MIN_MS``,
+fragments and bursts wait longer (up to ``DEBOUNCE_MAX_MS``) while the user
+keeps typing.
+
+Timers do not survive a restart, so a periodic sweep (every
+``DEBOUNCE_SWEEP_SECONDS``, and once at startup) hands batches whose window
+is long over and that nobody is processing to the same claim/enqueue path.
+Failed enqueues are retried with backoff.
+
+``DEBOUNCE_BACKEND=edge`` keeps the old edge-function flow.
+"""
+
+import asyncio
+import os
+import socket
+import uuid
+from dataclasses import dataclass
+from typing import Any, Dict, Optional, Set
+
+from app.core.config import settings
+from app.core.supabase import (
+    get_async_supabase_client,
+    get_supabase_data,
+    get_supabase_error,
+)
+
+_COMPLETE_ENDINGS = ("?", ".", "!")
+# Extra wait per additional message in the same burst.
+_BURST_STEP_MS = 2000
+# A batch is stranded once this long past the longest window...
+_SWEEP_GRACE_MS = 5000
+# ...and not yet older than this (older text is not answered anymore).
+_SWEEP_MAX_AGE_SECONDS = 3600
+_ENQUEUE_RETRIES = 5
+
+
+def debounce_window_seconds(text: Optional[str], burst: int = 1) -> float:
+    """Quiet period before processing a chat, from its latest text."""
+    cleaned = (text or "").strip()
+    complete = cleaned.endswith(_COMPLETE_ENDINGS) and len(cleaned.split()) >= 3
+    base_ms = settings.debounce_min_ms if complete else settings.debounce_typing_ms
+    window_ms = base_ms + max(burst - 1, 0) * _BURST_STEP_MS
+    return min(window_ms, settings.debounce_max_ms) / 1000
+
+
+@dataclass
+class _PendingChat:
+    handle: Optional[asyncio.TimerHandle] = None
+    burst: int = 0
+    window: float = 0.0
+
+
+async def _queue_rpc(name: str, params: Dict[str, Any]) -> Dict[str, Any]:
+    supabase = await get_async_supabase_client()
+    response = await supabase.rpc(name, params).execute()
+    error = get_supabase_error(response)
+    if error:
+        print("[debounce] rpc error", {"rpc": name, "chat_id": params.get("p_chat_id"), "error": str(error)})
+        return {}
+    return get_supabase_data(response) or {}
+
+
+class DebounceScheduler:
+    def __init__(self) -> None:
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._pending: Dict[str, _PendingChat] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self._sweeper: Optional[asyncio.Task] = None
+        self._enqueue_failures: Dict[str, int] = {}
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.processed = 0
+        self.failed = 0
+        self.swept = 0
+
+    # ── Lifecycle ────────────────────────────────────────────────
+
+    def start(self, loop: asyncio.AbstractEventLoop) -> None:
+        self._loop = loop
+        if settings.debounce_backend != "edge" and settings.debounce_sweep_seconds > 0:
+            self._sweeper = loop.create_task(self._sweep_loop())
+        print("[debounce] scheduler started", {"owner": self.owner})
+
+    async def stop(self) -> None:
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            await asyncio.gather(self._sweeper, return_exceptions=True)
+            self._sweeper = None
+        for pending in self._pending.values():
+            if pending.handle:
+                pending.handle.cancel()
+        self._pending.clear()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._loop = None
+
+    @property
+    def running(self) -> bool:
+        return self._loop is not None and not self._loop.is_closed()
+
+    # ── Scheduling ───────────────────────────────────────────────
+
+    def schedule(self, chat_id: str, text: Optional[str], messages: int = 1) -> bool:
+        """Arm (or reset) the timer for *chat_id*; safe from any thread.
+
+        Returns False when no event loop is attached (e.g. scripts), so the
+        caller can fall back to the edge function.
+        """
+        if not self.running:
+            return False
+        self._loop.call_soon_threadsafe(self._arm, chat_id, text, messages)
+        return True
+
+    def _arm(self, chat_id: str, text: Optional[str], messages: int = 1) -> None:
+        pending = self._pending.get(chat_id)
+        if pending is None:
+            pending = _PendingChat()
+            self._pending[chat_id] = pending
+        elif pending.handle:
+            pending.handle.cancel()
+        pending.burst += max(messages, 1)
+        pending.window = debounce_window_seconds(text, pending.burst)
+        pending.handle = self._loop.call_later(pending.window, self._fire, chat_id)
+        print(
+            "[debounce] armed",
+            {"chat_id": chat_id, "burst": pending.burst, "window_s": pending.window},
+        )
+
+    def _retry_later(self, chat_id: str, delay: float, window: float) -> None:
+        # A newer message already re-armed the chat; that timer wins.
+        if chat_id in self._pending:
+            return
+        pending = _PendingChat(burst=1, window=window)
+        pending.handle = self._loop.call_later(delay, self._fire, chat_id)
+        self._pending[chat_id] = pending
+
+    def _fire(self, chat_id: str) -> None:
+        pending = self._pending.pop(chat_id, None)
+        window = pending.window if pending else settings.debounce_min_ms / 1000
+        task = self._loop.create_task(self._process(chat_id, window))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    # ── Processing ───────────────────────────────────────────────
+
+    async def _process(self, chat_id: str, window: float) -> None:
+        if settings.chat_jobs_enabled:
+            await self._enqueue_job(chat_id, window)
+            return
+
+        claim = await _queue_rpc(
+            "claim_message_queue",
+            {
+                "p_chat_id": chat_id,
+                "p_owner": self.owner,
+                "p_quiet_ms": int(window * 1000),
+                "p_lease_seconds": settings.debounce_lease_seconds,
+            },
+        )
+        status = claim.get("status")
+        if status in {"pending", "busy"}:
+            delay = min(
+                max(int(claim.get("wait_ms") or 0), 250) / 1000,
+                settings.debounce_max_ms / 1000,
+            )
+            print("[debounce] not ready", {"chat_id": chat_id, "status": status, "retry_s": delay})
+            self._retry_later(chat_id, delay, window)
+            return
+        if status != "claimed":
+            return
+
+        from app.whatsapp.process_router import ProcessQueueRequest, run_process_queue
+
+        final_message = claim.get("combined_text") or ""
+        success = False
+        try:
+            result = await run_process_queue(
+                ProcessQueueRequest(
+                    chat_id=chat_id,
+                    final_message=final_message,
+                    batch_id=claim.get("last_added_at"),
+                )
+            )
+            success = isinstance(result, dict) and result.get("status") in {"sent", "skipped"}
+        except Exception as exc:
+            print("[debounce] processing error", {"chat_id": chat_id, "error": str(exc)})
+
+        if success:
+            self.processed += 1
+        else:
+            self.failed += 1
+
+        release = await _queue_rpc(
+            "release_message_queue",
+            {
+                "p_chat_id": chat_id,
+                "p_owner": self.owner,
+                "p_processed_text": final_message,
+                "p_success": success,
+            },
+        )
+        print("[debounce] released", {"chat_id": chat_id, "status": release.get("status")})
+        if release.get("status") == "requeued":
+            self._arm(chat_id, release.get("combined_text"))
+
+    async def _enqueue_job(self, chat_id: str, window: float) -> None:
+        from app.whatsapp.jobs import chat_job_worker
+
+        try:
+            result = await chat_job_worker.enqueue(chat_id, int(window * 1000))
+        except Exception as exc:
+            attempts = self._enqueue_failures.get(chat_id, 0) + 1
+            print(
+                "[debounce] enqueue error",
+                {"chat_id": chat_id, "attempt": attempts, "error": str(exc)},
+            )
+            if attempts <= _ENQUEUE_RETRIES:
+                self._enqueue_failures[chat_id] = attempts
+                self._retry_later(chat_id, min(2 ** attempts, 30), window)
+            else:
+                # Left to the sweep.
+                self._enqueue_failures.pop(chat_id, None)
+            return
+        self._enqueue_failures.pop(chat_id, None)
+        if result.get("status") == "pending":
+            delay = min(
+                max(int(result.get("wait_ms") or 0), 250) / 1000,
+                settings.debounce_max_ms / 1000,
+            )
+            self._retry_later(chat_id, delay, window)
+            return
+        print("[debounce] job enqueue", {"chat_id": chat_id, "status": result.get("status")})
+
+    # ── Sweep ────────────────────────────────────────────────────
+
+    async def _sweep_loop(self) -> None:
+        while True:
+            try:
+                await self.sweep()
+            except Exception as exc:
+                print("[debounce] sweep error", {"error": str(exc)})
+            await asyncio.sleep(settings.debounce_sweep_seconds)
+
+    async def sweep(self) -> int:
+        """Process batches left without a timer (e.g. by a restart)."""
+        supabase = await get_async_supabase_client()
+        response = await supabase.rpc(
+            "list_stale_message_queues",
+            {
+                "p_quiet_ms": settings.debounce_max_ms + _SWEEP_GRACE_MS,
+                "p_max_age_seconds": _SWEEP_MAX_AGE_SECONDS,
+            },
+        ).execute()
+        error = get_supabase_error(response)
+        if error:
+            raise RuntimeError(f"list_stale_message_queues failed: {error}")
+
+        swept = 0
+        for row in get_supabase_data(response) or []:
+            chat_id = row.get("chat_id")
+            if not chat_id or chat_id in self._pending:
+                continue
+            swept += 1
+            self._fire(chat_id)
+        if swept:
+            self.swept += swept
+            print("[debounce] swept stranded batches", {"chats": swept})
+        return swept
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": settings.debounce_backend,
+            "running": self.running,
+            "owner": self.owner,
+            "pending_chats": len(self._pending),
+            "in_flight": len(self._tasks),
+            "processed": self.processed,
+            "failed": self.failed,
+            "swept": self.swept,
+            "enqueue_retrying": len(self._enqueue_failures),
+        }
+
+
+debounce_scheduler = DebounceScheduler()
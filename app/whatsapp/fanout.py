@@ -0,0 +1,85 @@
+"""
+Bounded fan-out of blocking per-chat work, in order within each chat.
+
+With ``DEBOUNCE_BACKEND=edge`` (or when the in-process debounce scheduler is
+not running) every chat of a webhook was handed to the
+``process-whatsapp-queue`` edge function, and on failure processed with a
+full synchronous turn, one chat after another.  ``KeyedExecutor`` runs
+these calls on a thread pool of ``CHAT_FANOUT_CONCURRENCY`` workers, sized
+to the OpenAI rate limits.  Work items with the same key (chat id) never run
+concurrently and keep their submission order: a chat has at most one
+running item and the rest wait in its queue.
+"""
+
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Deque, Dict, Tuple
+
+from app.core.config import settings
+
+_WorkItem = Tuple[Callable[..., Any], Tuple[Any, ...], Dict[str, Any]]
+
+
+class KeyedExecutor:
+    def __init__(self, max_workers: int, name: str = "fanout") -> None:
+        self.max_workers = max(max_workers, 1)
+        self.name = name
+        self._pool = ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix=name
+        )
+        self._lock = threading.Lock()
+        # key → items waiting behind the one currently running
+        self._queues: Dict[str, Deque[_WorkItem]] = {}
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+
+    def submit(self, key: str, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> None:
+        """Run ``fn(*args, **kwargs)`` after earlier work for *key*."""
+        item: _WorkItem = (fn, args, kwargs)
+        with self._lock:
+            self.submitted += 1
+            queue = self._queues.get(key)
+            if queue is not None:
+                queue.append(item)
+                return
+            self._queues[key] = deque()
+        self._pool.submit(self._drain, key, item)
+
+    def _drain(self, key: str, item: _WorkItem) -> None:
+        while True:
+            fn, args, kwargs = item
+            try:
+                fn(*args, **kwargs)
+                ok = True
+            except Exception as exc:
+                ok = False
+                print(f"[{self.name}] work item failed", {"key": key, "error": str(exc)})
+            with self._lock:
+                if ok:
+                    self.completed += 1
+                else:
+                    self.failed += 1
+                queue = self._queues[key]
+                if not queue:
+                    del self._queues[key]
+                    return
+                item = queue.popleft()
+
+    def shutdown(self, wait: bool = False) -> None:
+        self._pool.shutdown(wait=wait)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "max_workers": self.max_workers,
+                "active_keys": len(self._queues),
+                "queued": sum(len(queue) for queue in self._queues.values()),
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "failed": self.failed,
+            }
+
+
+chat_fanout = KeyedExecutor(settings.chat_fanout_concurrency, name="chat-fanout")
@@ -9,6 +9,7 @@ For cycle 20XX-20(XX+1), all birth-year bounds shift by (XX - 2026).
 """
 
 from datetime import date
+from functools import lru_cache
 from typing import Dict, List, Optional, Tuple
 
 
@@ -60,6 +61,7 @@ def determine_grade(dob: date, cycle_start_year: int) -> Optional[Dict]:
     return None
 
 
+@lru_cache(maxsize=16)
 def build_grade_ranges_prompt(cycle_start_year: int) -> str:
     """Build a prompt-friendly string with DOB ranges for *cycle_start_year*."""
     ranges = get_grade_ranges(cycle_start_year)
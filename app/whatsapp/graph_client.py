@@ -0,0 +1,334 @@
+"""
+Shared HTTP layer for the WhatsApp Cloud (Graph) API.
+
+All outbound sends, media uploads and media downloads go through one pooled
+keep-alive client (HTTP/2 when available) instead of opening a new TLS
+connection per call.  On top of the pool this module adds:
+
+* a token-bucket rate limit per ``phone_number_id``;
+* retry with exponential backoff on 429/5xx (and on connection errors that
+  happen before the request is sent), honouring ``Retry-After``;
+* per-operation latency metrics, exposed via
+  ``/api/whatsapp/admin/graph/metrics``.
+"""
+
+import asyncio
+import random
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, Optional, Tuple
+
+import httpx
+
+from app.core.config import settings
+
+API_VERSION = "v21.0"
+GRAPH_BASE_URL = f"https://graph.facebook.com/{API_VERSION}"
+
+# Statuses retried for GET.  A POST (send message, upload media) that got a
+# 500/502/504 may already have been processed, so only rejections that
+# guarantee nothing was done (rate limit, unavailable) are retried for it.
+_RETRY_STATUS = {429, 500, 502, 503, 504}
+_RETRY_STATUS_UNSAFE = {429, 503}
+# Errors raised before the request reaches Meta: always safe to retry.
+_PRE_SEND_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+# Errors after the request may have been processed: only retried for GET.
+_POST_SEND_ERRORS = (httpx.ReadError, httpx.ReadTimeout, httpx.RemoteProtocolError)
+
+
+def graph_url(path: str) -> str:
+    if path.startswith("http://") or path.startswith("https://"):
+        return path
+    return f"{GRAPH_BASE_URL}/{path.lstrip('/')}"
+
+
+# ── Metrics ───────────────────────────────────────────────────────
+
+
+class GraphMetrics:
+    """Latency and retry counters per operation (send_text, upload_media...)."""
+
+    def __init__(self, sample_size: int = 500) -> None:
+        self._lock = threading.Lock()
+        self._sample_size = sample_size
+        self._ops: Dict[str, Dict[str, Any]] = {}
+
+    def _op(self, operation: str) -> Dict[str, Any]:
+        op = self._ops.get(operation)
+        if op is None:
+            op = {
+                "count": 0,
+                "errors": 0,
+                "retries": 0,
+                "rate_limited_ms": 0.0,
+                "total_ms": 0.0,
+                "max_ms": 0.0,
+                "samples": deque(maxlen=self._sample_size),
+            }
+            self._ops[operation] = op
+        return op
+
+    def record(self, operation: str, elapsed_ms: float, ok: bool) -> None:
+        with self._lock:
+            op = self._op(operation)
+            op["count"] += 1
+            op["total_ms"] += elapsed_ms
+            op["max_ms"] = max(op["max_ms"], elapsed_ms)
+            op["samples"].append(elapsed_ms)
+            if not ok:
+                op["errors"] += 1
+
+    def record_retry(self, operation: str) -> None:
+        with self._lock:
+            self._op(operation)["retries"] += 1
+
+    def record_throttle(self, operation: str, waited_ms: float) -> None:
+        with self._lock:
+            self._op(operation)["rate_limited_ms"] += waited_ms
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            result: Dict[str, Any] = {}
+            for name, op in self._ops.items():
+                samples = sorted(op["samples"])
+                result[name] = {
+                    "count": op["count"],
+                    "errors": op["errors"],
+                    "retries": op["retries"],
+                    "rate_limited_ms": round(op["rate_limited_ms"], 1),
+                    "avg_ms": round(op["total_ms"] / op["count"], 1) if op["count"] else None,
+                    "p50_ms": _percentile(samples, 0.50),
+                    "p95_ms": _percentile(samples, 0.95),
+                    "max_ms": round(op["max_ms"], 1),
+                }
+            return result
+
+
+def _percentile(samples: Any, fraction: float) -> Optional[float]:
+    if not samples:
+        return None
+    index = min(len(samples) - 1, int(round(fraction * (len(samples) - 1))))
+    return round(samples[index], 1)
+
+
+graph_metrics = GraphMetrics()
+
+
+# ── Rate limiting ─────────────────────────────────────────────────
+
+
+class PhoneNumberRateLimiter:
+    """Token bucket per phone_number_id; returns how long the caller must wait."""
+
+    def __init__(self, rate_per_second: float, burst: Optional[float] = None) -> None:
+        self.rate = rate_per_second
+        self.burst = burst or rate_per_second
+        self._lock = threading.Lock()
+        self._buckets: Dict[str, Tuple[float, float]] = {}
+
+    def reserve(self, key: Optional[str]) -> float:
+        if not key or self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            tokens, updated = self._buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            tokens -= 1
+            self._buckets[key] = (tokens, now)
+            if tokens >= 0:
+                return 0.0
+            return -tokens / self.rate
+
+
+_rate_limiter = PhoneNumberRateLimiter(settings.whatsapp_rate_limit_per_second)
+
+
+# ── Pooled clients ────────────────────────────────────────────────
+
+_client_lock = threading.Lock()
+_sync_client: Optional[httpx.Client] = None
+_async_client: Optional[httpx.AsyncClient] = None
+
+
+def _client_kwargs() -> Dict[str, Any]:
+    pool_size = settings.whatsapp_pool_size
+    return {
+        "http2": settings.whatsapp_http2,
+        "timeout": httpx.Timeout(30.0, connect=5.0),
+        "limits": httpx.Limits(
+            max_connections=pool_size,
+            max_keepalive_connections=pool_size,
+            keepalive_expiry=60,
+        ),
+    }
+
+
+def get_graph_client() -> httpx.Client:
+    global _sync_client
+    with _client_lock:
+        if _sync_client is None or _sync_client.is_closed:
+            _sync_client = httpx.Client(**_client_kwargs())
+            print(
+                "[graph] pooled client created",
+                {"http2": settings.whatsapp_http2, "pool_size": settings.whatsapp_pool_size},
+            )
+        return _sync_client
+
+
+def get_async_graph_client() -> httpx.AsyncClient:
+    global _async_client
+    with _client_lock:
+        if _async_client is None or _async_client.is_closed:
+            _async_client = httpx.AsyncClient(**_client_kwargs())
+            print(
+                "[graph] pooled async client created",
+                {"http2": settings.whatsapp_http2, "pool_size": settings.whatsapp_pool_size},
+            )
+        return _async_client
+
+
+async def close_graph_clients() -> None:
+    """Close both pools (called on application shutdown)."""
+    global _sync_client, _async_client
+    with _client_lock:
+        sync_client, async_client = _sync_client, _async_client
+        _sync_client = None
+        _async_client = None
+    if sync_client is not None:
+        sync_client.close()
+    if async_client is not None:
+        await async_client.aclose()
+
+
+# ── Requests ──────────────────────────────────────────────────────
+
+
+def _retry_delay(attempt: int, response: Optional[httpx.Response]) -> float:
+    if response is not None:
+        retry_after = response.headers.get("retry-after")
+        if retry_after:
+            try:
+                return min(float(retry_after), 30.0)
+            except ValueError:
+                pass
+    return min(0.5 * (2 ** attempt), 8.0) + random.uniform(0, 0.25)
+
+
+def _is_retryable_status(method: str, status_code: int) -> bool:
+    if method.upper() == "GET":
+        return status_code in _RETRY_STATUS
+    return status_code in _RETRY_STATUS_UNSAFE
+
+
+def _is_retryable_error(method: str, exc: Exception) -> bool:
+    if isinstance(exc, _PRE_SEND_ERRORS):
+        return True
+    return method.upper() == "GET" and isinstance(exc, _POST_SEND_ERRORS)
+
+
+def graph_request(
+    method: str,
+    path: str,
+    *,
+    operation: str,
+    phone_number_id: Optional[str] = None,
+    **kwargs: Any,
+) -> httpx.Response:
+    """Send a Graph API request through the pool with rate limit and retries."""
+    client = get_graph_client()
+    url = graph_url(path)
+    max_retries = settings.whatsapp_max_retries
+
+    wait = _rate_limiter.reserve(phone_number_id)
+    if wait:
+        graph_metrics.record_throttle(operation, wait * 1000)
+        time.sleep(wait)
+
+    attempt = 0
+    while True:
+        started = time.perf_counter()
+        try:
+            response = client.request(method, url, **kwargs)
+        except httpx.TransportError as exc:
+            graph_metrics.record(operation, (time.perf_counter() - started) * 1000, ok=False)
+            if attempt < max_retries and _is_retryable_error(method, exc):
+                graph_metrics.record_retry(operation)
+                time.sleep(_retry_delay(attempt, None))
+                attempt += 1
+                continue
+            raise
+
+        graph_metrics.record(
+            operation, (time.perf_counter() - started) * 1000, ok=response.is_success
+        )
+        if attempt < max_retries and _is_retryable_status(method, response.status_code):
+            print(
+                "[graph] retrying",
+                {"operation": operation, "status": response.status_code, "attempt": attempt + 1},
+            )
+            graph_metrics.record_retry(operation)
+            time.sleep(_retry_delay(attempt, response))
+            attempt += 1
+            continue
+        return response
+
+
+async def graph_request_async(
+    method: str,
+    path: str,
+    *,
+    operation: str,
+    phone_number_id: Optional[str] = None,
+    **kwargs: Any,
+) -> httpx.Response:
+    """Async counterpart of ``graph_request``."""
+    client = get_async_graph_client()
+    url = graph_url(path)
+    max_retries = settings.whatsapp_max_retries
+
+    wait = _rate_limiter.reserve(phone_number_id)
+    if wait:
+        graph_metrics.record_throttle(operation, wait * 1000)
+        await asyncio.sleep(wait)
+
+    attempt = 0
+    while True:
+        started = time.perf_counter()
+        try:
+            response = await client.request(method, url, **kwargs)
+        except httpx.TransportError as exc:
+            graph_metrics.record(operation, (time.perf_counter() - started) * 1000, ok=False)
+            if attempt < max_retries and _is_retryable_error(method, exc):
+                graph_metrics.record_retry(operation)
+                await asyncio.sleep(_retry_delay(attempt, None))
+                attempt += 1
+                continue
+            raise
+
+        graph_metrics.record(
+            operation, (time.perf_counter() - started) * 1000, ok=response.is_success
+        )
+        if attempt < max_retries and _is_retryable_status(method, response.status_code):
+            print(
+                "[graph] retrying",
+                {"operation": operation, "status": response.status_code, "attempt": attempt + 1},
+            )
+            graph_metrics.record_retry(operation)
+            await asyncio.sleep(_retry_delay(attempt, response))
+            attempt += 1
+            continue
+        return response
+
+
+def graph_error_message(response: httpx.Response) -> Tuple[Dict[str, Any], Optional[str]]:
+    """Return (json body, error message or None) for a Graph API response."""
+    try:
+        data = response.json()
+    except ValueError:
+        data = {}
+    if not isinstance(data, dict):
+        data = {}
+    if response.is_success:
+        return data, None
+    return data, data.get("error", {}).get("message") or "Unknown WhatsApp API error"
@@ -0,0 +1,393 @@
+"""
+Conversation history window for the admissions chatbot.
+
+Keeps the model input bounded: only the most recent session messages are
+loaded (DB-side limit), their size is estimated in tokens, and whatever
+falls outside the per-org budget is folded into a rolling summary stored on
+``chat_sessions.history_summary``.  The summary is refreshed incrementally —
+each refresh only sends the previous summary plus the newly evicted
+messages to the model — on a background executor (one job at a time per
+session), never on the turn's critical path.  A backlog larger than the
+fetched window (long sessions from before the summary existed) is
+summarized in chunks.
+"""
+
+import re
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+from app.core.config import settings
+from app.core.supabase import get_supabase_client, get_supabase_data
+from app.whatsapp.ai_logs import ai_log_writer
+from app.whatsapp.fanout import KeyedExecutor
+
+# Background summary refreshes, serialized per session.
+history_summarizer = KeyedExecutor(2, name="history-summary")
+
+
+# ── Timestamp ordering ────────────────────────────────────────────
+
+
+def _normalize_dt(value: str) -> str:
+    normalized = value.strip()
+    if normalized.endswith("Z"):
+        normalized = normalized.replace("Z", "+00:00")
+    if len(normalized) >= 3 and normalized[-3] in {"+", "-"}:
+        normalized = f"{normalized}:00"
+    if len(normalized) >= 5 and normalized[-5] in {"+", "-"}:
+        normalized = f"{normalized[:-2]}:{normalized[-2:]}"
+
+    # Fix microseconds to be 3 or 6 digits for Python < 3.11 compatibility
+    match = re.search(r"\.(\d+)(?:([+-]\d{2}:\d{2})|$)", normalized)
+    if match:
+        us = match.group(1)
+        tz = match.group(2) or ""
+        if len(us) != 3 and len(us) != 6:
+            if len(us) < 6:
+                new_us = us.ljust(6, "0")
+            else:
+                new_us = us[:6]
+            normalized = normalized.replace(f".{us}{tz}", f".{new_us}{tz}")
+
+    return normalized
+
+
+def parse_message_dt(value: Optional[str]) -> Optional[datetime]:
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(_normalize_dt(value))
+        if parsed.tzinfo is None:
+            return parsed.replace(tzinfo=timezone.utc)
+        return parsed
+    except ValueError:
+        try:
+            parsed = datetime.fromisoformat(_normalize_dt(value.replace(" ", "T")))
+            if parsed.tzinfo is None:
+                return parsed.replace(tzinfo=timezone.utc)
+            return parsed
+        except ValueError:
+            return None
+
+
+def order_session_messages(
+    data: List[Dict[str, Any]],
+) -> List[Dict[str, Any]]:
+    """Chronological user/assistant messages (user turns by WhatsApp time)."""
+
+    def _sort_key(item: Dict[str, Any]) -> float:
+        role = item.get("role")
+        created_dt = parse_message_dt(item.get("created_at"))
+        wa_dt = parse_message_dt(item.get("wa_timestamp"))
+        if role == "user" and wa_dt:
+            dt = wa_dt
+        else:
+            dt = created_dt or wa_dt
+        return dt.timestamp() if dt else 0.0
+
+    ordered = sorted(data, key=_sort_key)
+    return [
+        item
+        for item in ordered
+        if item.get("role") in {"user", "assistant"} and item.get("body")
+    ]
+
+
+# ── Budget ────────────────────────────────────────────────────────
+
+
+def estimate_tokens(text: Optional[str]) -> int:
+    """Cheap token estimate (~4 characters per token for Spanish/English)."""
+    if not text:
+        return 0
+    return len(text) // 4 + 1
+
+
+@dataclass
+class HistoryLimits:
+    max_messages: int
+    max_tokens: int
+    # After an eviction the window shrinks to this fraction of the budget so
+    # the summary is not refreshed on every single turn.
+    refill_ratio: float = 0.6
+
+    @classmethod
+    def for_org(cls, org: Dict[str, Any]) -> "HistoryLimits":
+        ai_settings = org.get("ai_settings") or {}
+
+        def _int_setting(key: str, default: int) -> int:
+            try:
+                value = int(ai_settings.get(key) or default)
+            except (TypeError, ValueError):
+                return default
+            return value if value > 0 else default
+
+        return cls(
+            max_messages=_int_setting("history_max_messages", settings.history_max_messages),
+            max_tokens=_int_setting("history_max_tokens", settings.history_max_tokens),
+        )
+
+
+@dataclass
+class HistoryWindow:
+    messages: List[Dict[str, Any]]
+    summary: Optional[str] = None
+    evicted: List[Dict[str, Any]] = field(default_factory=list)
+    estimated_tokens: int = 0
+
+
+def _messages_tokens(messages: List[Dict[str, Any]]) -> int:
+    return sum(estimate_tokens(message.get("body")) + 4 for message in messages)
+
+
+def _split_evictable(
+    messages: List[Dict[str, Any]],
+) -> int:
+    """Index after the last assistant message (pending user texts are kept)."""
+    last_assistant_index = -1
+    for index, message in enumerate(messages):
+        if message.get("role") == "assistant":
+            last_assistant_index = index
+    return last_assistant_index + 1
+
+
+def select_history_window(
+    messages: List[Dict[str, Any]],
+    limits: HistoryLimits,
+    summary: Optional[str] = None,
+) -> HistoryWindow:
+    """Pick the most recent messages that fit the budget.
+
+    *messages* must be chronologically ordered.  Unanswered user messages
+    (after the last assistant reply) are never evicted.
+    """
+    boundary = _split_evictable(messages)
+    answered, pending = messages[:boundary], messages[boundary:]
+    base_tokens = _messages_tokens(pending) + estimate_tokens(summary)
+
+    def _fits(candidate: List[Dict[str, Any]], ratio: float) -> bool:
+        return (
+            len(candidate) + len(pending) <= limits.max_messages * ratio
+            and _messages_tokens(candidate) + base_tokens <= limits.max_tokens * ratio
+        )
+
+    if _fits(answered, 1.0):
+        return HistoryWindow(
+            messages=messages,
+            summary=summary,
+            estimated_tokens=_messages_tokens(answered) + base_tokens,
+        )
+
+    start = 0
+    while start < len(answered) and not _fits(answered[start:], limits.refill_ratio):
+        start += 1
+    # Never start the window on an assistant reply without its question
+    while start < len(answered) and answered[start].get("role") == "assistant":
+        start += 1
+
+    kept = answered[start:]
+    return HistoryWindow(
+        messages=kept + pending,
+        summary=summary,
+        evicted=answered[:start],
+        estimated_tokens=_messages_tokens(kept) + base_tokens,
+    )
+
+
+# ── Rolling summary ───────────────────────────────────────────────
+
+_SUMMARY_INSTRUCTIONS = (
+    "Actualiza el resumen de una conversacion de WhatsApp entre una familia y "
+    "el area de admisiones. Conserva datos clave (nombres, grados, fechas, "
+    "citas, documentos solicitados, acuerdos y pendientes) y elimina saludos "
+    "y relleno. Responde solo con el resumen actualizado, en espanol, en "
+    "maximo 12 lineas."
+)
+
+
+# Messages folded into the summary per model call.
+_SUMMARY_CHUNK = 60
+
+
+def _summarize(
+    previous_summary: Optional[str],
+    evicted: List[Dict[str, Any]],
+    model: str,
+    log: Dict[str, Any],
+    round_index: int,
+) -> Optional[str]:
+    from app.chat.service import get_openai_client
+
+    transcript = "\n".join(
+        f"{'Usuario' if message.get('role') == 'user' else 'Asistente'}: {message.get('body')}"
+        for message in evicted
+    )
+    prompt = (
+        f"Resumen anterior:\n{previous_summary or '(sin resumen)'}\n\n"
+        f"Mensajes nuevos a incorporar:\n{transcript}"
+    )
+    started = time.perf_counter()
+    response = None
+    error: Optional[BaseException] = None
+    try:
+        response = get_openai_client().responses.create(
+            model=model,
+            instructions=_SUMMARY_INSTRUCTIONS,
+            input=[{"role": "user", "content": prompt}],
+        )
+    except Exception as exc:
+        error = exc
+        print("[history] summary refresh failed", {"error": str(exc)})
+    ai_log_writer.log_model_call(
+        model=model,
+        kind="history_summary",
+        round_index=round_index,
+        latency_ms=(time.perf_counter() - started) * 1000,
+        response=response,
+        error=error,
+        **log,
+    )
+    if response is None:
+        return None
+    return (response.output_text or "").strip() or None
+
+
+def _load_backlog(
+    session_id: str,
+    summarized_until: Optional[str],
+    until: Optional[str],
+    before: Optional[str],
+) -> List[Dict[str, Any]]:
+    query = (
+        get_supabase_client()
+        .from_("messages")
+        .select("role, body, created_at, wa_timestamp")
+        .eq("chat_session_id", session_id)
+    )
+    if summarized_until:
+        query = query.gt("created_at", summarized_until)
+    if until:
+        query = query.lte("created_at", until)
+    if before:
+        query = query.lt("created_at", before)
+    response = query.order("created_at").execute()
+    return get_supabase_data(response) or []
+
+
+def summarize_history(
+    session_id: str,
+    model: str,
+    log: Dict[str, Any],
+    until: Optional[str] = None,
+    before: Optional[str] = None,
+) -> None:
+    """Fold every unsummarized message up to *until* (or *before*) into the summary.
+
+    Runs in the background.  The stored summary and cut-off are re-read
+    first, so a job queued twice for the same session does nothing the
+    second time; progress is saved after each chunk.
+    """
+    session_response = (
+        get_supabase_client()
+        .from_("chat_sessions")
+        .select("history_summary, history_summarized_until")
+        .eq("id", session_id)
+        .single()
+        .execute()
+    )
+    session = get_supabase_data(session_response) or {}
+    summary = session.get("history_summary")
+    summarized_until = session.get("history_summarized_until")
+
+    backlog = order_session_messages(
+        _load_backlog(session_id, summarized_until, until, before)
+    )
+    for index in range(0, len(backlog), _SUMMARY_CHUNK):
+        chunk = backlog[index:index + _SUMMARY_CHUNK]
+        new_summary = _summarize(summary, chunk, model, log, index // _SUMMARY_CHUNK)
+        if not new_summary:
+            # The rest is retried by a later turn (the cut-off did not move).
+            return
+        chunk_times = [parse_message_dt(message.get("created_at")) for message in chunk]
+        chunk_until = max((dt for dt in chunk_times if dt), default=None)
+
+        payload: Dict[str, Any] = {
+            "history_summary": new_summary,
+            "updated_at": datetime.utcnow().isoformat(),
+        }
+        if chunk_until:
+            payload["history_summarized_until"] = chunk_until.isoformat()
+        get_supabase_client().from_("chat_sessions").update(payload).eq(
+            "id", session_id
+        ).execute()
+        summary = new_summary
+        print(
+            "[history] summary refreshed",
+            {
+                "session_id": session_id,
+                "summarized": len(chunk),
+                "remaining": max(len(backlog) - index - len(chunk), 0),
+                "summary_tokens": estimate_tokens(new_summary),
+            },
+        )
+
+
+def _message_times(messages: List[Dict[str, Any]]) -> List[datetime]:
+    return [
+        dt for dt in (parse_message_dt(message.get("created_at")) for message in messages) if dt
+    ]
+
+
+def build_history_window(
+    session_id: str,
+    messages: List[Dict[str, Any]],
+    org: Dict[str, Any],
+    summary: Optional[str],
+    model: str,
+    chat_id: Optional[str] = None,
+    unsummarized_count: int = 0,
+) -> HistoryWindow:
+    """Order and bound the session history; summarize off the turn.
+
+    Evicted messages, and unsummarized messages older than the fetched
+    ones, are folded into the summary in the background: this turn uses the
+    stored summary, the next one sees the refreshed summary.
+    """
+    limits = HistoryLimits.for_org(org)
+    window = select_history_window(order_session_messages(messages), limits, summary)
+
+    until = before = None
+    if window.evicted:
+        until = max(_message_times(window.evicted), default=None)
+    elif unsummarized_count > len(messages):
+        before = min(_message_times(messages), default=None)
+    if until or before:
+        history_summarizer.submit(
+            session_id,
+            summarize_history,
+            session_id,
+            model,
+            {"organization_id": org.get("id"), "chat_id": chat_id, "session_id": session_id},
+            until=until.isoformat() if until else None,
+            before=before.isoformat() if before else None,
+        )
+    print(
+        "[history] window",
+        {
+            "session_id": session_id,
+            "messages": len(window.messages),
+            "evicted": len(window.evicted),
+            "unsummarized": unsummarized_count,
+            "estimated_tokens": window.estimated_tokens,
+            "has_summary": bool(window.summary),
+        },
+    )
+    return window
+
+
+def summary_instructions(summary: Optional[str]) -> Optional[str]:
+    if not summary:
+        return None
+    return f"RESUMEN DE LA CONVERSACION PREVIA (mensajes anteriores):\n{summary}"
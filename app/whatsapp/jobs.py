@@ -0,0 +1,243 @@
+"""
+Durable chat-turn queue backed by the ``chat_jobs`` table.
+
+The debounce scheduler enqueues a job once a chat has been quiet long
+enough; ``ChatJobWorker`` pulls jobs with ``claim_chat_jobs`` (``FOR UPDATE
+SKIP LOCKED``) and runs up to ``CHAT_JOBS_CONCURRENCY`` turns at a time per
+process.  Each running job holds a lease that is extended while the turn is
+in progress; if the worker dies the lease expires and another replica picks
+the job up.  Failures are retried with exponential backoff and end in
+``chat_jobs_dead_letter`` after ``CHAT_JOBS_MAX_ATTEMPTS``.  A turn whose
+reply already reached WhatsApp reports ``sent`` even if a later step fails
+(see ``process_router._reply_sent_result``), so a retry never answers the
+same batch twice.
+"""
+
+import asyncio
+from typing import Any, Dict, List, Optional, Set
+
+from app.core.config import settings
+from app.core.supabase import (
+    get_async_supabase_client,
+    get_supabase_data,
+    get_supabase_error,
+)
+from app.whatsapp.debounce import debounce_scheduler
+
+
+async def _jobs_rpc(name: str, params: Dict[str, Any]) -> Any:
+    supabase = await get_async_supabase_client()
+    response = await supabase.rpc(name, params).execute()
+    error = get_supabase_error(response)
+    if error:
+        raise RuntimeError(f"{name} failed: {error}")
+    return get_supabase_data(response)
+
+
+class ChatJobWorker:
+    def __init__(self) -> None:
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wake: Optional[asyncio.Event] = None
+        self._runner: Optional[asyncio.Task] = None
+        self._tasks: Set[asyncio.Task] = set()
+        self._stopping = False
+        self.owner = debounce_scheduler.owner
+        self.claimed = 0
+        self.completed = 0
+        self.retried = 0
+        self.dead = 0
+
+    # ── Lifecycle ────────────────────────────────────────────────
+
+    def start(self, loop: asyncio.AbstractEventLoop) -> None:
+        self._loop = loop
+        self._wake = asyncio.Event()
+        self._stopping = False
+        self._runner = loop.create_task(self._run())
+        print(
+            "[jobs] worker started",
+            {"owner": self.owner, "concurrency": settings.chat_jobs_concurrency},
+        )
+
+    async def stop(self) -> None:
+        self._stopping = True
+        if self._wake:
+            self._wake.set()
+        if self._runner:
+            await asyncio.gather(self._runner, return_exceptions=True)
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._loop = None
+        self._runner = None
+
+    @property
+    def running(self) -> bool:
+        return self._runner is not None and not self._runner.done()
+
+    def wake(self) -> None:
+        """Skip the poll interval (thread-safe)."""
+        if self._loop is not None and self._wake is not None:
+            self._loop.call_soon_threadsafe(self._wake.set)
+
+    # ── Queue operations ─────────────────────────────────────────
+
+    async def enqueue(self, chat_id: str, quiet_ms: int = 0) -> Dict[str, Any]:
+        result = await _jobs_rpc(
+            "enqueue_chat_job",
+            {
+                "p_chat_id": chat_id,
+                "p_quiet_ms": quiet_ms,
+                "p_max_attempts": settings.chat_jobs_max_attempts,
+            },
+        ) or {}
+        if result.get("status") == "queued":
+            self.wake()
+        return result
+
+    async def _claim(self, limit: int) -> List[Dict[str, Any]]:
+        jobs = await _jobs_rpc(
+            "claim_chat_jobs",
+            {
+                "p_owner": self.owner,
+                "p_limit": limit,
+                "p_lease_seconds": settings.chat_jobs_lease_seconds,
+            },
+        )
+        return jobs or []
+
+    # ── Worker loop ──────────────────────────────────────────────
+
+    async def _run(self) -> None:
+        while not self._stopping:
+            free = settings.chat_jobs_concurrency - len(self._tasks)
+            jobs: List[Dict[str, Any]] = []
+            if free > 0:
+                try:
+                    jobs = await self._claim(free)
+                except Exception as exc:
+                    print("[jobs] claim error", {"error": str(exc)})
+
+            for job in jobs:
+                self.claimed += 1
+                task = asyncio.create_task(self._run_job(job))
+                self._tasks.add(task)
+                task.add_done_callback(self._job_done)
+
+            # A full batch may mean more jobs are waiting; otherwise sleep
+            # until the next poll or until a job is enqueued/finished.
+            if jobs and len(jobs) == free:
+                continue
+            try:
+                await asyncio.wait_for(
+                    self._wake.wait(), timeout=settings.chat_jobs_poll_seconds
+                )
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+    def _job_done(self, task: asyncio.Task) -> None:
+        self._tasks.discard(task)
+        if self._wake is not None:
+            self._wake.set()
+
+    async def _heartbeat(self, job_id: int) -> None:
+        interval = max(settings.chat_jobs_lease_seconds / 3, 1)
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                kept = await _jobs_rpc(
+                    "extend_chat_job_lease",
+                    {
+                        "p_job_id": job_id,
+                        "p_owner": self.owner,
+                        "p_lease_seconds": settings.chat_jobs_lease_seconds,
+                    },
+                )
+            except Exception as exc:
+                print("[jobs] heartbeat error", {"job_id": job_id, "error": str(exc)})
+                continue
+            if not kept:
+                print("[jobs] lease lost", {"job_id": job_id})
+                return
+
+    async def _run_job(self, job: Dict[str, Any]) -> None:
+        from app.whatsapp.process_router import ProcessQueueRequest, run_process_queue
+
+        job_id = job.get("id")
+        chat_id = job.get("chat_id")
+        final_message = job.get("combined_text") or ""
+        print(
+            "[jobs] running",
+            {"job_id": job_id, "chat_id": chat_id, "attempt": job.get("attempts")},
+        )
+
+        heartbeat = asyncio.create_task(self._heartbeat(job_id))
+        error: Optional[str] = None
+        try:
+            if final_message:
+                result = await run_process_queue(
+                    ProcessQueueRequest(
+                        chat_id=chat_id,
+                        final_message=final_message,
+                        batch_id=job.get("last_added_at"),
+                    )
+                )
+                if not isinstance(result, dict) or result.get("status") not in {"sent", "skipped"}:
+                    error = str((result or {}).get("error") or (result or {}).get("status"))
+        except Exception as exc:
+            error = str(exc)
+        finally:
+            heartbeat.cancel()
+
+        try:
+            if error is None:
+                outcome = await _jobs_rpc(
+                    "complete_chat_job",
+                    {
+                        "p_job_id": job_id,
+                        "p_owner": self.owner,
+                        "p_processed_text": final_message,
+                    },
+                ) or {}
+                self.completed += 1
+                if outcome.get("status") == "requeued":
+                    debounce_scheduler.schedule(chat_id, outcome.get("combined_text"))
+            else:
+                outcome = await _jobs_rpc(
+                    "fail_chat_job",
+                    {
+                        "p_job_id": job_id,
+                        "p_owner": self.owner,
+                        "p_error": error[:1000],
+                        "p_backoff_seconds": settings.chat_jobs_backoff_seconds,
+                    },
+                ) or {}
+                if outcome.get("status") == "dead":
+                    self.dead += 1
+                else:
+                    self.retried += 1
+        except Exception as exc:
+            # The lease expires and the job is claimed again.
+            print("[jobs] finalize error", {"job_id": job_id, "error": str(exc)})
+            return
+
+        print(
+            "[jobs] finished",
+            {"job_id": job_id, "chat_id": chat_id, "outcome": outcome.get("status"), "error": error},
+        )
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": settings.chat_jobs_enabled,
+            "running": self.running,
+            "owner": self.owner,
+            "in_flight": len(self._tasks),
+            "concurrency": settings.chat_jobs_concurrency,
+            "claimed": self.claimed,
+            "completed": self.completed,
+            "retried": self.retried,
+            "dead": self.dead,
+        }
+
+
+chat_job_worker = ChatJobWorker()
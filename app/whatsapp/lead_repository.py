@@ -0,0 +1,219 @@
+"""
+Per-turn repository of a chat's leads and their scheduled appointments.
+
+Within one turn the same lead rows used to be fetched again by almost every
+helper (``_get_lead_by_chat`` in the turn setup, slot search, booking,
+event registration, lead status...), each repeating the
+``wa_chat_id`` → ``wa_id`` fallback.  The repository is seeded from the
+``get_turn_context`` bootstrap, attached as ``chat["_lead_repo"]`` and
+serves all of them; ``get_leads_by_chat(..., chat=chat)`` goes through it.
+
+Writes to leads or appointments (lead create/update, notes, bookings,
+cancellations) invalidate it, and the next read reloads leads and
+appointments with two queries.  Cross-turn caching is not needed: every
+turn's bootstrap already returns the leads in the same round-trip as the
+chat and session.
+"""
+
+import functools
+import threading
+from typing import Any, Callable, Dict, List, Optional, TypeVar
+
+from app.core.supabase import get_supabase_client, get_supabase_data
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+# Same columns as the leads returned by get_turn_context
+LEAD_FIELDS = (
+    "id, lead_number, status, metadata, notes, contact_id, "
+    "student_first_name, student_middle_name, "
+    "student_last_name_paternal, student_last_name_maternal, "
+    "student_dob, grade_interest, current_school, "
+    "contact_name, contact_email, contact_phone, created_at"
+)
+APPOINTMENT_FIELDS = "id, lead_id, slot_id, starts_at, ends_at, status, created_at"
+
+
+class LeadRepositoryTotals:
+    """Process-wide counters, exposed at ``/api/whatsapp/admin/leads/stats``."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.turns = 0
+        self.queries = 0
+        self.avoided = 0
+        self.invalidations = 0
+
+    def add(
+        self,
+        turns: int = 0,
+        queries: int = 0,
+        avoided: int = 0,
+        invalidations: int = 0,
+    ) -> None:
+        with self._lock:
+            self.turns += turns
+            self.queries += queries
+            self.avoided += avoided
+            self.invalidations += invalidations
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "turns": self.turns,
+                "queries": self.queries,
+                "queries_avoided": self.avoided,
+                "invalidations": self.invalidations,
+            }
+
+
+lead_repository_totals = LeadRepositoryTotals()
+
+
+class LeadRepository:
+    def __init__(
+        self,
+        org_id: str,
+        chat_id: str,
+        wa_id: Optional[str] = None,
+        leads: Optional[List[Dict[str, Any]]] = None,
+        appointments: Optional[List[Dict[str, Any]]] = None,
+    ) -> None:
+        self.org_id = org_id
+        self.chat_id = chat_id
+        self.wa_id = wa_id
+        # Tool calls of one response may run on several threads.
+        self._lock = threading.Lock()
+        self._leads = leads
+        self._appointments = appointments if leads is not None else None
+        self.queries = 0
+        self.avoided = 0
+        self.invalidations = 0
+        lead_repository_totals.add(turns=1)
+
+    @classmethod
+    def from_turn_context(cls, ctx: Any) -> "LeadRepository":
+        return cls(
+            org_id=ctx.org.get("id"),
+            chat_id=ctx.chat.get("id"),
+            wa_id=ctx.chat.get("wa_id"),
+            leads=list(ctx.leads),
+            appointments=list(ctx.appointments),
+        )
+
+    # ── Reads ────────────────────────────────────────────────────
+
+    def leads(self, supabase: Any = None) -> List[Dict[str, Any]]:
+        """All leads of the chat, newest first."""
+        with self._lock:
+            self._ensure_loaded(supabase)
+            return list(self._leads)
+
+    def lead(self, supabase: Any = None) -> Optional[Dict[str, Any]]:
+        """The most recent (primary) lead."""
+        leads = self.leads(supabase)
+        return leads[0] if leads else None
+
+    def appointments(self, supabase: Any = None) -> List[Dict[str, Any]]:
+        """Scheduled appointments of the chat's leads, newest first."""
+        with self._lock:
+            self._ensure_loaded(supabase)
+            return list(self._appointments)
+
+    def appointments_by_lead(self, supabase: Any = None) -> Dict[str, Dict[str, Any]]:
+        """Latest scheduled appointment per lead id."""
+        appt_map: Dict[str, Dict[str, Any]] = {}
+        for appt in self.appointments(supabase):
+            appt_map.setdefault(appt.get("lead_id"), appt)
+        return appt_map
+
+    def _ensure_loaded(self, supabase: Any) -> None:
+        if self._leads is not None:
+            self.avoided += 1
+            lead_repository_totals.add(avoided=1)
+            return
+        supabase = supabase or get_supabase_client()
+        queries = 0
+        leads: List[Dict[str, Any]] = []
+        for column, value in (("wa_chat_id", self.chat_id), ("wa_id", self.wa_id)):
+            if not value:
+                continue
+            response = (
+                supabase.from_("leads")
+                .select(LEAD_FIELDS)
+                .eq("organization_id", self.org_id)
+                .eq(column, value)
+                .order("created_at", desc=True)
+                .execute()
+            )
+            queries += 1
+            leads = get_supabase_data(response) or []
+            if leads:
+                break
+
+        appointments: List[Dict[str, Any]] = []
+        lead_ids = [lead.get("id") for lead in leads if lead.get("id")]
+        if lead_ids:
+            response = (
+                supabase.from_("appointments")
+                .select(APPOINTMENT_FIELDS)
+                .in_("lead_id", lead_ids)
+                .eq("status", "scheduled")
+                .order("created_at", desc=True)
+                .execute()
+            )
+            queries += 1
+            appointments = get_supabase_data(response) or []
+
+        self._leads = leads
+        self._appointments = appointments
+        self.queries += queries
+        lead_repository_totals.add(queries=queries)
+
+    # ── Invalidation ─────────────────────────────────────────────
+
+    def invalidate(self) -> None:
+        with self._lock:
+            if self._leads is None:
+                return
+            self._leads = None
+            self._appointments = None
+            self.invalidations += 1
+        lead_repository_totals.add(invalidations=1)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "queries": self.queries,
+            "queries_avoided": self.avoided,
+            "invalidations": self.invalidations,
+        }
+
+
+def get_lead_repository(chat: Optional[Dict[str, Any]]) -> Optional[LeadRepository]:
+    return chat.get("_lead_repo") if chat else None
+
+
+def attach_lead_repository(ctx: Any) -> LeadRepository:
+    """Seed the repository from the turn bootstrap and attach it to the chat."""
+    repo = LeadRepository.from_turn_context(ctx)
+    ctx.chat["_lead_repo"] = repo
+    return repo
+
+
+def invalidate_chat_leads(chat: Optional[Dict[str, Any]]) -> None:
+    repo = get_lead_repository(chat)
+    if repo is not None:
+        repo.invalidate()
+
+
+def invalidates_leads(func: F) -> F:
+    """Invalidate the chat's lead repository after *func* (called with ``chat=``)."""
+
+    @functools.wraps(func)
+    def wrapper(*args: Any, **kwargs: Any) -> Any:
+        try:
+            return func(*args, **kwargs)
+        finally:
+            invalidate_chat_leads(kwargs.get("chat"))
+
+    return wrapper  # type: ignore[return-value]
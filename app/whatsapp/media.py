@@ -3,6 +3,7 @@ from typing import Optional, Tuple
 import httpx
 
 from app.core.config import settings
+from app.whatsapp.graph_client import graph_request
 
 
 class MediaDownloadError(Exception):
@@ -17,9 +18,9 @@ def download_whatsapp_media(
 
     headers = {"Authorization": f"Bearer {settings.whatsapp_access_token}"}
 
-    with httpx.Client(timeout=30) as client:
-        meta_response = client.get(
-            f"https://graph.facebook.com/v21.0/{media_id}", headers=headers
+    try:
+        meta_response = graph_request(
+            "GET", media_id, operation="media_metadata", headers=headers
         )
         if not meta_response.is_success:
             raise MediaDownloadError("Failed to fetch media metadata")
@@ -30,8 +31,12 @@ def download_whatsapp_media(
         if not url:
             raise MediaDownloadError("Missing media URL")
 
-        media_response = client.get(url, headers=headers)
+        media_response = graph_request(
+            "GET", url, operation="media_download", headers=headers
+        )
         if not media_response.is_success:
             raise MediaDownloadError("Failed to download media file")
+    except httpx.HTTPError as exc:
+        raise MediaDownloadError(f"Media request failed: {exc}") from exc
 
-        return media_response.content, mime_type
+    return media_response.content, mime_type
@@ -0,0 +1,213 @@
+"""
+WhatsApp media ids for documents kept in Supabase Storage.
+
+Requirement and event PDFs used to be downloaded from Storage, base64
+encoded and uploaded to the Graph API on every send.  Uploaded media stays
+usable for weeks, so ``whatsapp_media_cache`` keeps the media id per
+(phone_number_id, storage bucket, path, content hash).  The content hash is
+the Storage object's ETag, read with a metadata-only request, so a replaced
+document gets a new row and a new upload.  Rows expire after
+``WHATSAPP_MEDIA_CACHE_DAYS``; a cached id that Graph rejects as invalid or
+expired is dropped and the document is uploaded once more.  Any other send
+error is returned as is: after a timeout or 5xx the document may already
+have been delivered.
+"""
+
+import base64
+from datetime import datetime, timedelta
+from typing import Any, Optional, Tuple
+
+from app.core.config import settings
+from app.core.supabase import get_supabase_data, get_supabase_error
+from app.whatsapp.outbound import (
+    SendWhatsAppDocumentParams,
+    UploadWhatsAppMediaParams,
+    WhatsAppResponse,
+    send_whatsapp_document,
+    upload_whatsapp_media,
+)
+
+CACHE_TABLE = "whatsapp_media_cache"
+# Graph errors for a media id it does not accept: 100 (invalid parameter,
+# unknown id) and 131053 (media could not be fetched, e.g. expired).  Both
+# are rejections, so nothing was delivered and a resend is safe.
+STALE_MEDIA_ERROR_CODES = {100, 131053}
+
+
+def _enabled() -> bool:
+    return settings.whatsapp_media_cache_days > 0 and not settings.whatsapp_dry_run
+
+
+def _content_hash(supabase: Any, bucket: str, path: str) -> Optional[str]:
+    """ETag of the Storage object (changes with its content), or None."""
+    try:
+        info = supabase.storage.from_(bucket).info(path) or {}
+    except Exception as exc:
+        print("[media-cache] storage info failed", {"bucket": bucket, "path": path, "error": str(exc)})
+        return None
+    etag = info.get("etag") or info.get("eTag") or (info.get("metadata") or {}).get("eTag")
+    if etag:
+        return str(etag).strip('"')
+    version = info.get("version")
+    return f"version:{version}" if version else None
+
+
+def _cache_key(phone_number_id: str, bucket: str, path: str, content_hash: str) -> dict:
+    return {
+        "phone_number_id": phone_number_id,
+        "storage_bucket": bucket,
+        "file_path": path,
+        "content_hash": content_hash,
+    }
+
+
+def _lookup(supabase: Any, key: dict) -> Optional[str]:
+    try:
+        query = supabase.from_(CACHE_TABLE).select("media_id")
+        for column, value in key.items():
+            query = query.eq(column, value)
+        response = (
+            query.gt("expires_at", datetime.utcnow().isoformat())
+            .limit(1)
+            .execute()
+        )
+    except Exception as exc:
+        print("[media-cache] lookup failed", {"error": str(exc)})
+        return None
+    rows = get_supabase_data(response) or []
+    return rows[0].get("media_id") if rows else None
+
+
+def _store(supabase: Any, key: dict, media_id: str, mime_type: str) -> None:
+    expires_at = datetime.utcnow() + timedelta(days=settings.whatsapp_media_cache_days)
+    try:
+        response = (
+            supabase.from_(CACHE_TABLE)
+            .upsert(
+                {
+                    **key,
+                    "media_id": media_id,
+                    "mime_type": mime_type,
+                    "expires_at": expires_at.isoformat(),
+                    "created_at": datetime.utcnow().isoformat(),
+                },
+                on_conflict="phone_number_id,storage_bucket,file_path,content_hash",
+            )
+            .execute()
+        )
+    except Exception as exc:
+        print("[media-cache] store failed", {"error": str(exc)})
+        return
+    error = get_supabase_error(response)
+    if error:
+        print("[media-cache] store failed", {"error": str(error)})
+
+
+def _forget(supabase: Any, key: dict) -> None:
+    try:
+        query = supabase.from_(CACHE_TABLE).delete()
+        for column, value in key.items():
+            query = query.eq(column, value)
+        query.execute()
+    except Exception as exc:
+        print("[media-cache] delete failed", {"error": str(exc)})
+
+
+def _upload(
+    supabase: Any,
+    phone_number_id: str,
+    bucket: str,
+    path: str,
+    mime_type: str,
+    file_name: str,
+) -> WhatsAppResponse:
+    try:
+        file_bytes = supabase.storage.from_(bucket).download(path)
+    except Exception as exc:
+        print(f"[admissions] storage download error: {exc}")
+        return WhatsAppResponse(error=f"storage download failed: {exc}")
+    return upload_whatsapp_media(
+        UploadWhatsAppMediaParams(
+            phone_number_id=phone_number_id,
+            media_base64=base64.b64encode(file_bytes).decode("utf-8"),
+            mime_type=mime_type,
+            file_name=file_name,
+        )
+    )
+
+
+def get_storage_media_id(
+    supabase: Any,
+    phone_number_id: str,
+    bucket: str,
+    path: str,
+    mime_type: str,
+    file_name: str,
+    refresh: bool = False,
+) -> Tuple[WhatsAppResponse, bool]:
+    """Media id for a Storage document, uploading it only when needed.
+
+    Returns the upload response (``media_id`` or ``error``) and whether the
+    id came from the cache.
+    """
+    key = None
+    if _enabled():
+        content_hash = _content_hash(supabase, bucket, path)
+        if content_hash:
+            key = _cache_key(phone_number_id, bucket, path, content_hash)
+            if refresh:
+                _forget(supabase, key)
+            else:
+                media_id = _lookup(supabase, key)
+                if media_id:
+                    return WhatsAppResponse(media_id=media_id), True
+
+    upload_result = _upload(supabase, phone_number_id, bucket, path, mime_type, file_name)
+    if key is not None and upload_result.media_id and not upload_result.error:
+        _store(supabase, key, upload_result.media_id, mime_type)
+    return upload_result, False
+
+
+def send_storage_document(
+    supabase: Any,
+    phone_number_id: str,
+    to: str,
+    bucket: str,
+    path: str,
+    mime_type: str,
+    file_name: str,
+    caption: Optional[str] = None,
+) -> Tuple[WhatsAppResponse, WhatsAppResponse]:
+    """Send a Storage document as a WhatsApp document message.
+
+    Returns ``(upload_result, send_result)``; when the upload fails the
+    send result is empty.  With a warm cache this is a single Graph call.
+    """
+    upload_result, cached = get_storage_media_id(
+        supabase, phone_number_id, bucket, path, mime_type, file_name
+    )
+    if upload_result.error or not upload_result.media_id:
+        return upload_result, WhatsAppResponse()
+
+    def _send(media_id: str) -> WhatsAppResponse:
+        return send_whatsapp_document(
+            SendWhatsAppDocumentParams(
+                phone_number_id=phone_number_id,
+                to=to,
+                media_id=media_id,
+                file_name=file_name,
+                caption=caption,
+            )
+        )
+
+    send_result = _send(upload_result.media_id)
+    if cached and send_result.error_code in STALE_MEDIA_ERROR_CODES:
+        # The cached id may have expired on Meta's side before our TTL.
+        print("[media-cache] cached media rejected, uploading again", {"path": path})
+        upload_result, _cached = get_storage_media_id(
+            supabase, phone_number_id, bucket, path, mime_type, file_name, refresh=True
+        )
+        if upload_result.error or not upload_result.media_id:
+            return upload_result, WhatsAppResponse()
+        send_result = _send(upload_result.media_id)
+    return upload_result, send_result
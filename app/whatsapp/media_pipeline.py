@@ -0,0 +1,404 @@
+"""
+Background stage that copies inbound WhatsApp media into Supabase Storage.
+
+Webhook ingest used to download every image, document or voice note and
+upload it to Storage before moving on to the next message, so one large
+PDF delayed the whole webhook.  Messages are now stored right away (the
+insert trigger sets ``media_status = 'pending'``) and the transfer is handed
+to this pipeline.  The file is streamed from the Graph CDN chunk by chunk
+(spooled to a temporary file above ``SPOOL_MAX_BYTES``, never held in memory
+as a whole) while its SHA-256 is computed.
+
+Storage is content-addressed: objects live at ``sha256/<ab>/<hash>``
+and ``whatsapp_media_objects`` maps hash → path.  When a parent forwards a
+document that is already stored, the upload is skipped and the message
+points at the shared object.  New objects are streamed from the spool into
+the Storage REST API.  The message row is then patched with
+``media_path``/``media_url``/``media_sha256`` and ``media_status = 'ready'``
+(or ``'failed'``).
+
+At most ``MEDIA_PIPELINE_CONCURRENCY`` transfers run at a time per process;
+``0`` keeps the old inline download.  Transfers cut short by a restart
+leave the message ``pending``; a sweep at startup and every
+``SWEEP_SECONDS`` submits such messages again.  Shutdown waits at most
+``STOP_TIMEOUT_SECONDS`` for in-flight transfers and cancels the rest.
+"""
+
+import asyncio
+import hashlib
+import tempfile
+import time
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Any, AsyncIterator, Dict, Optional, Set
+
+import httpx
+
+from app.core.config import settings
+from app.core.supabase import (
+    get_async_supabase_client,
+    get_supabase_data,
+    get_supabase_error,
+)
+from app.whatsapp.graph_client import (
+    get_async_graph_client,
+    graph_metrics,
+    graph_request_async,
+)
+from app.whatsapp.storage import (
+    MEDIA_OBJECTS_TABLE,
+    content_addressed_path,
+    get_public_media_url,
+    is_duplicate_object_error,
+    media_object_row,
+    storage_headers,
+    storage_object_url,
+)
+
+CHUNK_SIZE = 64 * 1024
+# Downloads larger than this are spooled to a temporary file, not memory.
+SPOOL_MAX_BYTES = 1024 * 1024
+STOP_TIMEOUT_SECONDS = 10.0
+SWEEP_SECONDS = 60.0
+# Pending this long means the transfer was lost (no live transfer is older).
+SWEEP_STALE_SECONDS = 300
+# Older pending media is left alone.
+SWEEP_MAX_AGE_SECONDS = 24 * 3600
+SWEEP_BATCH = 50
+
+
+class MediaTransferError(Exception):
+    pass
+
+
+@dataclass
+class MediaTransfer:
+    message_id: str
+    chat_id: str
+    media_id: str
+    file_name: Optional[str] = None
+    mime_type: Optional[str] = None
+
+
+@dataclass
+class _StoredMedia:
+    path: str
+    sha256: str
+    size: int
+    deduplicated: bool = False
+
+
+def _iso(epoch: float) -> str:
+    return datetime.fromtimestamp(epoch, tz=timezone.utc).isoformat()
+
+
+def _graph_headers() -> Dict[str, str]:
+    if not settings.whatsapp_access_token:
+        raise MediaTransferError("WHATSAPP_ACCESS_TOKEN is not set")
+    return {"Authorization": f"Bearer {settings.whatsapp_access_token}"}
+
+
+class MediaPipeline:
+    def __init__(self) -> None:
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._tasks: Set[asyncio.Task] = set()
+        self._active: Set[str] = set()
+        self._sweeper: Optional[asyncio.Task] = None
+        self._storage_client: Optional[httpx.AsyncClient] = None
+        self.queued = 0
+        self.swept = 0
+        self.stored = 0
+        self.failed = 0
+        self.deduplicated = 0
+        self.bytes = 0
+        self.uploaded_bytes = 0
+
+    # ── Lifecycle ────────────────────────────────────────────────
+
+    def start(self, loop: asyncio.AbstractEventLoop) -> None:
+        self._loop = loop
+        self._slots = asyncio.Semaphore(max(settings.media_pipeline_concurrency, 1))
+        if settings.media_pipeline_concurrency > 0:
+            self._sweeper = loop.create_task(self._sweep_loop())
+        print(
+            "[media] pipeline started",
+            {"concurrency": settings.media_pipeline_concurrency},
+        )
+
+    async def stop(self) -> None:
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            await asyncio.gather(self._sweeper, return_exceptions=True)
+            self._sweeper = None
+        if self._tasks:
+            _done, unfinished = await asyncio.wait(
+                set(self._tasks), timeout=STOP_TIMEOUT_SECONDS
+            )
+            # Cancelled messages stay pending and are swept on the next start.
+            for task in unfinished:
+                task.cancel()
+            await asyncio.gather(*unfinished, return_exceptions=True)
+        if self._storage_client is not None:
+            await self._storage_client.aclose()
+            self._storage_client = None
+        self._loop = None
+
+    @property
+    def running(self) -> bool:
+        return (
+            settings.media_pipeline_concurrency > 0
+            and self._loop is not None
+            and not self._loop.is_closed()
+        )
+
+    # ── Submission ───────────────────────────────────────────────
+
+    def submit(self, transfer: MediaTransfer) -> bool:
+        """Queue a transfer; safe from any thread.
+
+        Returns False when the pipeline is not running (disabled, scripts),
+        so the caller can store the media inline.
+        """
+        if not self.running:
+            return False
+        self.queued += 1
+        self._loop.call_soon_threadsafe(self._spawn, transfer)
+        return True
+
+    def _spawn(self, transfer: MediaTransfer) -> None:
+        if transfer.message_id in self._active:
+            return
+        self._active.add(transfer.message_id)
+        task = self._loop.create_task(self._run(transfer))
+        self._tasks.add(task)
+
+        def _done(task: asyncio.Task) -> None:
+            self._tasks.discard(task)
+            self._active.discard(transfer.message_id)
+
+        task.add_done_callback(_done)
+
+    # ── Sweep ────────────────────────────────────────────────────
+
+    async def _sweep_loop(self) -> None:
+        while True:
+            try:
+                await self.sweep()
+            except Exception as exc:
+                print("[media] sweep error", {"error": str(exc)})
+            await asyncio.sleep(SWEEP_SECONDS)
+
+    async def sweep(self) -> int:
+        """Submit again the transfers of messages stuck in ``pending``."""
+        now = time.time()
+        supabase = await get_async_supabase_client()
+        response = await (
+            supabase.from_("messages")
+            .select("id, chat_id, media_id, media_mime_type, file_name:payload->>media_file_name")
+            .eq("media_status", "pending")
+            .lt("created_at", _iso(now - SWEEP_STALE_SECONDS))
+            .gt("created_at", _iso(now - SWEEP_MAX_AGE_SECONDS))
+            .order("created_at")
+            .limit(SWEEP_BATCH)
+            .execute()
+        )
+        error = get_supabase_error(response)
+        if error:
+            raise RuntimeError(f"pending media lookup failed: {error}")
+
+        swept = 0
+        for row in get_supabase_data(response) or []:
+            if not row.get("media_id") or row.get("id") in self._active:
+                continue
+            swept += 1
+            self._spawn(
+                MediaTransfer(
+                    message_id=row["id"],
+                    chat_id=row.get("chat_id"),
+                    media_id=row["media_id"],
+                    file_name=row.get("file_name"),
+                    mime_type=row.get("media_mime_type"),
+                )
+            )
+        if swept:
+            self.swept += swept
+            print("[media] re-submitted pending transfers", {"messages": swept})
+        return swept
+
+    # ── Transfer ─────────────────────────────────────────────────
+
+    async def _run(self, transfer: MediaTransfer) -> None:
+        async with self._slots:
+            started = time.perf_counter()
+            try:
+                result = await self._transfer(transfer)
+                media_url = get_public_media_url(result.path) or result.path
+            except Exception as exc:
+                self.failed += 1
+                print(
+                    "[media] transfer failed",
+                    {"message_id": transfer.message_id, "media_id": transfer.media_id, "error": str(exc)},
+                )
+                await self._patch(transfer.message_id, {"media_status": "failed"})
+                return
+
+            self.stored += 1
+            self.bytes += result.size
+            if result.deduplicated:
+                self.deduplicated += 1
+            else:
+                self.uploaded_bytes += result.size
+            await self._patch(
+                transfer.message_id,
+                {
+                    "media_path": result.path,
+                    "media_url": media_url,
+                    "media_sha256": result.sha256,
+                    "media_status": "ready",
+                },
+            )
+            print(
+                "[media] stored",
+                {
+                    "message_id": transfer.message_id,
+                    "bytes": result.size,
+                    "deduplicated": result.deduplicated,
+                    "elapsed_ms": round((time.perf_counter() - started) * 1000),
+                },
+            )
+
+    async def _transfer(self, transfer: MediaTransfer) -> "_StoredMedia":
+        headers = _graph_headers()
+        meta_response = await graph_request_async(
+            "GET", transfer.media_id, operation="media_metadata", headers=headers
+        )
+        if not meta_response.is_success:
+            raise MediaTransferError("Failed to fetch media metadata")
+        meta = meta_response.json()
+        url = meta.get("url")
+        if not url:
+            raise MediaTransferError("Missing media URL")
+        mime_type = meta.get("mime_type") or transfer.mime_type
+
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES) as spool:
+            digest = hashlib.sha256()
+            size = 0
+            started = time.perf_counter()
+            ok = False
+            try:
+                async with get_async_graph_client().stream("GET", url, headers=headers) as download:
+                    if not download.is_success:
+                        raise MediaTransferError(
+                            f"Failed to download media file ({download.status_code})"
+                        )
+                    async for chunk in download.aiter_bytes(CHUNK_SIZE):
+                        digest.update(chunk)
+                        spool.write(chunk)
+                        size += len(chunk)
+                ok = True
+            finally:
+                graph_metrics.record(
+                    "media_download", (time.perf_counter() - started) * 1000, ok=ok
+                )
+
+            sha256 = digest.hexdigest()
+            existing = await self._find_object(sha256)
+            if existing:
+                return _StoredMedia(existing, sha256, size, deduplicated=True)
+
+            path = content_addressed_path(sha256, mime_type, transfer.file_name)
+            spool.seek(0)
+
+            async def _chunks() -> AsyncIterator[bytes]:
+                while True:
+                    chunk = spool.read(CHUNK_SIZE)
+                    if not chunk:
+                        return
+                    yield chunk
+
+            upload_headers = storage_headers(mime_type)
+            upload_headers["Content-Length"] = str(size)
+            upload = await self._storage().post(
+                storage_object_url(path),
+                headers=upload_headers,
+                content=_chunks(),
+            )
+
+        # The same content may have been stored concurrently.
+        if not upload.is_success and not is_duplicate_object_error(upload):
+            raise MediaTransferError(
+                f"Storage upload failed ({upload.status_code}): {upload.text[:200]}"
+            )
+        await self._register_object(media_object_row(sha256, path, size, mime_type))
+        return _StoredMedia(path, sha256, size, deduplicated=False)
+
+    async def _find_object(self, sha256: str) -> Optional[str]:
+        try:
+            supabase = await get_async_supabase_client()
+            response = await (
+                supabase.from_(MEDIA_OBJECTS_TABLE)
+                .select("storage_path")
+                .eq("sha256", sha256)
+                .eq("storage_bucket", settings.supabase_storage_bucket)
+                .limit(1)
+                .execute()
+            )
+        except Exception as exc:
+            # Upload instead; a duplicate object is recognised by Storage.
+            print("[media] object lookup failed", {"sha256": sha256, "error": str(exc)})
+            return None
+        rows = get_supabase_data(response) or []
+        return rows[0].get("storage_path") if rows else None
+
+    async def _register_object(self, row: Dict[str, Any]) -> None:
+        try:
+            supabase = await get_async_supabase_client()
+            response = await (
+                supabase.from_(MEDIA_OBJECTS_TABLE)
+                .upsert(row, on_conflict="sha256", ignore_duplicates=True)
+                .execute()
+            )
+        except Exception as exc:
+            error: Any = exc
+        else:
+            error = get_supabase_error(response)
+        if error:
+            print("[media] object index update failed", {"sha256": row.get("sha256"), "error": str(error)})
+
+    def _storage(self) -> httpx.AsyncClient:
+        if self._storage_client is None or self._storage_client.is_closed:
+            self._storage_client = httpx.AsyncClient(
+                timeout=httpx.Timeout(120.0, connect=5.0)
+            )
+        return self._storage_client
+
+    async def _patch(self, message_id: str, fields: Dict[str, Any]) -> None:
+        try:
+            supabase = await get_async_supabase_client()
+            response = await (
+                supabase.from_("messages").update(fields).eq("id", message_id).execute()
+            )
+        except Exception as exc:
+            print("[media] message update failed", {"message_id": message_id, "error": str(exc)})
+            return
+        error = get_supabase_error(response)
+        if error:
+            print("[media] message update failed", {"message_id": message_id, "error": str(error)})
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "running": self.running,
+            "concurrency": settings.media_pipeline_concurrency,
+            "in_flight": len(self._tasks),
+            "queued": self.queued,
+            "stored": self.stored,
+            "failed": self.failed,
+            "deduplicated": self.deduplicated,
+            "swept": self.swept,
+            "bytes": self.bytes,
+            "uploaded_bytes": self.uploaded_bytes,
+        }
+
+
+media_pipeline = MediaPipeline()
@@ -0,0 +1,114 @@
+"""
+In-process cache for organization bot configuration.
+
+``organizations`` rows change very rarely but were read on every webhook
+(by ``phone_number_id``).  Entries live in a TTL+LRU map; turns load the
+organization through the turn-context RPC anyway and ``prime`` the cache
+with that fresher row.  Entries can be dropped explicitly via the admin
+endpoint (``/api/whatsapp/admin/org-cache/invalidate``) after an
+organization is edited.
+"""
+
+import threading
+from typing import Any, Dict, Optional
+
+from cachetools import TTLCache
+
+from app.core.config import settings
+from app.core.supabase import (
+    get_supabase_client,
+    get_supabase_data,
+    get_supabase_error,
+)
+
+ORG_CONFIG_FIELDS = (
+    "id, name, bot_name, bot_instructions, bot_tone, bot_language, bot_model, phone_number_id"
+)
+
+
+class OrgConfigCache:
+    def __init__(self, maxsize: int, ttl: float) -> None:
+        self._by_phone: TTLCache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    # ── Lookups ──────────────────────────────────────────────────
+
+    def get_by_phone_number_id(self, phone_number_id: Optional[str]) -> Optional[Dict[str, Any]]:
+        if not phone_number_id:
+            return None
+        with self._lock:
+            org = self._by_phone.get(phone_number_id)
+            if org is not None:
+                self.hits += 1
+                return org
+            self.misses += 1
+
+        supabase = get_supabase_client()
+        response = (
+            supabase.from_("organizations")
+            .select(ORG_CONFIG_FIELDS)
+            .eq("phone_number_id", phone_number_id)
+            .limit(1)
+            .execute()
+        )
+        if get_supabase_error(response):
+            return None
+        rows = get_supabase_data(response) or []
+        org = rows[0] if rows else None
+        if org:
+            self.prime(org)
+        return org
+
+    # ── Maintenance ──────────────────────────────────────────────
+
+    def prime(self, org: Dict[str, Any]) -> None:
+        """Store an organization row that was loaded elsewhere."""
+        if not org or not org.get("phone_number_id"):
+            return
+        with self._lock:
+            self._by_phone[org["phone_number_id"]] = org
+
+    def invalidate(
+        self,
+        org_id: Optional[str] = None,
+        phone_number_id: Optional[str] = None,
+    ) -> int:
+        """Drop matching entries (everything when no key is given)."""
+        with self._lock:
+            if not org_id and not phone_number_id:
+                removed = len(self._by_phone)
+                self._by_phone.clear()
+            else:
+                removed = 0
+                for key, org in list(self._by_phone.items()):
+                    if key == phone_number_id or (org_id and org.get("id") == org_id):
+                        self._by_phone.pop(key, None)
+                        removed += 1
+            self.invalidations += 1
+        print(
+            "[org_cache] invalidated",
+            {"org_id": org_id, "phone_number_id": phone_number_id, "removed": removed},
+        )
+        return removed
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / total, 4) if total else None,
+                "invalidations": self.invalidations,
+                "entries_by_phone_number_id": len(self._by_phone),
+                "ttl_seconds": self._by_phone.ttl,
+                "maxsize": self._by_phone.maxsize,
+            }
+
+
+org_cache = OrgConfigCache(
+    maxsize=settings.org_cache_max_size,
+    ttl=settings.org_cache_ttl_seconds,
+)
@@ -1,14 +1,17 @@
 import base64
 import time
-from typing import Optional
+from typing import Any, Dict, Optional
 
-import httpx
 from fastapi import HTTPException
 from pydantic import BaseModel
 
 from app.core.config import settings
-
-API_VERSION = "v21.0"
+from app.whatsapp.graph_client import (
+    API_VERSION,
+    graph_error_message,
+    graph_request,
+    graph_request_async,
+)
 
 
 def _normalize_recipient(to: str) -> str:
@@ -77,44 +80,107 @@ class WhatsAppResponse(BaseModel):
     message_id: Optional[str] = None
     media_id: Optional[str] = None
     error: Optional[str] = None
+    # Graph API error code (``error.code``) when the request was rejected
+    error_code: Optional[int] = None
 
 
-def send_whatsapp_text(
-    params: SendWhatsAppTextParams,
+def _auth_headers(token: str) -> Dict[str, str]:
+    return {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {token}",
+    }
+
+
+def _message_response(response: Any, with_message_id: bool = True) -> WhatsAppResponse:
+    data, error_message = graph_error_message(response)
+    if error_message:
+        code = (data.get("error") or {}).get("code")
+        return WhatsAppResponse(
+            error=error_message, error_code=code if isinstance(code, int) else None
+        )
+    if not with_message_id:
+        return WhatsAppResponse()
+    message_id = data.get("messages", [{}])[0].get("id")
+    return WhatsAppResponse(message_id=message_id)
+
+
+def _post_message(
+    phone_number_id: str,
+    access_token: Optional[str],
+    payload: Dict[str, Any],
+    operation: str,
+    with_message_id: bool = True,
 ) -> WhatsAppResponse:
-    if settings.whatsapp_dry_run:
-        return WhatsAppResponse(message_id=f"dryrun.text.{int(time.time() * 1000)}")
+    token = _get_access_token(access_token)
+    response = graph_request(
+        "POST",
+        f"{phone_number_id}/messages",
+        operation=operation,
+        phone_number_id=phone_number_id,
+        headers=_auth_headers(token),
+        json=payload,
+    )
+    return _message_response(response, with_message_id)
 
-    recipient = _normalize_recipient(params.to)
-    payload = {
+
+async def _post_message_async(
+    phone_number_id: str,
+    access_token: Optional[str],
+    payload: Dict[str, Any],
+    operation: str,
+    with_message_id: bool = True,
+) -> WhatsAppResponse:
+    token = _get_access_token(access_token)
+    response = await graph_request_async(
+        "POST",
+        f"{phone_number_id}/messages",
+        operation=operation,
+        phone_number_id=phone_number_id,
+        headers=_auth_headers(token),
+        json=payload,
+    )
+    return _message_response(response, with_message_id)
+
+
+def _text_payload(params: SendWhatsAppTextParams) -> Dict[str, Any]:
+    return {
         "messaging_product": "whatsapp",
         "recipient_type": "individual",
-        "to": recipient,
+        "to": _normalize_recipient(params.to),
         "type": "text",
         "text": {"preview_url": False, "body": params.body},
     }
 
-    token = _get_access_token(params.access_token)
-    response = httpx.post(
-        f"https://graph.facebook.com/{API_VERSION}/{params.phone_number_id}/messages",
-        headers={
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {token}",
-        },
-        json=payload,
-        timeout=30,
+
+def _read_payload(params: SendWhatsAppReadParams) -> Dict[str, Any]:
+    return {
+        "messaging_product": "whatsapp",
+        "status": "read",
+        "message_id": params.message_id,
+        "typing_indicator": {"type": params.typing_type},
+    }
+
+
+def send_whatsapp_text(
+    params: SendWhatsAppTextParams,
+) -> WhatsAppResponse:
+    if settings.whatsapp_dry_run:
+        return WhatsAppResponse(message_id=f"dryrun.text.{int(time.time() * 1000)}")
+
+    return _post_message(
+        params.phone_number_id, params.access_token, _text_payload(params), "send_text"
     )
 
-    try:
-        data = response.json()
-    except ValueError:
-        data = {}
-    if not response.is_success:
-        error_message = data.get("error", {}).get("message") or "Unknown WhatsApp API error"
-        return WhatsAppResponse(error=error_message)
 
-    message_id = data.get("messages", [{}])[0].get("id")
-    return WhatsAppResponse(message_id=message_id)
+async def send_whatsapp_text_async(
+    params: SendWhatsAppTextParams,
+) -> WhatsAppResponse:
+    if settings.whatsapp_dry_run:
+        return WhatsAppResponse(message_id=f"dryrun.text.{int(time.time() * 1000)}")
+
+    return await _post_message_async(
+        params.phone_number_id, params.access_token, _text_payload(params), "send_text"
+    )
 
 
 def send_whatsapp_read(
@@ -123,33 +189,28 @@ def send_whatsapp_read(
     if settings.whatsapp_dry_run:
         return WhatsAppResponse()
 
-    payload = {
-        "messaging_product": "whatsapp",
-        "status": "read",
-        "message_id": params.message_id,
-        "typing_indicator": {"type": params.typing_type},
-    }
-
-    token = _get_access_token(params.access_token)
-    response = httpx.post(
-        f"https://graph.facebook.com/{API_VERSION}/{params.phone_number_id}/messages",
-        headers={
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {token}",
-        },
-        json=payload,
-        timeout=30,
+    return _post_message(
+        params.phone_number_id,
+        params.access_token,
+        _read_payload(params),
+        "send_read",
+        with_message_id=False,
     )
 
-    try:
-        data = response.json()
-    except ValueError:
-        data = {}
-    if not response.is_success:
-        error_message = data.get("error", {}).get("message") or "Unknown WhatsApp API error"
-        return WhatsAppResponse(error=error_message)
 
-    return WhatsAppResponse()
+async def send_whatsapp_read_async(
+    params: SendWhatsAppReadParams,
+) -> WhatsAppResponse:
+    if settings.whatsapp_dry_run:
+        return WhatsAppResponse()
+
+    return await _post_message_async(
+        params.phone_number_id,
+        params.access_token,
+        _read_payload(params),
+        "send_read",
+        with_message_id=False,
+    )
 
 
 def upload_whatsapp_media(
@@ -173,20 +234,19 @@ def upload_whatsapp_media(
         "messaging_product": "whatsapp",
     }
 
-    response = httpx.post(
-        f"https://graph.facebook.com/{API_VERSION}/{params.phone_number_id}/media",
+    response = graph_request(
+        "POST",
+        f"{params.phone_number_id}/media",
+        operation="upload_media",
+        phone_number_id=params.phone_number_id,
         headers={"Authorization": f"Bearer {token}"},
         data=data,
         files=files,
         timeout=60,
     )
 
-    try:
-        payload = response.json()
-    except ValueError:
-        payload = {}
-    if not response.is_success:
-        error_message = payload.get("error", {}).get("message") or "Unknown WhatsApp API error"
+    payload, error_message = graph_error_message(response)
+    if error_message:
         return WhatsAppResponse(error=error_message)
 
     return WhatsAppResponse(media_id=payload.get("id"))
@@ -198,40 +258,20 @@ def send_whatsapp_image(
     if settings.whatsapp_dry_run:
         return WhatsAppResponse(message_id=f"dryrun.image.{int(time.time() * 1000)}")
 
-    recipient = _normalize_recipient(params.to)
     payload = {
         "messaging_product": "whatsapp",
         "recipient_type": "individual",
-        "to": recipient,
+        "to": _normalize_recipient(params.to),
         "type": "image",
         "image": {
             "id": params.media_id,
             "caption": params.caption,
         },
     }
-
-    token = _get_access_token(params.access_token)
-    response = httpx.post(
-        f"https://graph.facebook.com/{API_VERSION}/{params.phone_number_id}/messages",
-        headers={
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {token}",
-        },
-        json=payload,
-        timeout=30,
+    return _post_message(
+        params.phone_number_id, params.access_token, payload, "send_image"
     )
 
-    try:
-        data = response.json()
-    except ValueError:
-        data = {}
-    if not response.is_success:
-        error_message = data.get("error", {}).get("message") or "Unknown WhatsApp API error"
-        return WhatsAppResponse(error=error_message)
-
-    message_id = data.get("messages", [{}])[0].get("id")
-    return WhatsAppResponse(message_id=message_id)
-
 
 def send_whatsapp_audio(
     params: SendWhatsAppAudioParams,
@@ -239,40 +279,20 @@ def send_whatsapp_audio(
     if settings.whatsapp_dry_run:
         return WhatsAppResponse(message_id=f"dryrun.audio.{int(time.time() * 1000)}")
 
-    recipient = _normalize_recipient(params.to)
     payload = {
         "messaging_product": "whatsapp",
         "recipient_type": "individual",
-        "to": recipient,
+        "to": _normalize_recipient(params.to),
         "type": "audio",
         "audio": {
             "id": params.media_id,
             "voice": bool(params.voice),
         },
     }
-
-    token = _get_access_token(params.access_token)
-    response = httpx.post(
-        f"https://graph.facebook.com/{API_VERSION}/{params.phone_number_id}/messages",
-        headers={
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {token}",
-        },
-        json=payload,
-        timeout=30,
+    return _post_message(
+        params.phone_number_id, params.access_token, payload, "send_audio"
     )
 
-    try:
-        data = response.json()
-    except ValueError:
-        data = {}
-    if not response.is_success:
-        error_message = data.get("error", {}).get("message") or "Unknown WhatsApp API error"
-        return WhatsAppResponse(error=error_message)
-
-    message_id = data.get("messages", [{}])[0].get("id")
-    return WhatsAppResponse(message_id=message_id)
-
 
 def send_whatsapp_document(
     params: SendWhatsAppDocumentParams,
@@ -280,11 +300,10 @@ def send_whatsapp_document(
     if settings.whatsapp_dry_run:
         return WhatsAppResponse(message_id=f"dryrun.document.{int(time.time() * 1000)}")
 
-    recipient = _normalize_recipient(params.to)
     payload = {
         "messaging_product": "whatsapp",
         "recipient_type": "individual",
-        "to": recipient,
+        "to": _normalize_recipient(params.to),
         "type": "document",
         "document": {
             "id": params.media_id,
@@ -292,25 +311,6 @@ def send_whatsapp_document(
             "filename": params.file_name,
         },
     }
-
-    token = _get_access_token(params.access_token)
-    response = httpx.post(
-        f"https://graph.facebook.com/{API_VERSION}/{params.phone_number_id}/messages",
-        headers={
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {token}",
-        },
-        json=payload,
-        timeout=30,
+    return _post_message(
+        params.phone_number_id, params.access_token, payload, "send_document"
     )
-
-    try:
-        data = response.json()
-    except ValueError:
-        data = {}
-    if not response.is_success:
-        error_message = data.get("error", {}).get("message") or "Unknown WhatsApp API error"
-        return WhatsAppResponse(error=error_message)
-
-    message_id = data.get("messages", [{}])[0].get("id")
-    return WhatsAppResponse(message_id=message_id)
@@ -1,8 +1,10 @@
 from datetime import datetime, timezone
+import time
 import unicodedata
 from typing import Any, Dict, List, Optional, Tuple
 
 from fastapi import APIRouter, Depends, Header, HTTPException, Query
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
 
 from app.chat.service import get_openai_client, DEFAULT_MODEL
@@ -17,16 +19,20 @@ from app.core.supabase import (
 from app.whatsapp.outbound import (
     SendWhatsAppTextParams,
     send_whatsapp_text,
-    SendWhatsAppDocumentParams,
-    send_whatsapp_document,
-    UploadWhatsAppMediaParams,
-    upload_whatsapp_media,
     SendWhatsAppReadParams,
     send_whatsapp_read,
 )
 
 # ── New modular imports ──────────────────────────────────────────
-from app.whatsapp.prompt import build_prompt
+from app.whatsapp.ai_logs import ai_log_writer
+from app.whatsapp.chat_lock import chat_turn_lock
+from app.whatsapp.media_cache import send_storage_document
+from app.whatsapp.prompt import build_prompt, prompt_cache_key
+from app.whatsapp.history import (
+    build_history_window,
+    order_session_messages,
+    summary_instructions,
+)
 from app.whatsapp.sanitizer import (
     sanitize_response,
     validate_and_fix_response,
@@ -47,7 +53,17 @@ from app.whatsapp.chat_state import (
     slot_id_allowed,
     get_pending_event,
     ensure_active_session,
+    ChatStateSession,
+    flush_chat_state,
+)
+from app.whatsapp.lead_repository import (
+    attach_lead_repository,
+    get_lead_repository,
+    invalidates_leads,
 )
+from app.whatsapp.org_cache import org_cache
+from app.whatsapp.slot_calendar import slot_calendar
+from app.whatsapp.turn_context import TurnContext, load_turn_context
 from app.whatsapp.tools import (
     CreateAdmissionsLeadRequest,
     UpdateAdmissionsLeadRequest,
@@ -63,6 +79,7 @@ from app.whatsapp.tools import (
     GetLeadStatusRequest,
     build_tools_list,
 )
+from app.whatsapp.tools.registry import ToolContext, ToolMemo, tool_registry
 
 # ── Backward-compatible aliases (used throughout this file) ──────
 # These allow the existing code (with underscore prefixes) to keep
@@ -87,6 +104,7 @@ _slot_id_from_selection = slot_id_from_selection
 _slot_id_allowed = slot_id_allowed
 _get_pending_event = get_pending_event
 _ensure_active_session = ensure_active_session
+_order_session_messages = order_session_messages
 
 router = APIRouter(prefix="/api/whatsapp", tags=["whatsapp"])
 
@@ -94,6 +112,8 @@ router = APIRouter(prefix="/api/whatsapp", tags=["whatsapp"])
 class ProcessQueueRequest(BaseModel):
     chat_id: str
     final_message: Optional[str] = None
+    # message_queue.last_added_at of the batch (duplicate detection)
+    batch_id: Optional[str] = None
 
 
 class CloseChatSessionEndpointRequest(BaseModel):
@@ -113,76 +133,22 @@ class CloseChatSessionEndpointRequest(BaseModel):
 
 def _load_session_messages(
     session_id: str,
+    limit: Optional[int] = None,
 ) -> List[Dict[str, Any]]:
+    """Session messages in chronological order (only the last *limit* if set)."""
     supabase = get_supabase_client()
-    print("[admissions] loading session messages", {"session_id": session_id})
-    response = (
+    print("[admissions] loading session messages", {"session_id": session_id, "limit": limit})
+    query = (
         supabase.from_("messages")
         .select("role, body, created_at, wa_timestamp")
         .eq("chat_session_id", session_id)
         .order("created_at", desc=True)
-        .execute()
     )
+    if limit:
+        query = query.limit(limit)
+    response = query.execute()
     data = get_supabase_data(response) or []
-
-    def _normalize_dt(value: str) -> str:
-        import re
-
-        normalized = value.strip()
-        if normalized.endswith("Z"):
-            normalized = normalized.replace("Z", "+00:00")
-        if len(normalized) >= 3 and normalized[-3] in {"+", "-"}:
-            normalized = f"{normalized}:00"
-        if len(normalized) >= 5 and normalized[-5] in {"+", "-"}:
-            normalized = f"{normalized[:-2]}:{normalized[-2:]}"
-
-        # Fix microseconds to be 3 or 6 digits for Python < 3.11 compatibility
-        match = re.search(r"\.(\d+)(?:([+-]\d{2}:\d{2})|$)", normalized)
-        if match:
-            us = match.group(1)
-            tz = match.group(2) or ""
-            if len(us) != 3 and len(us) != 6:
-                if len(us) < 6:
-                    new_us = us.ljust(6, "0")
-                else:
-                    new_us = us[:6]
-                normalized = normalized.replace(f".{us}{tz}", f".{new_us}{tz}")
-
-        return normalized
-
-    def _parse_dt(value: Optional[str]) -> Optional[datetime]:
-        if not value:
-            return None
-        try:
-            parsed = datetime.fromisoformat(_normalize_dt(value))
-            if parsed.tzinfo is None:
-                return parsed.replace(tzinfo=timezone.utc)
-            return parsed
-        except ValueError:
-            try:
-                parsed = datetime.fromisoformat(_normalize_dt(value.replace(" ", "T")))
-                if parsed.tzinfo is None:
-                    return parsed.replace(tzinfo=timezone.utc)
-                return parsed
-            except ValueError:
-                return None
-
-    def _sort_key(item: Dict[str, Any]) -> float:
-        role = item.get("role")
-        created_dt = _parse_dt(item.get("created_at"))
-        wa_dt = _parse_dt(item.get("wa_timestamp"))
-        if role == "user" and wa_dt:
-            dt = wa_dt
-        else:
-            dt = created_dt or wa_dt
-        return dt.timestamp() if dt else 0.0
-
-    ordered = sorted(data, key=_sort_key)
-    return [
-        item
-        for item in ordered
-        if item.get("role") in {"user", "assistant"} and item.get("body")
-    ]
+    return _order_session_messages(data)
 
 
 
@@ -504,7 +470,7 @@ def _get_scheduled_appointment_for_chat(
     chat: Dict[str, Any],
 ) -> Tuple[Optional[Dict[str, Any]], List[Dict[str, Any]]]:
     leads = _get_leads_by_chat(
-        supabase, org.get("id"), chat.get("id"), wa_id=chat.get("wa_id")
+        supabase, org.get("id"), chat.get("id"), wa_id=chat.get("wa_id"), chat=chat
     )
     if not leads:
         return None, []
@@ -513,6 +479,13 @@ def _get_scheduled_appointment_for_chat(
     if not lead_ids:
         return None, leads
 
+    repo = get_lead_repository(chat)
+    if repo is not None:
+        appointments = sorted(
+            repo.appointments(supabase), key=lambda appt: appt.get("starts_at") or ""
+        )
+        return (appointments[0] if appointments else None), leads
+
     appt_response = (
         supabase.from_("appointments")
         .select("id, lead_id, slot_id, starts_at, ends_at")
@@ -557,7 +530,7 @@ def _update_appointment_flow_from_user_text(
         appointment, _ = _get_scheduled_appointment_for_chat(supabase, org, chat)
         if appointment:
             lead = _get_lead_by_chat(
-                supabase, org.get("id"), chat.get("id"), wa_id=chat.get("wa_id")
+                supabase, org.get("id"), chat.get("id"), wa_id=chat.get("wa_id"), chat=chat
             )
             slot_state = _get_slot_state(lead, chat)
             if slot_state.get("flow") != "reschedule":
@@ -647,7 +620,7 @@ def _infer_requirement_divisions(
 
     supabase = get_supabase_client()
     leads = _get_leads_by_chat(
-        supabase, org.get("id"), chat.get("id"), wa_id=chat.get("wa_id")
+        supabase, org.get("id"), chat.get("id"), wa_id=chat.get("wa_id"), chat=chat
     )
     for lead in leads:
         division = _normalize_event_division(str(lead.get("division") or ""))
@@ -878,6 +851,7 @@ def _merge_existing_lead_from_create_request(
         supabase.from_("crm_contacts").update(contact_updates).eq("id", contact_id).execute()
 
 
+@invalidates_leads
 def _create_admissions_lead(
     request: CreateAdmissionsLeadRequest,
     org: Dict[str, Any],
@@ -912,7 +886,7 @@ def _create_admissions_lead(
     if not org_id or not chat_id:
         raise HTTPException(status_code=400, detail="Missing org or chat id")
 
-    existing_leads = _get_leads_by_chat(supabase, org_id, chat_id, wa_id)
+    existing_leads = _get_leads_by_chat(supabase, org_id, chat_id, wa_id, chat=chat)
     
     for lead in existing_leads:
         if _same_student_from_create_request(lead, request):
@@ -1014,6 +988,29 @@ def _create_admissions_lead(
     )
 
 
+def _create_lead_and_register_pending_event(
+    request: CreateAdmissionsLeadRequest,
+    org: Dict[str, Any],
+    chat: Dict[str, Any],
+    session_id: str,
+) -> str:
+    """Tool handler: create the lead, then finish a deferred event signup."""
+    tool_result = _create_admissions_lead(request, org=org, chat=chat)
+    pending_event_id = _pop_chat_state_value(
+        get_supabase_client(), chat, "pending_event_registration"
+    )
+    if pending_event_id:
+        register_text = _register_event(
+            RegisterEventRequest(event_id=pending_event_id),
+            org=org,
+            chat=chat,
+            session_id=session_id,
+        )
+        tool_result = f"{tool_result} {register_text}"
+    return tool_result
+
+
+@invalidates_leads
 def _update_admissions_lead(
     request: UpdateAdmissionsLeadRequest,
     org: Dict[str, Any],
@@ -1172,6 +1169,7 @@ def _update_admissions_lead(
     )
 
 
+@invalidates_leads
 def _add_lead_note(
     request: AddLeadNoteRequest,
     org: Dict[str, Any],
@@ -1183,7 +1181,7 @@ def _add_lead_note(
     if not org_id or not chat_id:
         raise HTTPException(status_code=400, detail="Missing org or chat id")
 
-    leads = _get_leads_by_chat(supabase, org_id, chat_id, wa_id=chat.get("wa_id"))
+    leads = _get_leads_by_chat(supabase, org_id, chat_id, wa_id=chat.get("wa_id"), chat=chat)
     if not leads:
         # No lead yet — save as pending note so it attaches when lead is created
         _append_pending_note(supabase, chat, request.notes)
@@ -1221,7 +1219,7 @@ def _maybe_auto_add_interest_note(
         return None
     supabase = get_supabase_client()
     leads = _get_leads_by_chat(
-        supabase, org.get("id"), chat.get("id"), wa_id=chat.get("wa_id")
+        supabase, org.get("id"), chat.get("id"), wa_id=chat.get("wa_id"), chat=chat
     )
     if not leads:
         return None
@@ -1247,7 +1245,7 @@ def _maybe_auto_add_notes(
 
     supabase = get_supabase_client()
     leads = _get_leads_by_chat(
-        supabase, org.get("id"), chat.get("id"), wa_id=chat.get("wa_id")
+        supabase, org.get("id"), chat.get("id"), wa_id=chat.get("wa_id"), chat=chat
     )
     if leads:
         for lead in leads:
@@ -1259,6 +1257,7 @@ def _maybe_auto_add_notes(
     return True
 
 
+@invalidates_leads
 def _maybe_auto_cancel(
     combined_user: str,
     history: List[Dict[str, str]],
@@ -1316,7 +1315,7 @@ def _maybe_auto_cancel(
     # Check if there's a scheduled appointment to cancel
     supabase = get_supabase_client()
     lead = _get_lead_by_chat(
-        supabase, org.get("id"), chat.get("id"), wa_id=chat.get("wa_id")
+        supabase, org.get("id"), chat.get("id"), wa_id=chat.get("wa_id"), chat=chat
     )
     if not lead or not lead.get("id"):
         return None
@@ -1354,6 +1353,7 @@ def _maybe_auto_cancel(
     if get_supabase_error(cancel_response) or not cancel_row or not cancel_row.get("success"):
         message = (cancel_row or {}).get("message") or "No pude cancelar la cita en este momento."
         return f"{message} Por favor intenta de nuevo o contacta a admisiones."
+    slot_calendar.invalidate(org.get("id"))
     
     # Clear any stored slot options
     _clear_slot_options(supabase, lead, chat)
@@ -1381,30 +1381,34 @@ def _get_lead_status(
     chat_id = chat.get("id")
     wa_id = chat.get("wa_id")
 
-    # Query leads with status fields (not using _get_leads_by_chat which omits status)
-    _status_fields = (
-        "id, lead_number, status, student_first_name, "
-        "student_last_name_paternal, grade_interest"
-    )
-    resp = (
-        supabase.from_("leads")
-        .select(_status_fields)
-        .eq("organization_id", org_id)
-        .eq("wa_chat_id", chat_id)
-        .order("created_at", desc=True)
-        .execute()
-    )
-    leads = get_supabase_data(resp) or []
-    if not leads and wa_id:
-        resp2 = (
+    # Leads (with status) from the turn's lead repository when available
+    repo = get_lead_repository(chat)
+    if repo is not None:
+        leads = repo.leads(supabase)
+    else:
+        _status_fields = (
+            "id, lead_number, status, student_first_name, "
+            "student_last_name_paternal, grade_interest"
+        )
+        resp = (
             supabase.from_("leads")
             .select(_status_fields)
             .eq("organization_id", org_id)
-            .eq("wa_id", wa_id)
+            .eq("wa_chat_id", chat_id)
             .order("created_at", desc=True)
             .execute()
         )
-        leads = get_supabase_data(resp2) or []
+        leads = get_supabase_data(resp) or []
+        if not leads and wa_id:
+            resp2 = (
+                supabase.from_("leads")
+                .select(_status_fields)
+                .eq("organization_id", org_id)
+                .eq("wa_id", wa_id)
+                .order("created_at", desc=True)
+                .execute()
+            )
+            leads = get_supabase_data(resp2) or []
     if not leads:
         return (
             "No encontré un registro de admisiones asociado a este chat. "
@@ -1424,9 +1428,24 @@ def _get_lead_status(
         "lost": "Proceso pausado - contacta a admisiones para reactivar",
     }
 
+    # Next appointment and recent history for every lead in one round-trip
+    lead_ids = [lead.get("id") for lead in leads if lead.get("id")]
+    details_resp = supabase.rpc(
+        "get_lead_status_details",
+        {"p_lead_ids": lead_ids, "p_history_limit": 3},
+    ).execute()
+    details_error = get_supabase_error(details_resp)
+    if details_error:
+        raise RuntimeError(f"get_lead_status_details failed: {details_error}")
+    details = {
+        row.get("lead_id"): row
+        for row in get_supabase_data(details_resp) or []
+    }
+
     results = []
     for lead in leads:
         lead_id = lead.get("id")
+        detail = details.get(lead_id) or {}
         student_name = _compose_full_name([
             lead.get("student_first_name"),
             lead.get("student_last_name_paternal"),
@@ -1437,33 +1456,16 @@ def _get_lead_status(
         status_text = status_descriptions.get(status, f"Estado: {status}")
 
         # Upcoming appointment
-        appt_resp = (
-            supabase.from_("appointments")
-            .select("id, starts_at, ends_at, status")
-            .eq("lead_id", lead_id)
-            .eq("status", "scheduled")
-            .order("starts_at", desc=False)
-            .limit(1)
-            .execute()
-        )
-        appts = get_supabase_data(appt_resp) or []
+        appt = detail.get("next_appointment")
         appt_text = ""
-        if appts:
+        if appt:
             formatted = _format_slot_window_local(
-                appts[0].get("starts_at"), appts[0].get("ends_at")
+                appt.get("starts_at"), appt.get("ends_at")
             )
             appt_text = f"Cita programada: {formatted}" if formatted else ""
 
         # Recent status history (last 3)
-        history_resp = (
-            supabase.from_("lead_status_history")
-            .select("previous_status, new_status, created_at")
-            .eq("lead_id", lead_id)
-            .order("created_at", desc=True)
-            .limit(3)
-            .execute()
-        )
-        history = get_supabase_data(history_resp) or []
+        history = detail.get("history") or []
         history_text = ""
         if history:
             lines = [
@@ -1518,7 +1520,7 @@ def _maybe_book_from_selection(
     """
     supabase = get_supabase_client()
     lead = _get_lead_by_chat(
-        supabase, org.get("id"), chat.get("id"), wa_id=chat.get("wa_id")
+        supabase, org.get("id"), chat.get("id"), wa_id=chat.get("wa_id"), chat=chat
     )
     slot_options = _get_slot_options(lead, chat)
 
@@ -1644,7 +1646,7 @@ def _maybe_book_pending_selection(
     if not pending:
         return None
     lead = _get_lead_by_chat(
-        supabase, org.get("id"), chat.get("id"), wa_id=chat.get("wa_id")
+        supabase, org.get("id"), chat.get("id"), wa_id=chat.get("wa_id"), chat=chat
     )
     if not lead or not lead.get("id"):
         return None
@@ -1732,31 +1734,25 @@ def _maybe_book_pending_selection(
 
 
 
-def _send_assistant_message(
-    assistant_text: str,
-    org: Dict[str, Any],
-    chat: Dict[str, Any],
-    session_id: str,
-) -> Dict[str, Any]:
-    supabase = get_supabase_client()
-    
+def _prepare_outbound_text(assistant_text: str) -> str:
     # Sanitize the response before sending
     sanitized_text = _sanitize_assistant_response(assistant_text)
-    
+
     # If sanitization resulted in empty text, use a fallback
     if not sanitized_text:
         sanitized_text = "Disculpa, hubo un problema procesando mi respuesta. ¿Podrías repetir tu pregunta?"
         print("[admissions] WARNING: Empty response after sanitization, using fallback")
-    
-    send_result = send_whatsapp_text(
-        SendWhatsAppTextParams(
-            phone_number_id=org.get("phone_number_id"),
-            to=chat.get("wa_id"),
-            body=sanitized_text,
-        )
-    )
+    return sanitized_text
+
 
-    message_payload = {
+def _assistant_message_payload(
+    sanitized_text: str,
+    send_result: Any,
+    org: Dict[str, Any],
+    chat: Dict[str, Any],
+    session_id: str,
+) -> Dict[str, Any]:
+    return {
         "chat_id": chat.get("id"),
         "chat_session_id": session_id,
         "wa_message_id": send_result.message_id,
@@ -1773,6 +1769,64 @@ def _send_assistant_message(
         "created_at": datetime.utcnow().isoformat(),
     }
 
+
+def _send_result_summary(send_result: Any) -> Dict[str, Any]:
+    return {
+        "status": "sent" if not send_result.error else "error",
+        "message_id": send_result.message_id,
+        "error": send_result.error,
+    }
+
+
+def _mark_reply_sent(chat: Dict[str, Any], send_result: Any) -> None:
+    """Remember that this turn's reply reached WhatsApp."""
+    if not send_result.error:
+        chat["_reply_sent"] = _send_result_summary(send_result)
+
+
+def _reply_sent_result(chat: Dict[str, Any], exc: BaseException) -> Optional[Dict[str, Any]]:
+    """Result of a turn that failed after its reply was delivered, if so.
+
+    Retrying such a turn (``chat_jobs``, connection-error retry) would send
+    a second reply and repeat its tool side effects, so the error is only
+    logged and the turn is reported as sent.
+    """
+    sent = chat.get("_reply_sent")
+    if sent is None:
+        return None
+    print(
+        "[admissions] error after reply was sent",
+        {"chat_id": chat.get("id"), "error": str(exc)},
+    )
+    return {**sent, "warning": str(exc)}
+
+
+def _send_assistant_message(
+    assistant_text: str,
+    org: Dict[str, Any],
+    chat: Dict[str, Any],
+    session_id: str,
+) -> Dict[str, Any]:
+    supabase = get_supabase_client()
+
+    sanitized_text = _prepare_outbound_text(assistant_text)
+
+    # Checkpoint pending chat state before the reply leaves the process
+    flush_chat_state(chat)
+
+    send_result = send_whatsapp_text(
+        SendWhatsAppTextParams(
+            phone_number_id=org.get("phone_number_id"),
+            to=chat.get("wa_id"),
+            body=sanitized_text,
+        )
+    )
+    _mark_reply_sent(chat, send_result)
+
+    message_payload = _assistant_message_payload(
+        sanitized_text, send_result, org, chat, session_id
+    )
+
     supabase.from_("messages").insert(message_payload).execute()
 
     supabase.from_("chat_sessions").update(
@@ -1782,11 +1836,7 @@ def _send_assistant_message(
         }
     ).eq("id", session_id).execute()
 
-    return {
-        "status": "sent" if not send_result.error else "error",
-        "message_id": send_result.message_id,
-        "error": send_result.error,
-    }
+    return _send_result_summary(send_result)
 
 
 def _load_session_state(session_id: str) -> Dict[str, Any]:
@@ -1840,9 +1890,6 @@ def _load_lead_context(
     if not leads:
         return None
 
-    # 2. Build context string for all leads
-    context_parts = []
-    
     # We will check appointments for ALL lead IDs
     lead_ids = [l["id"] for l in leads]
     
@@ -1855,6 +1902,19 @@ def _load_lead_context(
         .execute()
     )
     all_appts = get_supabase_data(appt_response) or []
+    return _format_lead_context(leads, all_appts)
+
+
+def _format_lead_context(
+    leads: List[Dict[str, Any]],
+    all_appts: List[Dict[str, Any]],
+) -> Optional[str]:
+    """Build the DATOS DE LEADS block from leads and scheduled appointments."""
+    if not leads:
+        return None
+
+    # 2. Build context string for all leads
+    context_parts = []
     appt_map = {a["lead_id"]: a for a in all_appts}
 
     for i, lead_data in enumerate(leads, 1):
@@ -1935,13 +1995,52 @@ def _load_lead_context(
 
 
 @router.post("/process", dependencies=[Depends(require_cron_secret)])
-def process_queue(
+async def process_queue(
     payload: ProcessQueueRequest,
 ):
-    """Top-level endpoint — wraps the implementation with connection-error retry."""
-    from app.core.supabase import CONN_ERRORS
+    """Top-level endpoint — dispatches to the async or sync turn pipeline.
+
+    ``PROCESS_QUEUE_MODE=async`` (default) keeps the event loop free while
+    waiting on OpenAI/WhatsApp; ``sync`` runs the original blocking
+    implementation in the threadpool as a fallback.
+    """
+    return await run_process_queue(payload)
+
+
+async def run_process_queue(
+    payload: ProcessQueueRequest,
+) -> Dict[str, Any]:
+    """Process one debounced batch with the configured pipeline.
+
+    Shared by the HTTP endpoint (edge-function backend) and the in-process
+    debounce scheduler.
+    """
+    print(
+        "[admissions] process_queue",
+        {"chat_id": payload.chat_id, "mode": settings.process_queue_mode},
+    )
+
+    async def _turn(final_message: Optional[str]) -> Dict[str, Any]:
+        request = ProcessQueueRequest(chat_id=payload.chat_id, final_message=final_message)
+        if settings.process_queue_mode == "sync":
+            return await run_in_threadpool(_process_queue_sync, request)
+
+        from app.whatsapp.async_pipeline import process_queue_async_with_retry
 
-    print("[admissions] process_queue", {"chat_id": payload.chat_id})
+        return await process_queue_async_with_retry(request)
+
+    # One turn per chat at a time; requests that overlap a running turn are
+    # folded into its follow-up turn.
+    return await chat_turn_lock.run(
+        payload.chat_id, payload.final_message, _turn, batch_id=payload.batch_id
+    )
+
+
+def _process_queue_sync(
+    payload: ProcessQueueRequest,
+):
+    """Run ``_process_queue_impl`` with connection-error retry."""
+    from app.core.supabase import CONN_ERRORS
 
     for _attempt in range(2):
         try:
@@ -1959,40 +2058,28 @@ def process_queue(
                 raise
 
 
-def _process_queue_impl(
-    payload: ProcessQueueRequest,
-):
-    supabase = get_supabase_client()
-    chat_response = (
-        supabase.from_("chats")
-        .select("id, wa_id, organization_id, active_session_id, state_context")
-        .eq("id", payload.chat_id)
-        .single()
-        .execute()
-    )
-    chat_error = get_supabase_error(chat_response)
-    chat = get_supabase_data(chat_response)
+# ── Turn phases ──────────────────────────────────────────────────
+# _process_queue_impl (sync) and app.whatsapp.async_pipeline (async) share
+# these phases; only the model calls and the WhatsApp I/O differ.  Both
+# start from a TurnContext loaded with the get_turn_context RPC.
 
-    if chat_error or not chat:
-        raise HTTPException(status_code=404, detail="Chat not found")
-    print("[admissions] chat loaded", {"chat_id": chat.get("id")})
+MAX_TOOL_ROUNDS = 5
 
-    org_response = (
-        supabase.from_("organizations")
-        .select(
-            "id, name, bot_name, bot_instructions, bot_tone, bot_language, bot_model, phone_number_id"
-        )
-        .eq("id", chat.get("organization_id"))
-        .single()
-        .execute()
-    )
-    org_error = get_supabase_error(org_response)
-    org = get_supabase_data(org_response)
+_TECHNICAL_DIFFICULTIES_TEXT = (
+    "Disculpa, estoy teniendo dificultades técnicas en este momento. "
+    "Por favor intenta de nuevo en unos minutos, o si prefieres, "
+    "puedes llamarnos al 8711123687."
+)
+_BOOKING_CONFIRMATION_FALLBACK_TEXT = (
+    "¡Excelente! Ya quedaron registrados tus datos y tu visita fue agendada. "
+    "Te esperamos. 😊"
+)
+_TOOL_ROUNDS_DONE_TEXT = (
+    "Tu solicitud fue procesada correctamente. ¿En qué más puedo ayudarte?"
+)
 
-    if org_error or not org:
-        raise HTTPException(status_code=404, detail="Organization not found")
-    print("[admissions] org loaded", {"org_id": org.get("id")})
 
+def _validate_turn_entities(chat: Dict[str, Any], org: Dict[str, Any]) -> None:
     if not org.get("phone_number_id"):
         raise HTTPException(
             status_code=500, detail="Organization missing phone_number_id"
@@ -2001,34 +2088,11 @@ def _process_queue_impl(
     if not chat.get("wa_id"):
         raise HTTPException(status_code=500, detail="Chat missing wa_id")
 
-    # Mark last message as read and show typing indicator
-    last_msg_response = (
-        supabase.from_("messages")
-        .select("wa_message_id")
-        .eq("chat_id", chat.get("id"))
-        .eq("direction", "inbound")
-        .order("created_at", desc=True)
-        .limit(1)
-        .execute()
-    )
-    last_msgs = get_supabase_data(last_msg_response)
-    if last_msgs and last_msgs[0].get("wa_message_id"):
-        send_whatsapp_read(
-            SendWhatsAppReadParams(
-                phone_number_id=org.get("phone_number_id"),
-                message_id=last_msgs[0].get("wa_message_id"),
-                typing_type="text",
-            )
-        )
-
-    session_id = _ensure_active_session(chat, org.get("id"))
-
-    supabase.from_("messages").update({"chat_session_id": session_id}).eq(
-        "chat_id", chat.get("id")
-    ).is_("chat_session_id", None).execute()
-
-    all_messages = _load_session_messages(session_id)
 
+def _split_session_messages(
+    all_messages: List[Dict[str, Any]],
+) -> Tuple[List[Dict[str, str]], List[str]]:
+    """Split session messages into model history and unanswered user texts."""
     history: List[Dict[str, str]] = []
     pending_user_texts: List[str] = []
 
@@ -2050,18 +2114,79 @@ def _process_queue_impl(
         if role == "user" and body:
             pending_user_texts.append(body)
 
+    return history, pending_user_texts
+
+
+def _resolve_model(org: Dict[str, Any]) -> str:
+    model = org.get("bot_model")
+    if not isinstance(model, str) or not model.strip():
+        model = DEFAULT_MODEL
+    return model
+
+
+def _build_slot_options_context(
+    lead: Optional[Dict[str, Any]], chat: Dict[str, Any]
+) -> Optional[str]:
+    slot_options = _get_slot_options(lead, chat)
+    if not slot_options:
+        return None
+    appointment_flow = _get_chat_state(chat).get("appointment_flow")
+    slot_tool_name = (
+        "reschedule_appointment"
+        if appointment_flow == "reschedule"
+        else "book_appointment"
+    )
+    slot_context_lines = [f"OPCIONES DE HORARIOS DISPONIBLES (usa estos IDs exactos para {slot_tool_name}):"]
+    for opt in slot_options:
+        formatted = _format_slot_window_local(opt.get("starts_at"), opt.get("ends_at"))
+        if formatted:
+            slot_context_lines.append(
+                f"- Opción {opt.get('option')}: {formatted} (slot_id: {opt.get('slot_id')})"
+            )
+    if appointment_flow == "reschedule":
+        slot_context_lines.append("Si el usuario elige una opción, usa el slot_id correspondiente en reschedule_appointment.")
+    else:
+        slot_context_lines.append("Si el usuario elige una opción, usa el slot_id correspondiente en book_appointment.")
+    return "\n".join(slot_context_lines)
+
+
+def _prepare_turn(
+    payload: ProcessQueueRequest,
+    ctx: TurnContext,
+) -> Dict[str, Any]:
+    """Run the database-bound part of a turn, up to the first model call.
+
+    Returns a turn dict.  ``skip_reason`` is set when there is nothing to
+    answer and ``forced_text`` when a deterministic path (slot search,
+    booking from selection, cancellation) already produced the reply.
+    """
+    supabase = get_supabase_client()
+    chat, org = ctx.chat, ctx.org
+    session_id = ctx.session_id
+
+    model = _resolve_model(org)
+    # Bounded window of the session: recent messages + rolling summary
+    history_window = build_history_window(
+        session_id,
+        ctx.messages,
+        org,
+        ctx.history_summary,
+        model,
+        chat_id=chat.get("id"),
+        unsummarized_count=ctx.unsummarized_count,
+    )
+    history, pending_user_texts = _split_session_messages(history_window.messages)
+
     combined_user = payload.final_message or " ".join(pending_user_texts)
+    turn: Dict[str, Any] = {
+        "session_id": session_id,
+        "combined_user": combined_user,
+        "history": history,
+    }
     if not combined_user:
-        return {"status": "skipped", "reason": "no_user_message"}
+        turn["skip_reason"] = "no_user_message"
+        return turn
     print("[admissions] combined user", {"text": combined_user})
-    # print(
-    #     "[admissions] history",
-    #     {"count": len(history), "messages": history},
-    # )
-    # print("----------- HISTORY LINES -----------")
-    # for i, msg in enumerate(history):
-    #     print(f"[{i}] {msg.get('role')}: {msg.get('content')}")
-    # print("-------------------------------------")
 
     preferred_date = _extract_preferred_date(combined_user)
     if preferred_date:
@@ -2069,67 +2194,48 @@ def _process_queue_impl(
 
     _update_appointment_flow_from_user_text(combined_user, org, chat)
 
-    forced_slots = _maybe_auto_search_slots(
-        combined_user=combined_user, org=org, chat=chat
-    )
-    if forced_slots:
-        return _send_assistant_message(forced_slots, org, chat, session_id)
-
-    forced_text = _maybe_book_from_selection(
-        combined_user=combined_user, org=org, chat=chat
+    forced_text = (
+        _maybe_auto_search_slots(combined_user=combined_user, org=org, chat=chat)
+        or _maybe_book_from_selection(combined_user=combined_user, org=org, chat=chat)
+        # Check if user is providing a cancellation reason after being asked
+        or _maybe_auto_cancel(
+            combined_user=combined_user,
+            history=history,
+            org=org,
+            chat=chat,
+        )
     )
     if forced_text:
-        return _send_assistant_message(forced_text, org, chat, session_id)
-    
-    # Check if user is providing a cancellation reason after being asked
-    forced_cancel = _maybe_auto_cancel(
-        combined_user=combined_user,
-        history=history,
-        org=org,
-        chat=chat,
-    )
-    if forced_cancel:
-        return _send_assistant_message(forced_cancel, org, chat, session_id)
+        turn["forced_text"] = forced_text
+        return turn
 
     has_assistant_history = any(
         message.get("role") == "assistant" for message in history
     )
 
-    lead_context = _load_lead_context(
-        org.get("id"), chat.get("id"), wa_id=chat.get("wa_id")
+    # Bootstrap leads, or a reload if a forced path wrote to them
+    lead_repo = get_lead_repository(chat) or attach_lead_repository(ctx)
+    lead_context = _format_lead_context(
+        lead_repo.leads(supabase), lead_repo.appointments(supabase)
     )
+    lead = lead_repo.lead(supabase)
 
     # ── Build instructions (replaces system messages) ──────────────
+    # The memoized static prefix goes first so it stays byte-stable across
+    # turns (OpenAI prompt caching); everything per-turn follows it.
     instructions_parts = [_build_prompt(org)]
-    if has_assistant_history:
+    history_summary = summary_instructions(history_window.summary)
+    if history_summary:
+        instructions_parts.append(history_summary)
+    if has_assistant_history or history_summary:
         instructions_parts.append("El usuario ya fue saludado en esta conversacion.")
     if lead_context:
         instructions_parts.append(lead_context)
 
     # Add slot options context if available
-    lead = _get_lead_by_chat(
-        supabase, org.get("id"), chat.get("id"), wa_id=chat.get("wa_id")
-    )
-    slot_options = _get_slot_options(lead, chat)
-    if slot_options:
-        appointment_flow = _get_chat_state(chat).get("appointment_flow")
-        slot_tool_name = (
-            "reschedule_appointment"
-            if appointment_flow == "reschedule"
-            else "book_appointment"
-        )
-        slot_context_lines = [f"OPCIONES DE HORARIOS DISPONIBLES (usa estos IDs exactos para {slot_tool_name}):"]
-        for opt in slot_options:
-            formatted = _format_slot_window_local(opt.get("starts_at"), opt.get("ends_at"))
-            if formatted:
-                slot_context_lines.append(
-                    f"- Opción {opt.get('option')}: {formatted} (slot_id: {opt.get('slot_id')})"
-                )
-        if appointment_flow == "reschedule":
-            slot_context_lines.append("Si el usuario elige una opción, usa el slot_id correspondiente en reschedule_appointment.")
-        else:
-            slot_context_lines.append("Si el usuario elige una opción, usa el slot_id correspondiente en book_appointment.")
-        instructions_parts.append("\n".join(slot_context_lines))
+    slot_context = _build_slot_options_context(lead, chat)
+    if slot_context:
+        instructions_parts.append(slot_context)
 
     # If a booking was just completed (by _maybe_book_from_selection),
     # inject the context so the LLM generates a natural confirmation
@@ -2138,367 +2244,360 @@ def _process_queue_impl(
         instructions_parts.append(booking_context)
         chat.pop("_booking_context", None)
 
-    full_instructions = "\n\n".join(instructions_parts)
-
     # ── Build input (history + current user message) ──────────────
     input_messages = []
     input_messages.extend(history)
     input_messages.append({"role": "user", "content": combined_user})
 
-    tools = build_tools_list()
+    turn.update(
+        {
+            "lead": lead,
+            "instructions": "\n\n".join(instructions_parts),
+            "input_messages": input_messages,
+            "tools": build_tools_list(),
+            "model": model,
+            "prompt_cache_key": prompt_cache_key(org),
+            "tool_calls": [],
+            "lead_note_added": False,
+        }
+    )
+    return turn
+
+
+def _model_request(
+    turn: Dict[str, Any],
+    input_items: List[Any],
+    with_tools: bool = True,
+    extra_instructions: Optional[str] = None,
+) -> Dict[str, Any]:
+    """Keyword arguments for ``responses.create`` (sync and async clients)."""
+    instructions = turn["instructions"]
+    if extra_instructions:
+        instructions = instructions + "\n\n" + extra_instructions
+    request: Dict[str, Any] = {
+        "model": turn["model"],
+        "instructions": instructions,
+        "input": input_items,
+    }
+    if turn.get("prompt_cache_key"):
+        request["prompt_cache_key"] = turn["prompt_cache_key"]
+    if with_tools:
+        request["tools"] = turn["tools"]
+    return request
+
+
+def _function_calls(response: Any) -> List[Any]:
+    return [item for item in response.output if item.type == "function_call"]
+
+
+def _log_model_call(
+    turn: Dict[str, Any],
+    org: Dict[str, Any],
+    chat: Dict[str, Any],
+    kind: str,
+    round_index: int,
+    started: float,
+    response: Any = None,
+    error: Optional[BaseException] = None,
+) -> None:
+    """Queue the ``ai_logs`` record of one model call (sync and async)."""
+    ai_log_writer.log_model_call(
+        organization_id=org.get("id"),
+        chat_id=chat.get("id"),
+        session_id=turn.get("session_id"),
+        model=turn.get("model"),
+        kind=kind,
+        round_index=round_index,
+        latency_ms=(time.perf_counter() - started) * 1000,
+        response=response,
+        error=error,
+    )
+
+
+def _call_model(
+    client: Any,
+    request: Dict[str, Any],
+    turn: Dict[str, Any],
+    org: Dict[str, Any],
+    chat: Dict[str, Any],
+    kind: str,
+    round_index: int,
+) -> Any:
+    started = time.perf_counter()
+    try:
+        response = client.responses.create(**request)
+    except Exception as exc:
+        _log_model_call(turn, org, chat, kind, round_index, started, error=exc)
+        raise
+    _log_model_call(turn, org, chat, kind, round_index, started, response=response)
+    return response
+
+
+def _tool_context(
+    turn: Dict[str, Any],
+    org: Dict[str, Any],
+    chat: Dict[str, Any],
+) -> ToolContext:
+    """Per-turn context for the tool registry (memo shared by all rounds)."""
+    return ToolContext(
+        org=org,
+        chat=chat,
+        session_id=turn["session_id"],
+        combined_user=turn["combined_user"],
+        memo=turn.setdefault("tool_memo", ToolMemo()),
+    )
+
+
+def _execute_first_round_tools(
+    turn: Dict[str, Any],
+    org: Dict[str, Any],
+    chat: Dict[str, Any],
+    tool_calls: List[Any],
+    assistant_text: str,
+) -> Dict[str, Any]:
+    """Execute the tool calls of the first model response.
+
+    Returns ``tool_outputs`` for the follow-up request, the (possibly
+    overridden) ``assistant_text``, ``done`` when no follow-up model call is
+    needed, and ``booking_context`` when a pending selection was booked and
+    the model should confirm it.  Independent calls run concurrently
+    through ``tool_registry``; effects are applied in call order.
+    """
+    turn["tool_calls"].extend(tool_calls)
+
+    booking_done = False
+    booking_error_text: Optional[str] = None
+    # Collect tool outputs for the Responses API followup
+    tool_outputs = []
+    results = tool_registry.execute(tool_calls, _tool_context(turn, org, chat))
+    for result in results:
+        tool_name = result.name
+        tool_result = result.output
+        if result.note_added:
+            turn["lead_note_added"] = True
+        if tool_name == "book_appointment":
+            if tool_result.lower().startswith("cita agendada exitosamente"):
+                booking_done = True
+                assistant_text = "¡Tu visita ha sido agendada exitosamente! Te esperamos con gusto."
+            elif tool_result.lower().startswith("el horario seleccionado"):
+                booking_error_text = (
+                    "Para reservar necesito que elijas una opcion "
+                    "de la lista enviada. Si no tienes opciones, "
+                    "dime que dias te convienen."
+                )
+        elif tool_name == "reschedule_appointment":
+            if tool_result.lower().startswith("cita reagendada exitosamente"):
+                booking_done = True
+                assistant_text = "¡Tu visita ha sido reagendada exitosamente! Te esperamos con gusto."
+            elif tool_result.lower().startswith("el horario seleccionado"):
+                booking_error_text = (
+                    "Para reagendar necesito que elijas una opcion "
+                    "de la lista enviada. Si no tienes opciones, "
+                    "dime que dias te convienen."
+                )
+        tool_outputs.append(result.as_output_item())
+
+    booking_context: Optional[str] = None
+    if booking_error_text and not booking_done:
+        assistant_text = booking_error_text
+        booking_done = True
+    if not booking_done:
+        pending_booking_text = _maybe_book_pending_selection(org=org, chat=chat)
+        if pending_booking_text:
+            assistant_text = pending_booking_text
+            booking_done = True
+        elif chat.get("_booking_context"):
+            # _maybe_book_pending_selection injected booking_context;
+            # the caller makes a targeted LLM call so it confirms naturally
+            booking_context = chat.pop("_booking_context", "")
+
+    return {
+        "tool_outputs": tool_outputs,
+        "assistant_text": assistant_text,
+        "done": booking_done,
+        "booking_context": booking_context,
+    }
+
+
+def _execute_followup_tools(
+    turn: Dict[str, Any],
+    org: Dict[str, Any],
+    chat: Dict[str, Any],
+    followup_tool_calls: List[Any],
+) -> List[Dict[str, Any]]:
+    """Execute the tool calls of a follow-up round; returns their outputs."""
+    results = tool_registry.execute(
+        followup_tool_calls, _tool_context(turn, org, chat)
+    )
+
+    followup_outputs = []
+    for tc, result in zip(followup_tool_calls, results):
+        # Track for note detection
+        turn["tool_calls"].append(tc)
+        if result.note_added:
+            turn["lead_note_added"] = True
+        followup_outputs.append(result.as_output_item())
+    return followup_outputs
+
+
+def _followup_error_text(tool_calls: List[Any]) -> str:
+    """Context-aware fallback when a follow-up model call fails."""
+    executed_tools = [t.name for t in tool_calls] if tool_calls else []
+    if "create_admissions_lead" in executed_tools:
+        return (
+            "¡Excelente! Ya quedaron registrados tus datos en admisiones. 🎉 "
+            "El siguiente paso es conocer el campus, ¿te gustaría que busque "
+            "horarios disponibles para una visita?"
+        )
+    if "book_appointment" in executed_tools or "reschedule_appointment" in executed_tools:
+        return "Tu solicitud de cita fue procesada. ¿Necesitas algo más?"
+    return _TOOL_ROUNDS_DONE_TEXT
+
+
+def _finalize_assistant_text(
+    turn: Dict[str, Any],
+    org: Dict[str, Any],
+    chat: Dict[str, Any],
+    assistant_text: str,
+) -> str:
+    """Post-model steps: auto notes, requested requirements and validation."""
+    combined_user = turn["combined_user"]
+    if not turn["lead_note_added"]:
+        _maybe_auto_add_notes(combined_user, org=org, chat=chat)
+
+    requirements_text = _maybe_send_requested_requirements(
+        combined_user=combined_user,
+        tool_calls=turn["tool_calls"],
+        org=org,
+        chat=chat,
+        session_id=turn["session_id"],
+    )
+    if requirements_text:
+        assistant_text = requirements_text
+
+    # Post-response validation: detect invented responses
+    return _validate_and_fix_response(
+        assistant_text, combined_user, turn["tool_calls"], turn["lead"], chat
+    )
+
+
+def _process_queue_impl(
+    payload: ProcessQueueRequest,
+):
+    ctx = load_turn_context(payload.chat_id)
+    _validate_turn_entities(ctx.chat, ctx.org)
+    org_cache.prime(ctx.org)
+    chat = ctx.chat
+    chat["_turn_context"] = ctx
+    lead_repo = attach_lead_repository(ctx)
+    # Batch state_context writes for the whole turn (one UPDATE at the end
+    # or at explicit checkpoints such as sending a message).
+    try:
+        with ChatStateSession(get_supabase_client(), chat):
+            return _run_turn(payload, ctx)
+    except Exception as exc:
+        sent = _reply_sent_result(chat, exc)
+        if sent is None:
+            raise
+        return sent
+    finally:
+        print("[lead-repo] turn", {"chat_id": chat.get("id"), **lead_repo.stats()})
+
+
+def _run_turn(
+    payload: ProcessQueueRequest,
+    ctx: TurnContext,
+) -> Dict[str, Any]:
+    chat, org = ctx.chat, ctx.org
+
+    # Mark last message as read and show typing indicator
+    if ctx.last_inbound_message_id:
+        send_whatsapp_read(
+            SendWhatsAppReadParams(
+                phone_number_id=org.get("phone_number_id"),
+                message_id=ctx.last_inbound_message_id,
+                typing_type="text",
+            )
+        )
+
+    turn = _prepare_turn(payload, ctx)
+    if turn.get("skip_reason"):
+        return {"status": "skipped", "reason": turn["skip_reason"]}
+    session_id = turn["session_id"]
+    if turn.get("forced_text"):
+        return _send_assistant_message(turn["forced_text"], org, chat, session_id)
 
-    model = org.get("bot_model")
-    if not isinstance(model, str) or not model.strip():
-        model = DEFAULT_MODEL
     client = get_openai_client()
     try:
-        response = client.responses.create(
-            model=model,
-            instructions=full_instructions,
-            input=input_messages,
-            tools=tools,
+        response = _call_model(
+            client, _model_request(turn, turn["input_messages"]), turn, org, chat, "turn", 0
         )
         assistant_text = response.output_text or ""
-        tool_calls = [
-            item for item in response.output
-            if item.type == "function_call"
-        ]
+        tool_calls = _function_calls(response)
     except Exception as exc:
         print(
             "[admissions] OpenAI API error",
-            {"error": str(exc), "chat_id": chat.get("id"), "model": model},
+            {"error": str(exc), "chat_id": chat.get("id"), "model": turn["model"]},
         )
         return _send_assistant_message(
-            "Disculpa, estoy teniendo dificultades técnicas en este momento. "
-            "Por favor intenta de nuevo en unos minutos, o si prefieres, "
-            "puedes llamarnos al 8711123687.",
-            org, chat, session_id,
+            _TECHNICAL_DIFFICULTIES_TEXT, org, chat, session_id
         )
     print(
         "[admissions] llm response",
         {"assistant_text": assistant_text, "tool_calls": len(tool_calls)},
     )
 
-
-    lead_note_added = False
-    booking_done = False
-    booking_error_text: Optional[str] = None
     if tool_calls:
-        # Collect tool outputs for the Responses API followup
-        tool_outputs = []
-        for tool_call in tool_calls:
-            tool_name = tool_call.name
-            tool_args_json = tool_call.arguments
-            tool_result = "No se pudo ejecutar la accion solicitada."
-            print(
-                "[admissions] tool call received",
-                {"tool_name": tool_name, "args": tool_args_json},
-            )
-            if tool_name == "create_admissions_lead":
-                try:
-                    tool_args = CreateAdmissionsLeadRequest.model_validate_json(
-                        tool_args_json
-                    )
-                    tool_result = _create_admissions_lead(
-                        tool_args, org=org, chat=chat
-                    )
-                    pending_event_id = _pop_chat_state_value(
-                        supabase, chat, "pending_event_registration"
-                    )
-                    if pending_event_id:
-                        register_text = _register_event(
-                            RegisterEventRequest(event_id=pending_event_id),
-                            org=org,
-                            chat=chat,
-                            session_id=session_id,
-                        )
-                        tool_result = f"{tool_result} {register_text}"
-                except HTTPException as exc:
-                    tool_result = f"No se pudo crear el lead: {exc.detail}"
-                except Exception:
-                    tool_result = (
-                        "No se pudo crear el lead: datos incompletos o invalidos."
-                    )
-            elif tool_name == "update_admissions_lead":
-                try:
-                    tool_args = UpdateAdmissionsLeadRequest.model_validate_json(
-                        tool_args_json
-                    )
-                    tool_result = _update_admissions_lead(
-                        tool_args, org=org, chat=chat
-                    )
-                    if tool_args.notes:
-                        lead_note_added = True
-                except HTTPException as exc:
-                    tool_result = f"No se pudo actualizar el lead: {exc.detail}"
-                except Exception:
-                    tool_result = (
-                        "No se pudo actualizar el lead: datos invalidos."
-                    )
-            elif tool_name == "add_lead_note":
-                try:
-                    tool_args = AddLeadNoteRequest.model_validate_json(
-                        tool_args_json
-                    )
-                    tool_result = _add_lead_note(
-                        tool_args, org=org, chat=chat
-                    )
-                    lead_note_added = True
-                except HTTPException as exc:
-                    tool_result = f"No se pudo agregar la nota: {exc.detail}"
-                except Exception:
-                    tool_result = "No se pudo agregar la nota al lead."
-            elif tool_name == "get_next_event":
-                try:
-                    tool_args = GetNextEventRequest.model_validate_json(
-                        tool_args_json
-                    )
-                    tool_result = _get_next_event(
-                        tool_args, org=org, chat=chat
-                    )
-                except Exception as exc:
-                    tool_result = f"Error al buscar eventos: {str(exc)}"
-            elif tool_name == "register_event":
-                try:
-                    tool_args = RegisterEventRequest.model_validate_json(
-                        tool_args_json
-                    )
-                    tool_result = _register_event(
-                        tool_args, org=org, chat=chat, session_id=session_id
-                    )
-                except Exception as exc:
-                    tool_result = f"Error al registrar evento: {str(exc)}"
-            elif tool_name == "get_admission_requirements":
-                try:
-                    tool_args = GetRequirementsRequest.model_validate_json(
-                        tool_args_json
-                    )
-                    lower_user = combined_user.lower()
-                    if not any(
-                        term in lower_user
-                        for term in [
-                            "requisito",
-                            "requisitos",
-                            "documento",
-                            "documentos",
-                            "pdf",
-                            "lista",
-                            "papeleria",
-                            "papelería",
-                            "papel",
-                        ]
-                    ):
-                        tool_result = (
-                            "Solo puedo enviar requisitos si me los solicitan. "
-                            "Si los necesitas, dimelo y con gusto te los envio."
-                        )
-                    else:
-                        tool_result = _send_requirements(
-                            tool_args, org=org, chat=chat, session_id=session_id
-                        )
-                except Exception as exc:
-                    tool_result = f"Error al enviar requisitos: {str(exc)}"
-            elif tool_name == "search_availability_slots":
-                try:
-                    tool_args = SearchSlotsRequest.model_validate_json(
-                        tool_args_json
-                    )
-                    tool_result = _search_availability_slots(
-                        tool_args, org=org, chat=chat
-                    )
-                except Exception as exc:
-                    tool_result = f"Error al buscar horarios: {str(exc)}"
-            elif tool_name == "book_appointment":
-                try:
-                    tool_args = BookAppointmentRequest.model_validate_json(
-                        tool_args_json
-                    )
-                    tool_result = _book_appointment(
-                        tool_args, org=org, chat=chat
-                    )
-                    if tool_result.lower().startswith("cita agendada exitosamente"):
-                        booking_done = True
-                        assistant_text = "¡Tu visita ha sido agendada exitosamente! Te esperamos con gusto."
-                    elif tool_result.lower().startswith("el horario seleccionado"):
-                        booking_error_text = (
-                            "Para reservar necesito que elijas una opcion "
-                            "de la lista enviada. Si no tienes opciones, "
-                            "dime que dias te convienen."
-                        )
-                except Exception as exc:
-                    tool_result = f"Error al agendar cita: {str(exc)}"
-            elif tool_name == "reschedule_appointment":
-                try:
-                    tool_args = RescheduleAppointmentRequest.model_validate_json(
-                        tool_args_json
-                    )
-                    tool_result = _reschedule_appointment(
-                        tool_args, org=org, chat=chat
-                    )
-                    if tool_result.lower().startswith("cita reagendada exitosamente"):
-                        booking_done = True
-                        assistant_text = "¡Tu visita ha sido reagendada exitosamente! Te esperamos con gusto."
-                    elif tool_result.lower().startswith("el horario seleccionado"):
-                        booking_error_text = (
-                            "Para reagendar necesito que elijas una opcion "
-                            "de la lista enviada. Si no tienes opciones, "
-                            "dime que dias te convienen."
-                        )
-                except Exception as exc:
-                    tool_result = f"Error al reagendar cita: {str(exc)}"
-            elif tool_name == "cancel_appointment":
-                try:
-                    tool_args = CancelAppointmentRequest.model_validate_json(
-                        tool_args_json
-                    )
-                    tool_result = _cancel_appointment(
-                        tool_args, org=org, chat=chat
-                    )
-                except Exception as exc:
-                    tool_result = f"Error al cancelar cita: {str(exc)}"
-            elif tool_name == "close_chat_session":
-                try:
-                    tool_args = CloseChatSessionRequest.model_validate_json(
-                        tool_args_json
-                    )
-                    tool_result = _close_chat_session(
-                        tool_args, org=org, chat=chat, session_id=session_id
-                    )
-                except Exception as exc:
-                    tool_result = f"Error al cerrar la sesión: {str(exc)}"
-            elif tool_name == "get_lead_status":
-                try:
-                    tool_args = GetLeadStatusRequest.model_validate_json(
-                        tool_args_json
-                    )
-                    tool_result = _get_lead_status(
-                        tool_args, org=org, chat=chat
-                    )
-                except Exception as exc:
-                    tool_result = f"Error al consultar estado: {str(exc)}"
-
-            print(
-                "[admissions] tool result",
-                {"tool_name": tool_name, "result": tool_result},
-            )
-            tool_outputs.append({
-                "type": "function_call_output",
-                "call_id": tool_call.call_id,
-                "output": tool_result,
-            })
-        if booking_error_text and not booking_done:
-            assistant_text = booking_error_text
-            booking_done = True
-        if not booking_done:
-            pending_booking_text = _maybe_book_pending_selection(org=org, chat=chat)
-            if pending_booking_text:
-                assistant_text = pending_booking_text
-                booking_done = True
-            elif chat.get("_booking_context"):
-                # _maybe_book_pending_selection injected booking_context
-                # Make a targeted LLM call with booking context so it confirms naturally
-                booking_ctx = chat.pop("_booking_context", "")
-                followup_instructions = full_instructions + "\n\n" + booking_ctx
-                try:
-                    followup = client.responses.create(
-                        model=model,
-                        instructions=followup_instructions,
-                        input=input_messages + list(response.output) + tool_outputs,
-                    )
-                    assistant_text = followup.output_text or ""
-                except Exception:
-                    # If LLM fails, use a simple confirmation
-                    assistant_text = (
-                        "¡Excelente! Ya quedaron registrados tus datos y tu visita fue agendada. "
-                        "Te esperamos. 😊"
-                    )
-                booking_done = True
-        if not booking_done:
-            # ── Build tool dispatch table for followup rounds ──
-            tool_dispatch = {
-                "create_admissions_lead": (
-                    CreateAdmissionsLeadRequest,
-                    lambda args: _create_admissions_lead(args, org=org, chat=chat),
-                ),
-                "update_admissions_lead": (
-                    UpdateAdmissionsLeadRequest,
-                    lambda args: _update_admissions_lead(args, org=org, chat=chat),
-                ),
-                "add_lead_note": (
-                    AddLeadNoteRequest,
-                    lambda args: _add_lead_note(args, org=org, chat=chat),
-                ),
-                "get_next_event": (
-                    GetNextEventRequest,
-                    lambda args: _get_next_event(args, org=org, chat=chat),
-                ),
-                "register_event": (
-                    RegisterEventRequest,
-                    lambda args: _register_event(args, org=org, chat=chat, session_id=session_id),
-                ),
-                "get_admission_requirements": (
-                    GetRequirementsRequest,
-                    lambda args: _send_requirements(args, org=org, chat=chat, session_id=session_id),
-                ),
-                "search_availability_slots": (
-                    SearchSlotsRequest,
-                    lambda args: _search_availability_slots(args, org=org, chat=chat),
-                ),
-                "book_appointment": (
-                    BookAppointmentRequest,
-                    lambda args: _book_appointment(args, org=org, chat=chat),
-                ),
-                "reschedule_appointment": (
-                    RescheduleAppointmentRequest,
-                    lambda args: _reschedule_appointment(args, org=org, chat=chat),
-                ),
-                "cancel_appointment": (
-                    CancelAppointmentRequest,
-                    lambda args: _cancel_appointment(args, org=org, chat=chat),
-                ),
-                "close_chat_session": (
-                    CloseChatSessionRequest,
-                    lambda args: _close_chat_session(args, org=org, chat=chat, session_id=session_id),
-                ),
-                "get_lead_status": (
-                    GetLeadStatusRequest,
-                    lambda args: _get_lead_status(args, org=org, chat=chat),
-                ),
-            }
-
+        outcome = _execute_first_round_tools(
+            turn, org, chat, tool_calls, assistant_text
+        )
+        assistant_text = outcome["assistant_text"]
+        accumulated_input = (
+            turn["input_messages"] + list(response.output) + outcome["tool_outputs"]
+        )
+        if outcome["booking_context"]:
+            # Make a targeted LLM call with booking context so it confirms naturally
+            try:
+                followup = _call_model(
+                    client,
+                    _model_request(
+                        turn,
+                        accumulated_input,
+                        with_tools=False,
+                        extra_instructions=outcome["booking_context"],
+                    ),
+                    turn,
+                    org,
+                    chat,
+                    "booking_confirmation",
+                    1,
+                )
+                assistant_text = followup.output_text or ""
+            except Exception:
+                # If LLM fails, use a simple confirmation
+                assistant_text = _BOOKING_CONFIRMATION_FALLBACK_TEXT
+        elif not outcome["done"]:
             # ── Agentic loop: keep executing tools until model responds ──
-            MAX_TOOL_ROUNDS = 5
-            accumulated_input = input_messages + list(response.output) + tool_outputs
             for round_idx in range(MAX_TOOL_ROUNDS):
                 try:
-                    followup = client.responses.create(
-                        model=model,
-                        instructions=full_instructions,
-                        input=accumulated_input,
-                        tools=tools,
+                    followup = _call_model(
+                        client,
+                        _model_request(turn, accumulated_input),
+                        turn,
+                        org,
+                        chat,
+                        "tool_followup",
+                        round_idx + 1,
                     )
                 except Exception as exc:
                     print(
                         "[admissions] OpenAI followup error",
                         {"error": str(exc), "round": round_idx, "chat_id": chat.get("id")},
                     )
-                    # Context-aware fallback
-                    executed_tools = [t.name for t in tool_calls] if tool_calls else []
-                    if "create_admissions_lead" in executed_tools:
-                        assistant_text = (
-                            "¡Excelente! Ya quedaron registrados tus datos en admisiones. 🎉 "
-                            "El siguiente paso es conocer el campus, ¿te gustaría que busque "
-                            "horarios disponibles para una visita?"
-                        )
-                    elif "book_appointment" in executed_tools or "reschedule_appointment" in executed_tools:
-                        assistant_text = "Tu solicitud de cita fue procesada. ¿Necesitas algo más?"
-                    else:
-                        assistant_text = "Tu solicitud fue procesada correctamente. ¿En qué más puedo ayudarte?"
+                    assistant_text = _followup_error_text(turn["tool_calls"])
                     break
 
-                followup_tool_calls = [
-                    item for item in followup.output if item.type == "function_call"
-                ]
+                followup_tool_calls = _function_calls(followup)
 
                 if not followup_tool_calls:
                     # Model produced text — we're done
@@ -2510,66 +2609,24 @@ def _process_queue_impl(
                     "[admissions] followup tool round",
                     {"round": round_idx + 1, "tools": [t.name for t in followup_tool_calls]},
                 )
-                followup_outputs = []
-                for tc in followup_tool_calls:
-                    tool_name = tc.name
-                    tool_args_json = tc.arguments
-                    tool_result = "No se pudo ejecutar la accion solicitada."
-                    if tool_name in tool_dispatch:
-                        request_cls, handler = tool_dispatch[tool_name]
-                        try:
-                            parsed_args = request_cls.model_validate_json(tool_args_json)
-                            tool_result = handler(parsed_args)
-                        except Exception as tool_exc:
-                            tool_result = f"Error ejecutando {tool_name}: {tool_exc}"
-                    print(
-                        f"[admissions] tool call received",
-                        {"tool_name": tool_name, "args": tool_args_json[:120]},
-                    )
-                    print(
-                        f"[admissions] tool result",
-                        {"tool_name": tool_name, "result": tool_result[:200]},
-                    )
-                    # Track for note detection
-                    tool_calls.append(tc)
-                    if tool_name in ("add_lead_note", "update_admissions_lead"):
-                        lead_note_added = True
-
-                    followup_outputs.append({
-                        "type": "function_call_output",
-                        "call_id": tc.call_id,
-                        "output": tool_result,
-                    })
+                followup_outputs = _execute_followup_tools(
+                    turn, org, chat, followup_tool_calls
+                )
 
                 # Extend accumulated input for next round
                 accumulated_input = accumulated_input + list(followup.output) + followup_outputs
             else:
                 # Exhausted all rounds without getting text
                 print("[admissions] WARNING: exhausted tool rounds without text response")
-                assistant_text = "Tu solicitud fue procesada correctamente. ¿En qué más puedo ayudarte?"
-
-    if not lead_note_added:
-        _maybe_auto_add_notes(combined_user, org=org, chat=chat)
+                assistant_text = _TOOL_ROUNDS_DONE_TEXT
 
-    requirements_text = _maybe_send_requested_requirements(
-        combined_user=combined_user,
-        tool_calls=tool_calls,
-        org=org,
-        chat=chat,
-        session_id=session_id,
-    )
-    if requirements_text:
-        assistant_text = requirements_text
-
-    # Post-response validation: detect invented responses
-    assistant_text = _validate_and_fix_response(
-        assistant_text, combined_user, tool_calls, lead, chat
-    )
+    assistant_text = _finalize_assistant_text(turn, org, chat, assistant_text)
 
     return _send_assistant_message(assistant_text, org, chat, session_id)
 
 
 
+@invalidates_leads
 def _cancel_appointment(
     request: CancelAppointmentRequest,
     org: Dict[str, Any],
@@ -2579,7 +2636,7 @@ def _cancel_appointment(
     print(f"[admissions] cancelling appointment, reason: {request.cancellation_reason}")
     
     # 1. Find leads for this chat
-    leads = _get_leads_by_chat(supabase, org.get("id"), chat.get("id"))
+    leads = _get_leads_by_chat(supabase, org.get("id"), chat.get("id"), chat=chat)
     if not leads:
         return "No encontré un lead activo para cancelar cita."
     
@@ -2614,6 +2671,7 @@ def _cancel_appointment(
     cancel_row = _first_response_row(cancel_response)
     if get_supabase_error(cancel_response) or not cancel_row or not cancel_row.get("success"):
         return (cancel_row or {}).get("message") or "No se pudo cancelar la cita."
+    slot_calendar.invalidate(org.get("id"))
 
     # 4. Update leads status back to contacted (ALL associated leads)
     supabase.from_("leads").update({
@@ -2626,6 +2684,7 @@ def _cancel_appointment(
     return "Cita cancelada exitosamente. El lead ha sido actualizado. Intenta convencer al usuario de agendar otra visita preguntando qué fechas le convendrían mejor."
 
 
+@invalidates_leads
 def _reschedule_appointment(
     request: RescheduleAppointmentRequest,
     org: Dict[str, Any],
@@ -2641,7 +2700,7 @@ def _reschedule_appointment(
         return "El horario seleccionado no es valido. Indica el numero de la opcion."
 
     lead = _get_lead_by_chat(
-        supabase, org.get("id"), chat.get("id"), wa_id=chat.get("wa_id")
+        supabase, org.get("id"), chat.get("id"), wa_id=chat.get("wa_id"), chat=chat
     )
     if not _slot_id_allowed(request.slot_id, lead, chat):
         return "El horario seleccionado no corresponde a las opciones enviadas. Elige una opcion de la lista."
@@ -2650,12 +2709,14 @@ def _reschedule_appointment(
     if not appointment:
         return "No encontré una cita activa para reagendar. Primero necesitamos agendar una visita."
 
+    # Moves the appointment and updates every sibling lead in one transaction
     response = supabase.rpc(
-        "reschedule_admission_appointment",
+        "reschedule_family_appointment",
         {
             "p_org_id": org.get("id"),
             "p_appointment_id": appointment.get("id"),
             "p_new_slot_id": request.slot_id,
+            "p_lead_ids": [row.get("id") for row in leads if row.get("id")],
             "p_notes": request.notes,
             "p_type": "Campus visit",
         },
@@ -2665,13 +2726,7 @@ def _reschedule_appointment(
         return "Error al reagendar la cita en base de datos."
     if not result.get("success"):
         return result.get("message") or "El nuevo horario ya no está disponible."
-
-    for lead_row in leads:
-        lead_id = lead_row.get("id")
-        if lead_id:
-            supabase.from_("leads").update(
-                {"status": "visit_scheduled", "updated_at": datetime.utcnow().isoformat()}
-            ).eq("id", lead_id).execute()
+    slot_calendar.invalidate(org.get("id"))
 
     _clear_slot_options(supabase, lead, chat)
     _pop_chat_state_value(supabase, chat, "pending_slot_option")
@@ -2721,71 +2776,15 @@ def _search_availability_slots(
     # Don't allow same-day bookings
     if start_dt.date() <= today:
         start_dt = datetime(today.year, today.month, today.day) + timedelta(days=1)
-    request_start = start_dt.strftime("%Y-%m-%d")
 
-    # Query all active slots in the date range
-    response = (
-        supabase.from_("availability_slots")
-        .select("id, starts_at, ends_at, max_appointments, appointments_count")
-        .eq("organization_id", org.get("id"))
-        .eq("is_active", True)
-        .eq("is_blocked", False)
-        .gte("starts_at", request_start)
-        .lte("ends_at", f"{request_end} 23:59:59")
-        .order("starts_at", desc=False)
-        .execute()
+    # Bookable slots (filtered by the search_availability_slots RPC) from
+    # the per-org in-memory calendar; ranges beyond its horizon call the RPC.
+    available_slots = slot_calendar.search(
+        org.get("id"), start_dt.date(), end_dt.date(), request.preferred_time
     )
     
-    slots = get_supabase_data(response) or []
-    
-    # Torreón timezone offset (UTC-6, no DST in Coahuila)
-    utc_offset = timedelta(hours=-6)
-    
-    # Business hours: 8:00 AM - 3:00 PM local time
-    BUSINESS_HOUR_START = 8   # 8:00 AM
-    BUSINESS_HOUR_END = 15    # 3:00 PM
-    
-    # Morning/afternoon split at noon
-    MORNING_END = 12   # 12:00 PM
-    AFTERNOON_START = 12  # 12:00 PM
-    
-    available_slots = []
-    for slot in slots:
-        # Check capacity
-        count = slot.get("appointments_count", 0)
-        max_app = slot.get("max_appointments", 1)
-        if count >= max_app:
-            continue
-        
-        # Parse start time and convert to local
-        starts_at = slot.get("starts_at")
-        if not starts_at:
-            continue
-        try:
-            start_utc = datetime.fromisoformat(starts_at.replace("+00", "+00:00"))
-            start_local = start_utc + utc_offset
-        except (ValueError, AttributeError):
-            continue
-        
-        # Exclude weekends (Saturday=5, Sunday=6)
-        if start_local.weekday() >= 5:
-            continue
-        
-        # Exclude outside business hours
-        if start_local.hour < BUSINESS_HOUR_START or start_local.hour >= BUSINESS_HOUR_END:
-            continue
-        
-        # Apply preferred_time filter
-        preferred = (request.preferred_time or "").lower().strip()
-        if preferred == "morning" and start_local.hour >= MORNING_END:
-            continue
-        if preferred == "afternoon" and start_local.hour < AFTERNOON_START:
-            continue
-        
-        available_slots.append(slot)
-    
     lead = _get_lead_by_chat(
-        supabase, org.get("id"), chat.get("id"), wa_id=chat.get("wa_id")
+        supabase, org.get("id"), chat.get("id"), wa_id=chat.get("wa_id"), chat=chat
     )
 
     if not available_slots:
@@ -2853,6 +2852,7 @@ def _search_availability_slots(
     return result_text
 
 
+@invalidates_leads
 def _book_appointment(
     request: BookAppointmentRequest,
     org: Dict[str, Any],
@@ -2868,7 +2868,7 @@ def _book_appointment(
         return "El horario seleccionado no es valido. Indica el numero de la opcion."
 
     lead = _get_lead_by_chat(
-        supabase, org.get("id"), chat.get("id"), wa_id=chat.get("wa_id")
+        supabase, org.get("id"), chat.get("id"), wa_id=chat.get("wa_id"), chat=chat
     )
     if not _slot_id_allowed(request.slot_id, lead, chat):
         return "El horario seleccionado no corresponde a las opciones enviadas. Elige una opcion de la lista."
@@ -2886,19 +2886,19 @@ def _book_appointment(
         lead = get_supabase_data(lead_response)
     # If multiple leads, we use the primary (first/latest) for the actual appointment record
     # but update status for all.
-    leads = _get_leads_by_chat(supabase, org.get("id"), chat.get("id"), wa_id=chat.get("wa_id"))
+    leads = _get_leads_by_chat(supabase, org.get("id"), chat.get("id"), wa_id=chat.get("wa_id"), chat=chat)
     
     if not leads:
         return "No encontre un lead activo para agendar. Crea el lead primero."
     
-    primary_lead = leads[0]
-    lead_id = primary_lead.get("id")
-
+    # The appointment belongs to the primary (first/latest) lead; the RPC
+    # marks every sibling as visit_scheduled and notes the shared visit on
+    # the others, in the same transaction as the booking.
     booking_response = supabase.rpc(
-        "book_admission_appointment",
+        "book_family_appointment",
         {
             "p_org_id": org.get("id"),
-            "p_lead_id": lead_id,
+            "p_lead_ids": [l.get("id") for l in leads if l.get("id")],
             "p_slot_id": request.slot_id,
             "p_notes": request.notes or "Agendado via WhatsApp Bot",
             "p_type": "Campus visit",
@@ -2910,24 +2910,7 @@ def _book_appointment(
         return "Error al crear la cita en base de datos."
     if not booking_row.get("success"):
         return booking_row.get("message") or "El horario seleccionado ya no está disponible."
-
-    # 2. Update Lead Status (For ALL leads sharing this contact)
-    for l in leads:
-        lid = l.get("id")
-        # Update status
-        supabase.from_("leads").update(
-            {"status": "visit_scheduled", "updated_at": datetime.utcnow().isoformat()}
-        ).eq("id", lid).execute()
-        
-        # Add a note explaining the shared visit if it's not the primary one
-        if lid != lead_id:
-             _append_lead_note(
-                supabase,
-                l,
-                org.get("id"),
-                f"Visita agendada (compartida con lead {primary_lead.get('lead_number')}) para {booking_row.get('starts_at')}",
-                subject="Cita Agendada"
-            )
+    slot_calendar.invalidate(org.get("id"))
 
     return "Cita agendada exitosamente. El lead (y hermanos) ha sido actualizado a 'visit_scheduled'."
 
@@ -2973,7 +2956,7 @@ def _get_next_event(
     )
 
     lead = _get_lead_by_chat(
-        supabase, org.get("id"), chat.get("id"), wa_id=chat.get("wa_id")
+        supabase, org.get("id"), chat.get("id"), wa_id=chat.get("wa_id"), chat=chat
     )
     if lead and lead.get("id") and event_id:
         attendance_response = (
@@ -3008,6 +2991,7 @@ def _get_next_event(
     )
 
 
+@invalidates_leads
 def _register_event(
     request: RegisterEventRequest,
     org: Dict[str, Any],
@@ -3021,7 +3005,7 @@ def _register_event(
         return "No tengo un evento seleccionado para registrar."
 
     lead = _get_lead_by_chat(
-        supabase, org.get("id"), chat.get("id"), wa_id=chat.get("wa_id")
+        supabase, org.get("id"), chat.get("id"), wa_id=chat.get("wa_id"), chat=chat
     )
     if not lead or not lead.get("id"):
         _set_chat_state_value(supabase, chat, "pending_event_registration", event_id)
@@ -3106,33 +3090,21 @@ def _send_event_document(
         return "No pude adjuntar el documento del evento por configuracion incompleta."
 
     try:
-        file_bytes = supabase.storage.from_(bucket).download(file_path)
-    except Exception:
-        return "No pude descargar el documento del evento."
-
-    try:
-        import base64
-
-        media_b64 = base64.b64encode(file_bytes).decode("utf-8")
-        upload_params = UploadWhatsAppMediaParams(
+        # Reuses the WhatsApp media id while the document is unchanged
+        upload_result, send_result = send_storage_document(
+            supabase,
             phone_number_id=org.get("phone_number_id"),
-            media_base64=media_b64,
+            to=chat.get("wa_id"),
+            bucket=bucket,
+            path=file_path,
             mime_type=mime_type,
             file_name=file_name,
+            caption="Documento del evento",
         )
-        upload_result = upload_whatsapp_media(upload_params)
         if upload_result.error or not upload_result.media_id:
             return "No pude subir el documento del evento a WhatsApp."
 
         media_id = upload_result.media_id
-        send_params = SendWhatsAppDocumentParams(
-            phone_number_id=org.get("phone_number_id"),
-            to=chat.get("wa_id"),
-            media_id=media_id,
-            file_name=file_name,
-            caption="Documento del evento",
-        )
-        send_result = send_whatsapp_document(send_params)
         message_payload = {
             "chat_id": chat.get("id"),
             "chat_session_id": session_id,
@@ -3206,44 +3178,27 @@ def _send_requirements(
     if not file_path or not bucket:
         return "Error de configuracion: falta bucket o path del archivo."
 
-    # 2. Download file from Supabase Storage
-    try:
-        print(f"[admissions] downloading {file_path} from {bucket}")
-        file_bytes = supabase.storage.from_(bucket).download(file_path)
-    except Exception as exc:
-        print(f"[admissions] storage download error: {exc}")
-        return "No se pudo descargar el documento de requisitos."
-        
-    # 3. Upload to WhatsApp
+    # 2. Upload to WhatsApp (cached media id while the PDF is unchanged)
+    #    and send the document to the user
     try:
-        import base64
-        media_b64 = base64.b64encode(file_bytes).decode("utf-8")
-        
-        upload_params = UploadWhatsAppMediaParams(
+        upload_result, send_result = send_storage_document(
+            supabase,
             phone_number_id=org.get("phone_number_id"),
-            media_base64=media_b64,
+            to=chat.get("wa_id"),
+            bucket=bucket,
+            path=file_path,
             mime_type="application/pdf",
             file_name=file_name,
+            caption=f"Requisitos de admisión para {division.replace('_', ' ').title()}",
         )
-        upload_result = upload_whatsapp_media(upload_params)
-        
+
         if upload_result.error or not upload_result.media_id:
             print(f"[admissions] whatsapp upload error: {upload_result.error}")
             return "Error al subir el documento a WhatsApp."
-            
+
         media_id = upload_result.media_id
-        
-        # 4. Send Document to User
-        send_params = SendWhatsAppDocumentParams(
-            phone_number_id=org.get("phone_number_id"),
-            to=chat.get("wa_id"),
-            media_id=media_id,
-            file_name=file_name,
-            caption=f"Requisitos de admisión para {division.replace('_', ' ').title()}",
-        )
-        send_result = send_whatsapp_document(send_params)
-        
-        # 5. Log Outbound Message
+
+        # 3. Log Outbound Message
         message_payload = {
             "chat_id": chat.get("id"),
             "chat_session_id": session_id,
@@ -3277,6 +3232,36 @@ def _send_requirements(
         return "Error inesperado al enviar requisitos."
 
 
+_REQUIREMENTS_REQUEST_TERMS = (
+    "requisito",
+    "requisitos",
+    "documento",
+    "documentos",
+    "pdf",
+    "lista",
+    "papeleria",
+    "papelería",
+    "papel",
+)
+
+
+def _send_requirements_if_requested(
+    request: GetRequirementsRequest,
+    org: Dict[str, Any],
+    chat: Dict[str, Any],
+    session_id: str,
+    combined_user: str,
+) -> str:
+    """Tool handler: only send the PDF when the user asked for it."""
+    lower_user = combined_user.lower()
+    if not any(term in lower_user for term in _REQUIREMENTS_REQUEST_TERMS):
+        return (
+            "Solo puedo enviar requisitos si me los solicitan. "
+            "Si los necesitas, dimelo y con gusto te los envio."
+        )
+    return _send_requirements(request, org=org, chat=chat, session_id=session_id)
+
+
 @router.get("/chats/{chat_id}/history", dependencies=[Depends(require_api_key)])
 def get_chat_history_endpoint(chat_id: str):
     """
@@ -3498,10 +3483,18 @@ def close_chat_session_endpoint(request: CloseChatSessionEndpointRequest):
         ]
         client = get_openai_client()
         try:
-            summary_resp = client.responses.create(
-                model=request.model,
-                instructions=summary_instructions,
-                input=summary_input,
+            summary_resp = _call_model(
+                client,
+                {
+                    "model": request.model,
+                    "instructions": summary_instructions,
+                    "input": summary_input,
+                },
+                {"session_id": session_id, "model": request.model},
+                {"id": request.org_id},
+                {"id": request.chat_id},
+                "session_summary",
+                0,
             )
             summary = summary_resp.output_text or ""
         except Exception as exc:
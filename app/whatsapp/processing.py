@@ -1,6 +1,7 @@
 from datetime import datetime, timezone
+import hashlib
 import time
-from typing import Any, Dict, Optional, Set
+from typing import Any, Dict, Optional, Set, Tuple
 
 from app.core.config import settings
 from app.core.supabase import (
@@ -9,22 +10,22 @@ from app.core.supabase import (
     get_supabase_error,
     reset_supabase_client,
 )
+from app.whatsapp.chat_lock import chat_turn_lock
+from app.whatsapp.debounce import debounce_scheduler
+from app.whatsapp.fanout import chat_fanout
 from app.whatsapp.media import MediaDownloadError, download_whatsapp_media
-from app.whatsapp.storage import upload_to_storage
+from app.whatsapp.media_pipeline import MediaTransfer, media_pipeline
+from app.whatsapp.org_cache import org_cache
+from app.whatsapp.storage import (
+    content_addressed_path,
+    find_media_object,
+    get_public_media_url,
+    is_duplicate_object_error,
+    register_media_object,
+    upload_to_storage,
+)
 
-
-def _get_public_media_url(path: str) -> Optional[str]:
-    supabase = get_supabase_client()
-    bucket = settings.supabase_storage_bucket
-    response = supabase.storage.from_(bucket).get_public_url(path)
-    if isinstance(response, dict):
-        return response.get("publicURL") or response.get("publicUrl")
-    if hasattr(response, "get"):
-        try:
-            return response.get("publicURL") or response.get("publicUrl")
-        except Exception:
-            return None
-    return None
+_get_public_media_url = get_public_media_url
 
 
 def handle_incoming_messages(value: Dict[str, Any]) -> None:
@@ -47,6 +48,149 @@ def handle_incoming_messages(value: Dict[str, Any]) -> None:
                 raise
 
 
+def _media_fields(
+    message: Dict[str, Any],
+) -> Tuple[Optional[str], Optional[str], Optional[str], Optional[str]]:
+    """(media_id, mime_type, file_name, caption) for image/document/audio."""
+    message_type = message.get("type")
+    if message_type == "image" and message.get("image", {}).get("id"):
+        image = message.get("image", {})
+        return image.get("id"), image.get("mime_type"), None, image.get("caption")
+    if message_type == "document" and message.get("document", {}).get("id"):
+        document = message.get("document", {})
+        return document.get("id"), document.get("mime_type"), document.get("filename"), None
+    if message_type == "audio" and message.get("audio", {}).get("id"):
+        audio = message.get("audio", {})
+        return audio.get("id"), audio.get("mime_type"), None, None
+    return None, None, None, None
+
+
+def _build_ingest_row(
+    message: Dict[str, Any],
+    contacts_by_wa_id: Dict[str, Dict[str, Any]],
+    default_contact: Optional[Dict[str, Any]],
+) -> Optional[Dict[str, Any]]:
+    """Row for ``ingest_whatsapp_messages`` (one per inbound message)."""
+    contact = contacts_by_wa_id.get(message.get("from") or "") or default_contact
+    wa_id = None
+    name = None
+    if contact and isinstance(contact, dict):
+        wa_id = contact.get("wa_id")
+        name = (contact.get("profile") or {}).get("name")
+    wa_id = wa_id or message.get("from") or ""
+    name = name or wa_id
+
+    if not wa_id:
+        print("Missing waId in incoming message")
+        return None
+    print("[whatsapp] incoming message", {"wa_id": wa_id, "type": message.get("type")})
+
+    media_id, media_mime, media_file_name, media_caption = _media_fields(message)
+    message_body = (
+        (message.get("text") or {}).get("body")
+        or media_caption
+        or media_file_name
+        or ("Mensaje de voz" if message.get("audio") else None)
+        or "[Media/Other]"
+    )
+
+    message_timestamp_ms = (
+        int(message.get("timestamp")) * 1000
+        if message.get("timestamp")
+        else int(datetime.utcnow().timestamp() * 1000)
+    )
+    message_timestamp_iso = datetime.fromtimestamp(
+        message_timestamp_ms / 1000, tz=timezone.utc
+    ).isoformat()
+
+    return {
+        "wa_id": wa_id,
+        "name": name,
+        "wa_message_id": message.get("id"),
+        "body": message_body,
+        "type": message.get("type"),
+        "payload": {
+            **message,
+            "media_id": media_id,
+            "media_mime_type": media_mime,
+            "media_file_name": media_file_name,
+            "media_caption": media_caption,
+            "voice": (message.get("audio") or {}).get("voice"),
+            "conversation_id": None,
+        },
+        "wa_timestamp": message_timestamp_iso,
+        "media_id": media_id,
+        "media_mime_type": media_mime,
+        "media_file_name": media_file_name,
+    }
+
+
+def _store_inbound_media(
+    stored: Dict[str, Any],
+    row: Dict[str, Any],
+) -> None:
+    """Download media for a newly stored message and attach its storage URL.
+
+    Objects are content-addressed: a file already stored (same SHA-256) is
+    not uploaded again and the message points at the shared object.
+    """
+    media_id = row.get("media_id")
+    try:
+        file_bytes, mime_type = download_whatsapp_media(media_id)
+        if not file_bytes:
+            return
+        mime_type = mime_type or row.get("media_mime_type")
+        sha256 = hashlib.sha256(file_bytes).hexdigest()
+        try:
+            media_path = find_media_object(sha256)
+        except Exception as exc:
+            # Upload instead; a duplicate object is recognised by Storage.
+            print("Media object lookup error (inbound media):", exc)
+            media_path = None
+        if not media_path:
+            storage_path = content_addressed_path(
+                sha256, mime_type, row.get("media_file_name")
+            )
+            try:
+                stored_path, storage_error = upload_to_storage(
+                    file_bytes=file_bytes,
+                    path=storage_path,
+                    content_type=mime_type,
+                )
+            except Exception as exc:
+                stored_path, storage_error = None, exc
+            if storage_error and not is_duplicate_object_error(storage_error):
+                print("Storage upload error (inbound media):", storage_error)
+                _set_media_status(stored, "failed")
+                return
+            media_path = stored_path or storage_path
+            try:
+                register_media_object(sha256, media_path, len(file_bytes), mime_type)
+            except Exception as exc:
+                # Only deduplication of later copies is lost.
+                print("Media object index error (inbound media):", exc)
+        media_url = _get_public_media_url(media_path) or media_path
+    except MediaDownloadError as exc:
+        print("Error downloading/uploading inbound media:", exc)
+        _set_media_status(stored, "failed")
+        return
+
+    get_supabase_client().from_("messages").update(
+        {
+            "media_path": media_path,
+            "media_url": media_url,
+            "media_sha256": sha256,
+            "media_status": "ready",
+        }
+    ).eq("id", stored.get("id")).execute()
+
+
+def _set_media_status(stored: Dict[str, Any], status: str) -> None:
+    get_supabase_client().from_("messages").update(
+        {"media_status": status}
+    ).eq("id", stored.get("id")).execute()
+
+
 def _handle_incoming_messages_impl(value: Dict[str, Any]) -> None:
     print("[whatsapp] webhook payload received")
     messages = list(value.get("messages") or [])
@@ -54,7 +198,9 @@ def _handle_incoming_messages_impl(value: Dict[str, Any]) -> None:
         print("[whatsapp] no messages in payload")
         return
 
-    contact = value.get("contacts", [None])[0]
+    contacts = [item for item in value.get("contacts") or [] if isinstance(item, dict)]
+    contacts_by_wa_id = {item["wa_id"]: item for item in contacts if item.get("wa_id")}
+    default_contact = contacts[0] if contacts else None
     metadata = value.get("metadata") or {}
     phone_number = metadata.get("display_phone_number")
     phone_number_id = metadata.get("phone_number_id")
@@ -64,18 +210,9 @@ def _handle_incoming_messages_impl(value: Dict[str, Any]) -> None:
     )
 
     supabase = get_supabase_client()
-    org_response = (
-        supabase.from_("organizations")
-        .select("id, name")
-        .eq("phone_number_id", phone_number_id)
-        .limit(1)
-        .execute()
-    )
-    org_error = get_supabase_error(org_response)
-    org_rows = get_supabase_data(org_response) or []
-    org_data = org_rows[0] if org_rows else None
+    org_data = org_cache.get_by_phone_number_id(phone_number_id)
 
-    if org_error or not org_data:
+    if not org_data:
         print("Organization not found for phone_number_id:", phone_number_id)
         return
     print("[whatsapp] org resolved", {"org_id": org_data.get("id")})
@@ -85,236 +222,109 @@ def _handle_incoming_messages_impl(value: Dict[str, Any]) -> None:
         key=lambda item: int(item.get("timestamp") or 0),
     )
 
-    chats_to_process: Set[str] = set()
-
-    for message in ordered_messages:
-        wa_id = None
-        if contact and isinstance(contact, dict):
-            wa_id = contact.get("wa_id")
-        wa_id = wa_id or message.get("from") or ""
-        name = None
-        if contact and isinstance(contact, dict):
-            profile = contact.get("profile") or {}
-            name = profile.get("name")
-        name = name or wa_id
-
-        if not wa_id:
-            print("Missing waId in incoming message")
-            continue
-        print("[whatsapp] incoming message", {"wa_id": wa_id, "type": message.get("type")})
-
-        upsert_response = (
-            supabase.from_("chats")
-            .upsert(
-                {
-                    "wa_id": wa_id,
-                    "name": name,
-                    "phone_number": phone_number,
-                    "organization_id": org_data["id"],
-                    "updated_at": datetime.utcnow().isoformat(),
-                },
-                on_conflict="wa_id,organization_id",
-            )
-            .execute()
+    rows = [
+        row
+        for row in (
+            _build_ingest_row(message, contacts_by_wa_id, default_contact)
+            for message in ordered_messages
         )
-        upsert_error = get_supabase_error(upsert_response)
-        if upsert_error:
-            print("Error upserting chat:", upsert_error)
-            continue
+        if row
+    ]
+    if not rows:
+        return
 
-        chat_response = (
-            supabase.from_("chats")
-            .select("*")
-            .eq("wa_id", wa_id)
-            .eq("organization_id", org_data["id"])
-            .limit(1)
-            .execute()
-        )
-        chat_error = get_supabase_error(chat_response)
-        chat_rows = get_supabase_data(chat_response) or []
-        chat_data = chat_rows[0] if chat_rows else None
+    ingest_response = supabase.rpc(
+        "ingest_whatsapp_messages",
+        {
+            "p_organization_id": org_data["id"],
+            "p_phone_number": phone_number,
+            "p_messages": rows,
+        },
+    ).execute()
+    ingest_error = get_supabase_error(ingest_response)
+    if ingest_error:
+        print("Error ingesting messages:", ingest_error, {"messages": len(rows)})
+        return
 
-        if chat_error or not chat_data:
-            print("Error fetching chat after upsert:", chat_error)
-            continue
+    result = get_supabase_data(ingest_response) or {}
+    stored_messages = result.get("messages") or []
+    chats_to_process: Set[str] = set(result.get("chat_ids") or [])
+    print(
+        "[whatsapp] messages stored",
+        {
+            "received": len(rows),
+            "stored": len(stored_messages),
+            "duplicates": len(rows) - len(stored_messages),
+            "chats": len(chats_to_process),
+        },
+    )
 
-        chat_id = chat_data.get("id")
-        if not chat_id:
-            print("Missing chat id after upsert")
+    # Media is downloaded only for messages that were actually new, in the
+    # background media pipeline (inline when it is not running).
+    rows_by_wa_id = {row["wa_message_id"]: row for row in rows if row.get("wa_message_id")}
+    for stored in stored_messages:
+        row = rows_by_wa_id.get(stored.get("wa_message_id"))
+        if not row or not row.get("media_id"):
             continue
-        print("[whatsapp] chat resolved", {"chat_id": chat_id})
-
-        media_url: Optional[str] = None
-        media_path: Optional[str] = None
-
-        is_image = message.get("type") == "image" and message.get("image", {}).get(
-            "id"
-        )
-        is_document = message.get("type") == "document" and message.get(
-            "document", {}
-        ).get("id")
-        is_audio = message.get("type") == "audio" and message.get("audio", {}).get(
-            "id"
-        )
-
-        media_id = None
-        media_mime = None
-        media_file_name = None
-        media_caption = None
-
-        if is_image:
-            media_id = message.get("image", {}).get("id")
-            media_mime = message.get("image", {}).get("mime_type")
-            media_caption = message.get("image", {}).get("caption")
-        elif is_document:
-            media_id = message.get("document", {}).get("id")
-            media_mime = message.get("document", {}).get("mime_type")
-            media_file_name = message.get("document", {}).get("filename")
-        elif is_audio:
-            media_id = message.get("audio", {}).get("id")
-            media_mime = message.get("audio", {}).get("mime_type")
-
-        if media_id:
-            try:
-                file_bytes, mime_type = download_whatsapp_media(media_id)
-                if file_bytes:
-                    storage_path = f"chats/{chat_id}/{media_id}-{media_file_name or 'file'}"
-                    stored_path, storage_error = upload_to_storage(
-                        file_bytes=file_bytes,
-                        path=storage_path,
-                        content_type=mime_type or media_mime,
-                    )
-                    if storage_error:
-                        print(
-                            "Storage upload error (inbound media):",
-                            storage_error,
-                        )
-                    else:
-                        media_path = stored_path or storage_path
-                        media_url = _get_public_media_url(media_path) or media_path
-            except MediaDownloadError as exc:
-                print("Error downloading/uploading inbound media:", exc)
-
-        message_body = (
-            (message.get("text") or {}).get("body")
-            or media_caption
-            or media_file_name
-            or ("Mensaje de voz" if message.get("audio") else None)
-            or "[Media/Other]"
+        transfer = MediaTransfer(
+            message_id=stored.get("id"),
+            chat_id=stored.get("chat_id"),
+            media_id=row.get("media_id"),
+            file_name=row.get("media_file_name"),
+            mime_type=row.get("media_mime_type"),
         )
+        if not media_pipeline.submit(transfer):
+            _store_inbound_media(stored, row)
 
-        message_id = message.get("id")
-        if message_id:
-            existing_response = (
-                supabase.from_("messages")
-                .select("id")
-                .eq("wa_message_id", message_id)
-                .maybe_single()
-                .execute()
-            )
-            existing_error = get_supabase_error(existing_response)
-            existing_data = get_supabase_data(existing_response)
+    latest_text_by_chat: Dict[str, str] = {}
+    new_messages_by_chat: Dict[str, int] = {}
+    for stored in stored_messages:
+        chat_id = stored.get("chat_id")
+        row = rows_by_wa_id.get(stored.get("wa_message_id")) or {}
+        latest_text_by_chat[chat_id] = row.get("body") or ""
+        new_messages_by_chat[chat_id] = new_messages_by_chat.get(chat_id, 0) + 1
 
-            if existing_error:
-                print(
-                    "Error checking duplicate message:",
-                    {"messageId": message_id, "error": existing_error},
-                )
+    for chat_id in chats_to_process:
+        if settings.debounce_backend != "edge" and debounce_scheduler.schedule(
+            chat_id,
+            latest_text_by_chat.get(chat_id),
+            new_messages_by_chat.get(chat_id, 1),
+        ):
+            continue
+        # Blocking edge-function call (or direct turn): fan out across
+        # chats, one at a time per chat.
+        chat_fanout.submit(chat_id, _invoke_queue_function, chat_id)
 
-            if existing_data:
-                print("Skipping duplicate message", {"messageId": message_id})
-                continue
 
-        message_timestamp_ms = (
-            int(message.get("timestamp")) * 1000
-            if message.get("timestamp")
-            else int(datetime.utcnow().timestamp() * 1000)
+def _invoke_queue_function(chat_id: str) -> None:
+    """Edge-function debounce backend (``DEBOUNCE_BACKEND=edge``)."""
+    supabase = get_supabase_client()
+    try:
+        start = time.time()
+        print("[whatsapp] invoking process-whatsapp-queue", {"chat_id": chat_id})
+        invoke_response = supabase.functions.invoke(
+            "process-whatsapp-queue",
+            {"body": {"chat_id": chat_id}},
         )
-        message_timestamp_iso = datetime.fromtimestamp(
-            message_timestamp_ms / 1000, tz=timezone.utc
-        ).isoformat()
-
-        message_insert = (
-            supabase.from_("messages")
-            .insert(
-                {
-                    "chat_id": chat_id,
-                    "chat_session_id": None,
-                    "wa_message_id": message_id,
-                    "body": message_body,
-                    "type": message.get("type"),
-                    "status": "received",
-                    "direction": "inbound",
-                    "role": "user",
-                    "payload": {
-                        **message,
-                        "media_id": media_id,
-                        "media_mime_type": media_mime,
-                        "media_file_name": media_file_name,
-                        "media_caption": media_caption,
-                        "voice": (message.get("audio") or {}).get("voice"),
-                        "conversation_id": None,
-                    },
-                    "wa_timestamp": message_timestamp_iso,
-                    "sender_name": name,
-                    "media_id": media_id,
-                    "media_path": media_path,
-                    "media_url": media_url,
-                    "media_mime_type": media_mime,
-                    "created_at": message_timestamp_iso,
-                }
+        elapsed = round((time.time() - start) * 1000)
+        invoke_error = get_supabase_error(invoke_response)
+        if invoke_error:
+            print(
+                "[whatsapp] process-whatsapp-queue error",
+                {"chat_id": chat_id, "error": invoke_error},
             )
-            .execute()
-        )
-
-        message_error = get_supabase_error(message_insert)
-        if message_error:
-            print("Error inserting message:", message_error)
-            continue
-        print("[whatsapp] message stored", {"wa_message_id": message_id})
-
-        queue_response = supabase.rpc(
-            "accumulate_whatsapp_message",
-            {
-                "p_chat_id": chat_id,
-                "p_new_text": message_body or "",
-            },
-        ).execute()
-        queue_error = get_supabase_error(queue_response)
-
-        if queue_error:
-            print("Error accumulating message queue:", queue_error)
+            _process_chat_directly(chat_id)
         else:
-            print("[whatsapp] message queued", {"chat_id": chat_id})
-            chats_to_process.add(chat_id)
-
-    for chat_id in chats_to_process:
-        try:
-            start = time.time()
-            print("[whatsapp] invoking process-whatsapp-queue", {"chat_id": chat_id})
-            invoke_response = supabase.functions.invoke(
-                "process-whatsapp-queue",
-                {"body": {"chat_id": chat_id}},
-            )
-            elapsed = round((time.time() - start) * 1000)
-            invoke_error = get_supabase_error(invoke_response)
-            if invoke_error:
-                print(
-                    "[whatsapp] process-whatsapp-queue error",
-                    {"chat_id": chat_id, "error": invoke_error},
-                )
-                _process_chat_directly(chat_id)
-            else:
-                print(
-                    "[whatsapp] process-whatsapp-queue ok",
-                    {"chat_id": chat_id, "elapsed_ms": elapsed},
-                )
-        except Exception as exc:
             print(
-                "[whatsapp] process-whatsapp-queue exception",
-                {"chat_id": chat_id, "error": str(exc)},
+                "[whatsapp] process-whatsapp-queue ok",
+                {"chat_id": chat_id, "elapsed_ms": elapsed},
             )
-            _process_chat_directly(chat_id)
+    except Exception as exc:
+        print(
+            "[whatsapp] process-whatsapp-queue exception",
+            {"chat_id": chat_id, "error": str(exc)},
+        )
+        _process_chat_directly(chat_id)
 
 
 def _process_chat_directly(chat_id: str) -> None:
@@ -323,7 +333,7 @@ def _process_chat_directly(chat_id: str) -> None:
         supabase = get_supabase_client()
         queue_response = (
             supabase.from_("message_queue")
-            .select("combined_text")
+            .select("combined_text, last_added_at")
             .eq("chat_id", chat_id)
             .maybe_single()
             .execute()
@@ -337,8 +347,13 @@ def _process_chat_directly(chat_id: str) -> None:
         from app.whatsapp.process_router import ProcessQueueRequest, _process_queue_impl
 
         print("[whatsapp] direct fallback processing", {"chat_id": chat_id})
-        result = _process_queue_impl(
-            ProcessQueueRequest(chat_id=chat_id, final_message=final_message)
+        result = chat_turn_lock.run_sync(
+            chat_id,
+            final_message,
+            lambda text: _process_queue_impl(
+                ProcessQueueRequest(chat_id=chat_id, final_message=text)
+            ),
+            batch_id=(queue or {}).get("last_added_at"),
         )
         if isinstance(result, dict) and result.get("status") in {"sent", "skipped"}:
             supabase.from_("message_queue").delete().eq("chat_id", chat_id).execute()
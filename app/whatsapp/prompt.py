@@ -1,9 +1,21 @@
 """
 System prompt builder for the admissions chatbot.
+
+The prompt is split in two parts so OpenAI prompt caching can hit:
+
+* a **static prefix** that only depends on the organisation config and the
+  admissions cycle.  It is memoized per (org id, config hash, cycle year)
+  and stays byte-identical between turns;
+* a small **dynamic suffix** with the current date/time.
 """
 
+import hashlib
+import json
+import threading
 from datetime import datetime
-from typing import Any, Dict
+from typing import Any, Dict, Optional, Tuple
+
+from cachetools import LRUCache
 
 from app.whatsapp.grade_calculator import build_grade_ranges_prompt
 
@@ -13,22 +25,70 @@ _DAYS_ES = [
     "viernes", "sábado", "domingo",
 ]
 
+# Admissions cycle the prompt promotes (grade ranges for it and the next one)
+PROMPT_CYCLE_START_YEAR = 2026
+
+_PROMPT_CONFIG_FIELDS = ("name", "bot_name", "bot_instructions", "bot_tone")
+
+_static_prompt_cache: LRUCache = LRUCache(maxsize=128)
+_static_prompt_lock = threading.Lock()
+
+
+def prompt_config_hash(org: Dict[str, Any]) -> str:
+    """Short hash of the org fields that shape the static prompt."""
+    config = {field: org.get(field) for field in _PROMPT_CONFIG_FIELDS}
+    encoded = json.dumps(config, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()[:16]
+
+
+def prompt_cache_key(org: Dict[str, Any], cycle_start_year: int = PROMPT_CYCLE_START_YEAR) -> str:
+    """Stable key for the Responses API ``prompt_cache_key`` parameter."""
+    return f"admissions:{org.get('id')}:{prompt_config_hash(org)}:{cycle_start_year}"
+
+
+def build_static_prompt(
+    org: Dict[str, Any],
+    cycle_start_year: int = PROMPT_CYCLE_START_YEAR,
+) -> str:
+    """Return the memoized, turn-independent part of the system prompt."""
+    key: Tuple[Optional[str], str, int] = (
+        org.get("id"),
+        prompt_config_hash(org),
+        cycle_start_year,
+    )
+    with _static_prompt_lock:
+        cached = _static_prompt_cache.get(key)
+    if cached is not None:
+        return cached
+
+    prompt = _render_static_prompt(org, cycle_start_year)
+    with _static_prompt_lock:
+        _static_prompt_cache[key] = prompt
+    return prompt
+
+
+def build_dynamic_prompt(now_utc: Optional[datetime] = None) -> str:
+    """Per-turn suffix: current date and time."""
+    now_utc = now_utc or datetime.utcnow()
+    current_date = now_utc.strftime("%Y-%m-%d")
+    current_time = now_utc.strftime("%H:%M:%S UTC")
+    day_of_week = _DAYS_ES[now_utc.weekday()]
+    return f"Hoy es {day_of_week} {current_date} y la hora actual es {current_time}."
+
 
 def build_prompt(org: Dict[str, Any]) -> str:
     """Build the full system prompt from the organisation config."""
+    return f"{build_static_prompt(org)}\n\n{build_dynamic_prompt()}"
+
+
+def _render_static_prompt(org: Dict[str, Any], cycle_start_year: int) -> str:
     bot_name = org.get("bot_name") or "Asistente"
     instructions = org.get("bot_instructions") or ""
     tone = org.get("bot_tone") or "amable"
     school_name = org.get("name") or "el colegio"
 
-    now_utc = datetime.utcnow()
-    current_date = now_utc.strftime("%Y-%m-%d")
-    current_time = now_utc.strftime("%H:%M:%S UTC")
-    day_of_week = _DAYS_ES[now_utc.weekday()]
-
     base_prompt = (
         f"Eres {bot_name}, un asistente virtual de admisiones de {school_name}. "
-        f"Hoy es {day_of_week} {current_date} y la hora actual es {current_time}. "
         f"Tu tono es {tone}. "
         "REGLA DE IDIOMA (OBLIGATORIA): "
         "SIEMPRE responde en el MISMO IDIOMA que usa el usuario en su mensaje. "
@@ -126,8 +186,8 @@ def build_prompt(org: Dict[str, Any]) -> str:
 
         # ── Grade ranges (DOB lookup table) ──
         "El preescolar (Early Childhood) incluye Prenursery y comienza desde los 2 años. "
-        + build_grade_ranges_prompt(2026) + " "
-        + build_grade_ranges_prompt(2027) + " "
+        + build_grade_ranges_prompt(cycle_start_year) + " "
+        + build_grade_ranges_prompt(cycle_start_year + 1) + " "
         "IMPORTANTE sobre los rangos: Cada rango es INCLUSIVO en ambos extremos. "
         "Si un niño nació el 01-Aug-2020, pertenece a Kindergarten (NO a Primaria 1). "
         "Primaria 1 abarca nacidos del 01-Aug-2019 AL 31-Jul-2020 (NO incluye 01-Aug-2020). "
@@ -0,0 +1,250 @@
+"""
+In-memory calendar of bookable availability slots per organization.
+
+Which slots are bookable (weekday, business hours and capacity, plus the
+org's ``appointment_settings`` and ``appointment_blackouts``) is decided in
+Postgres by the ``search_availability_slots`` RPC.  The RPC evaluates this in
+the organization's timezone and returns each row's local date and half-day.
+The calendar loads the next ``SLOT_CACHE_DAYS`` once and keeps the rows in
+sorted arrays per half-day ("morning"/"afternoon"/any).  A range query is
+then two ``bisect`` calls on the local dates.  Ranges beyond the horizon
+call the RPC directly, limited to the rows that are shown.
+
+Freshness: triggers bump ``availability_calendar_versions`` on every
+change to slots, blackouts or settings; the version is polled at most every
+``SLOT_CACHE_POLL_SECONDS`` and the calendar is reloaded when it moves.
+If the version cannot be read, the cached calendar keeps being served (and
+the version retried every poll) for up to ``MAX_UNVERIFIED_SECONDS``.
+Bookings made by this process invalidate the calendar immediately.
+"""
+
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from datetime import date, datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+from app.core.config import settings
+from app.core.supabase import (
+    get_supabase_client,
+    get_supabase_data,
+    get_supabase_error,
+)
+
+# Options offered to the user per search (keeps WhatsApp messages short)
+MAX_SLOT_OPTIONS = 8
+
+HALF_DAYS = ("morning", "afternoon")
+
+# Longest a calendar is served while its version cannot be read.
+MAX_UNVERIFIED_SECONDS = 300
+
+
+class OrgSlotCalendar:
+    """Bookable slots of one organization for local dates ``start``..``end``."""
+
+    def __init__(
+        self,
+        rows: List[Dict[str, Any]],
+        start: date,
+        end: date,
+        version: Optional[int] = None,
+    ) -> None:
+        self.start = start
+        self.end = end
+        self.version = version
+        self.loaded_on = datetime.now(timezone.utc).date()
+        self.checked_at = time.monotonic()
+        # Last time the rows were known to be current.
+        self.verified_at = self.checked_at
+        # Rows arrive ordered by starts_at, hence by local_date too.
+        dated = [(date.fromisoformat(row["local_date"]), row) for row in rows]
+        self._buckets: Dict[Optional[str], Tuple[List[date], List[Dict[str, Any]]]] = {}
+        for half_day in (None,) + HALF_DAYS:
+            bucket = [
+                (day, row) for day, row in dated
+                if half_day is None or row.get("half_day") == half_day
+            ]
+            self._buckets[half_day] = (
+                [day for day, _row in bucket],
+                [row for _day, row in bucket],
+            )
+
+    def __len__(self) -> int:
+        return len(self._buckets[None][1])
+
+    def covers(self, start: date, end: date) -> bool:
+        return self.start <= start and end <= self.end
+
+    def query(
+        self,
+        start: date,
+        end: date,
+        preferred_time: Optional[str] = None,
+        limit: int = MAX_SLOT_OPTIONS,
+    ) -> List[Dict[str, Any]]:
+        """Rows whose local date falls in [start, end], in start order."""
+        preferred = (preferred_time or "").lower().strip()
+        days, rows = self._buckets[preferred if preferred in HALF_DAYS else None]
+        lo = bisect_left(days, start)
+        hi = bisect_right(days, end)
+        return rows[lo:min(hi, lo + limit)]
+
+
+def _search_rpc(
+    org_id: str,
+    start: date,
+    end: date,
+    preferred_time: Optional[str] = None,
+    limit: Optional[int] = MAX_SLOT_OPTIONS,
+) -> List[Dict[str, Any]]:
+    response = (
+        get_supabase_client()
+        .rpc(
+            "search_availability_slots",
+            {
+                "p_org_id": org_id,
+                "p_start_date": start.isoformat(),
+                "p_end_date": end.isoformat(),
+                "p_preferred_time": preferred_time,
+                "p_limit": limit,
+            },
+        )
+        .execute()
+    )
+    error = get_supabase_error(response)
+    if error:
+        raise RuntimeError(f"search_availability_slots failed: {error}")
+    return get_supabase_data(response) or []
+
+
+def _fetch_version(org_id: str) -> Optional[int]:
+    """Current calendar version; None if it cannot be read (no trigger yet)."""
+    try:
+        response = (
+            get_supabase_client()
+            .from_("availability_calendar_versions")
+            .select("version")
+            .eq("organization_id", org_id)
+            .limit(1)
+            .execute()
+        )
+    except Exception as exc:
+        print("[slot-calendar] version lookup failed", {"org_id": org_id, "error": str(exc)})
+        return None
+    error = get_supabase_error(response)
+    if error:
+        print("[slot-calendar] version lookup failed", {"org_id": org_id, "error": str(error)})
+        return None
+    rows = get_supabase_data(response) or []
+    return int(rows[0].get("version") or 0) if rows else 0
+
+
+class SlotCalendarCache:
+    def __init__(self, horizon_days: int, poll_seconds: float) -> None:
+        self.horizon_days = horizon_days
+        self.poll_seconds = poll_seconds
+        self._calendars: Dict[str, OrgSlotCalendar] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.reloads = 0
+        self.fallbacks = 0
+        self.unverified_hits = 0
+        self.invalidations = 0
+
+    # ── Lookups ──────────────────────────────────────────────────
+
+    def search(
+        self,
+        org_id: str,
+        start: date,
+        end: date,
+        preferred_time: Optional[str] = None,
+    ) -> List[Dict[str, Any]]:
+        """Up to MAX_SLOT_OPTIONS bookable slot rows for local dates [start, end]."""
+        calendar = self._calendar(org_id) if settings.slot_cache_enabled else None
+        if calendar is None or not calendar.covers(start, end):
+            with self._lock:
+                self.fallbacks += 1
+            return _search_rpc(org_id, start, end, preferred_time)
+        return calendar.query(start, end, preferred_time)
+
+    def _calendar(self, org_id: str) -> Optional[OrgSlotCalendar]:
+        today = datetime.now(timezone.utc).date()
+        with self._lock:
+            calendar = self._calendars.get(org_id)
+        if calendar is not None and calendar.loaded_on == today:
+            now = time.monotonic()
+            if now - calendar.checked_at < self.poll_seconds:
+                with self._lock:
+                    self.hits += 1
+                return calendar
+            version = _fetch_version(org_id)
+            if version is None and now - calendar.verified_at < MAX_UNVERIFIED_SECONDS:
+                # Retry the version on the next poll instead of reloading now.
+                calendar.checked_at = now
+                with self._lock:
+                    self.hits += 1
+                    self.unverified_hits += 1
+                return calendar
+            if version is not None and version == calendar.version:
+                calendar.checked_at = calendar.verified_at = now
+                with self._lock:
+                    self.hits += 1
+                return calendar
+        else:
+            version = _fetch_version(org_id)
+
+        # Read the version before the rows: a change in between only causes
+        # one extra reload on the next poll.
+        # Local dates lag UTC by a few hours, so start one day earlier.
+        start = today - timedelta(days=1)
+        end = today + timedelta(days=self.horizon_days)
+        try:
+            rows = _search_rpc(org_id, start, end, limit=None)
+            calendar = OrgSlotCalendar(rows, start, end, version)
+        except Exception as exc:
+            print("[slot-calendar] load failed", {"org_id": org_id, "error": str(exc)})
+            return None
+        with self._lock:
+            self._calendars[org_id] = calendar
+            self.reloads += 1
+        print("[slot-calendar] loaded", {"org_id": org_id, "slots": len(calendar), "version": version})
+        return calendar
+
+    # ── Maintenance ──────────────────────────────────────────────
+
+    def invalidate(self, org_id: Optional[str] = None) -> int:
+        """Drop one organization's calendar (or all of them)."""
+        with self._lock:
+            if org_id is None:
+                removed = len(self._calendars)
+                self._calendars.clear()
+            else:
+                removed = 1 if self._calendars.pop(org_id, None) is not None else 0
+            self.invalidations += removed
+            return removed
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "enabled": settings.slot_cache_enabled,
+                "hits": self.hits,
+                "reloads": self.reloads,
+                "fallbacks": self.fallbacks,
+                "unverified_hits": self.unverified_hits,
+                "invalidations": self.invalidations,
+                "organizations": {
+                    org_id: {"slots": len(calendar), "version": calendar.version}
+                    for org_id, calendar in self._calendars.items()
+                },
+                "horizon_days": self.horizon_days,
+                "poll_seconds": self.poll_seconds,
+                "max_unverified_seconds": MAX_UNVERIFIED_SECONDS,
+            }
+
+
+slot_calendar = SlotCalendarCache(
+    horizon_days=settings.slot_cache_days,
+    poll_seconds=settings.slot_cache_poll_seconds,
+)
@@ -1,7 +1,74 @@
-from datetime import datetime
-from typing import Any, Dict
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
 
-from app.core.supabase import get_supabase_client, get_supabase_error
+from app.core.supabase import get_supabase_client, get_supabase_data, get_supabase_error
+
+# Delivery lifecycle order; a stored status is never replaced by a lower one.
+# Keep in sync with public.whatsapp_status_rank().
+STATUS_PRECEDENCE = {
+    "sent": 1,
+    "delivered": 2,
+    "read": 3,
+    "failed": 4,
+    "deleted": 5,
+}
+
+_TIMESTAMP_COLUMNS = {
+    "sent": "sent_at",
+    "delivered": "delivered_at",
+    "read": "read_at",
+}
+
+
+def _status_rank(status: Optional[str]) -> int:
+    return STATUS_PRECEDENCE.get(status or "", 0)
+
+
+def _status_timestamp(status: Dict[str, Any]) -> str:
+    raw = status.get("timestamp")
+    if raw:
+        try:
+            return datetime.fromtimestamp(int(raw), tz=timezone.utc).isoformat()
+        except (TypeError, ValueError):
+            pass
+    return datetime.now(timezone.utc).isoformat()
+
+
+def coalesce_statuses(statuses: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Collapse a webhook batch to one row per message.
+
+    Each row carries the highest-precedence status seen for the message plus
+    the earliest timestamp of every lifecycle step present in the batch, so
+    ``sent``/``delivered``/``read`` arriving together fill all three columns.
+    """
+    rows: Dict[str, Dict[str, Any]] = {}
+    for status in statuses:
+        message_id = status.get("id")
+        next_status = status.get("status")
+        if not message_id or not next_status:
+            continue
+
+        timestamp = _status_timestamp(status)
+        row = rows.get(message_id)
+        if row is None:
+            row = {
+                "wa_message_id": message_id,
+                "status": next_status,
+                "status_detail": status,
+                "sent_at": None,
+                "delivered_at": None,
+                "read_at": None,
+            }
+            rows[message_id] = row
+        elif _status_rank(next_status) > _status_rank(row["status"]):
+            row["status"] = next_status
+            row["status_detail"] = status
+
+        column = _TIMESTAMP_COLUMNS.get(next_status)
+        if column and (row[column] is None or timestamp < row[column]):
+            row[column] = timestamp
+
+    return list(rows.values())
 
 
 def handle_status_updates(value: Dict[str, Any]) -> None:
@@ -9,51 +76,27 @@ def handle_status_updates(value: Dict[str, Any]) -> None:
     if not statuses:
         return
 
+    rows = coalesce_statuses(statuses)
+    if not rows:
+        return
+
     supabase = get_supabase_client()
+    result = supabase.rpc("apply_whatsapp_statuses", {"p_statuses": rows}).execute()
 
-    for status in statuses:
-        message_id = status.get("id")
-        if not message_id:
-            continue
+    error = get_supabase_error(result)
+    if error:
+        print(
+            "Error updating message status:",
+            error,
+            {"statuses": len(statuses), "messages": len(rows)},
+        )
+        return
 
-        next_status = status.get("status")
-        status_timestamp = status.get("timestamp")
-        if status_timestamp:
-            status_timestamp = datetime.fromtimestamp(
-                int(status_timestamp)
-            ).isoformat()
-        else:
-            status_timestamp = datetime.utcnow().isoformat()
-
-        updates: Dict[str, Any] = {
-            "status": next_status,
-            "payload": {"status_detail": status},
-        }
-
-        if next_status == "sent":
-            updates["sent_at"] = status_timestamp
-        if next_status == "delivered":
-            updates["delivered_at"] = status_timestamp
-        if next_status == "read":
-            updates["read_at"] = status_timestamp
-
-        result = supabase.from_("messages").update(updates).eq(
-            "wa_message_id", message_id
-        ).execute()
-
-        error = get_supabase_error(result)
-        if error:
-            print(
-                "Error updating message status:",
-                error,
-                {"messageId": message_id, "nextStatus": next_status},
-            )
-        else:
-            print(
-                "Updated message status",
-                {
-                    "messageId": message_id,
-                    "nextStatus": next_status,
-                    "statusTimestamp": status_timestamp,
-                },
-            )
+    print(
+        "Updated message status",
+        {
+            "statuses": len(statuses),
+            "messages": len(rows),
+            "updated": get_supabase_data(result),
+        },
+    )
@@ -1,7 +1,16 @@
-from typing import Optional, Tuple
+import mimetypes
+from pathlib import PurePosixPath
+from typing import Any, Dict, Optional, Tuple
+from urllib.parse import quote
+
+import httpx
+from storage3.exceptions import StorageApiError
 
 from app.core.config import settings
-from app.core.supabase import get_supabase_client
+from app.core.supabase import get_supabase_client, get_supabase_data
+
+# sha256 → storage path of every inbound media object
+MEDIA_OBJECTS_TABLE = "whatsapp_media_objects"
 
 
 def upload_to_storage(
@@ -27,3 +36,126 @@ def upload_to_storage(
     if error:
         return None, error
     return path, None
+
+
+def get_public_media_url(path: str) -> Optional[str]:
+    supabase = get_supabase_client()
+    bucket = settings.supabase_storage_bucket
+    response = supabase.storage.from_(bucket).get_public_url(path)
+    if isinstance(response, str):
+        return response
+    if isinstance(response, dict):
+        return response.get("publicURL") or response.get("publicUrl")
+    if hasattr(response, "get"):
+        try:
+            return response.get("publicURL") or response.get("publicUrl")
+        except Exception:
+            return None
+    return None
+
+
+def storage_object_url(path: str, bucket: Optional[str] = None) -> str:
+    """REST endpoint of an object, for streamed uploads."""
+    base = (settings.supabase_url or "").rstrip("/")
+    return f"{base}/storage/v1/object/{bucket or settings.supabase_storage_bucket}/{quote(path)}"
+
+
+def storage_headers(content_type: Optional[str], upsert: bool = False) -> Dict[str, str]:
+    key = settings.supabase_service_key or ""
+    return {
+        "Authorization": f"Bearer {key}",
+        "apikey": key,
+        "Content-Type": content_type or "application/octet-stream",
+        "x-upsert": "true" if upsert else "false",
+    }
+
+
+# ── Content-addressed media ───────────────────────────────────────
+
+
+def content_addressed_path(
+    sha256: str,
+    mime_type: Optional[str] = None,
+    file_name: Optional[str] = None,
+) -> str:
+    """Shared storage path of a media object, derived from its SHA-256."""
+    extension = PurePosixPath(file_name).suffix.lower() if file_name else ""
+    if not extension and mime_type:
+        extension = mimetypes.guess_extension(mime_type.split(";")[0].strip()) or ""
+    return f"sha256/{sha256[:2]}/{sha256}{extension}"
+
+
+def _is_duplicate(status: Any, code: Any) -> bool:
+    return str(status) == "409" or str(code or "").lower() == "duplicate"
+
+
+def is_duplicate_object_error(error: Any) -> bool:
+    """Storage refused the upload because the object already exists.
+
+    *error* is the ``StorageApiError`` (or error dict) of a storage3 upload,
+    or the ``httpx.Response`` of a raw Storage REST upload.  Storage answers
+    ``{"statusCode": "409", "error": "Duplicate", ...}``; nothing else counts.
+    """
+    if isinstance(error, httpx.Response):
+        if error.status_code == 409:
+            return True
+        if error.status_code != 400:
+            return False
+        try:
+            body = error.json()
+        except ValueError:
+            return False
+        return isinstance(body, dict) and _is_duplicate(
+            body.get("statusCode"), body.get("error")
+        )
+    if isinstance(error, StorageApiError):
+        return _is_duplicate(error.status, error.code)
+    if isinstance(error, dict):
+        return _is_duplicate(
+            error.get("statusCode") or error.get("status"),
+            error.get("error") or error.get("code"),
+        )
+    return False
+
+
+def media_object_row(
+    sha256: str,
+    path: str,
+    size: int,
+    mime_type: Optional[str],
+) -> Dict[str, Any]:
+    return {
+        "sha256": sha256,
+        "storage_bucket": settings.supabase_storage_bucket,
+        "storage_path": path,
+        "size_bytes": size,
+        "mime_type": mime_type,
+    }
+
+
+def find_media_object(sha256: str) -> Optional[str]:
+    """Storage path of an already stored object with this hash, if any."""
+    response = (
+        get_supabase_client()
+        .from_(MEDIA_OBJECTS_TABLE)
+        .select("storage_path")
+        .eq("sha256", sha256)
+        .eq("storage_bucket", settings.supabase_storage_bucket)
+        .limit(1)
+        .execute()
+    )
+    rows = get_supabase_data(response) or []
+    return rows[0].get("storage_path") if rows else None
+
+
+def register_media_object(
+    sha256: str,
+    path: str,
+    size: int,
+    mime_type: Optional[str],
+) -> None:
+    get_supabase_client().from_(MEDIA_OBJECTS_TABLE).upsert(
+        media_object_row(sha256, path, size, mime_type),
+        on_conflict="sha256",
+        ignore_duplicates=True,
+    ).execute()
@@ -0,0 +1,162 @@
+"""
+Concurrent execution of the function calls of one model response.
+
+Every tool declares which per-chat resources it reads and writes (see
+``app.whatsapp.tools.registry``).  A call waits only for earlier calls it
+conflicts with — write/write or read/write on the same resource — so
+independent calls such as ``get_next_event`` and
+``search_availability_slots`` run in parallel on a shared thread pool,
+while writes to the chat's leads keep the order the model emitted them
+in.  Dependent calls are scheduled when their dependencies finish, never
+parked on a pool thread.  Results are always returned in call order, as the Responses API
+expects.
+"""
+
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from dataclasses import dataclass, field
+from typing import Any, Callable, Deque, FrozenSet, List, Optional, TypeVar
+
+from app.core.config import settings
+
+T = TypeVar("T")
+
+# Resource names (scoped to the chat being processed)
+LEADS = "leads"  # leads, lead notes, appointments and event registrations
+LEAD_SLOT_METADATA = "leads:slot_options"  # leads.metadata slot options only
+EVENT_STATE = "state:events"  # state_context: pending_event(_registration)
+SLOT_STATE = "state:slots"  # state_context: slot options / appointment flow
+NOTE_STATE = "state:notes"  # state_context: pending_notes
+OUTBOUND = "outbound"  # documents sent to WhatsApp (keep their order)
+EXCLUSIVE = "*"  # conflicts with every other call
+
+
+@dataclass(frozen=True)
+class ToolAccess:
+    reads: FrozenSet[str] = field(default_factory=frozenset)
+    writes: FrozenSet[str] = field(default_factory=frozenset)
+
+    def conflicts_with(self, other: "ToolAccess") -> bool:
+        if EXCLUSIVE in self.writes or EXCLUSIVE in other.writes:
+            return True
+        return bool(
+            self.writes & (other.reads | other.writes)
+            or other.writes & self.reads
+        )
+
+
+def tool_access(reads: tuple = (), writes: tuple = ()) -> ToolAccess:
+    return ToolAccess(reads=frozenset(reads), writes=frozenset(writes))
+
+
+# Unknown tools are treated as exclusive.
+EXCLUSIVE_ACCESS = tool_access(writes=(EXCLUSIVE,))
+
+
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=settings.tool_pool_size,
+            thread_name_prefix="tool",
+        )
+    return _executor
+
+
+def _dependencies(accesses: List[ToolAccess]) -> List[List[int]]:
+    """Earlier calls each call conflicts with (and must wait for)."""
+    return [
+        [earlier for earlier in range(index) if access.conflicts_with(accesses[earlier])]
+        for index, access in enumerate(accesses)
+    ]
+
+
+def _is_chain(dependencies: List[List[int]]) -> bool:
+    """True when no two calls could ever run at the same time."""
+    levels: List[int] = []
+    for deps in dependencies:
+        levels.append(1 + max((levels[earlier] for earlier in deps), default=-1))
+    return len(set(levels)) == len(levels)
+
+
+def execute_tool_calls(
+    tool_calls: List[Any],
+    run: Callable[[Any], T],
+    access_for: Callable[[Any], ToolAccess],
+    timeout_for: Optional[Callable[[Any], Optional[float]]] = None,
+    on_timeout: Optional[Callable[[Any], T]] = None,
+) -> List[T]:
+    """Run ``run(call)`` for every call, in parallel where access allows.
+
+    A single call, or calls that all depend on each other, run inline on
+    the calling thread.  Otherwise a call is handed to the shared pool
+    (``TOOL_POOL_SIZE`` threads) only once the calls it depends on have
+    finished, so no pool thread ever blocks waiting for another, and at
+    most ``TOOL_MAX_WORKERS`` calls of this turn run at a time.  When
+    ``timeout_for`` returns a limit for a call, its result is replaced by
+    ``on_timeout(call)`` once the limit passes; the call itself keeps
+    running, and later conflicting calls still wait for it.
+    """
+    timeouts = [timeout_for(call) if timeout_for else None for call in tool_calls]
+    dependencies = _dependencies([access_for(call) for call in tool_calls])
+    if settings.tool_max_workers <= 1 or (
+        not any(timeouts) and _is_chain(dependencies)
+    ):
+        return [run(call) for call in tool_calls]
+
+    executor = _get_executor()
+    futures: List[Future] = [Future() for _ in tool_calls]
+    waiting = [len(deps) for deps in dependencies]
+    dependents: List[List[int]] = [[] for _ in tool_calls]
+    for index, deps in enumerate(dependencies):
+        for earlier in deps:
+            dependents[earlier].append(index)
+    ready: Deque[int] = deque(index for index, deps in enumerate(dependencies) if not deps)
+    lock = threading.Lock()
+    running = 0
+
+    def _take_ready() -> List[int]:
+        # Caller holds ``lock``.
+        nonlocal running
+        batch = []
+        while ready and running < settings.tool_max_workers:
+            batch.append(ready.popleft())
+            running += 1
+        return batch
+
+    def _task(index: int) -> None:
+        nonlocal running
+        try:
+            futures[index].set_result(run(tool_calls[index]))
+        except BaseException as exc:
+            futures[index].set_exception(exc)
+        with lock:
+            running -= 1
+            for later in dependents[index]:
+                waiting[later] -= 1
+                if not waiting[later]:
+                    ready.append(later)
+            batch = _take_ready()
+        for later in batch:
+            executor.submit(_task, later)
+
+    with lock:
+        batch = _take_ready()
+    for index in batch:
+        executor.submit(_task, index)
+
+    results: List[T] = []
+    for call, future, timeout in zip(tool_calls, futures, timeouts):
+        if timeout and on_timeout is not None:
+            try:
+                results.append(future.result(timeout=timeout))
+            except FutureTimeoutError:
+                results.append(on_timeout(call))
+        else:
+            results.append(future.result())
+    return results
@@ -0,0 +1,434 @@
+"""
+Declarative registry of the admissions bot tools.
+
+Each ``ToolSpec`` maps a function-calling name to its request model, its
+handler (resolved lazily from a dotted path, so the registry does not import
+the router), the turn context it needs, the resources it reads/writes (used
+by ``app.whatsapp.tool_executor`` to parallelize calls), and flags for side
+effects, per-turn memoization and timeout.  Both the first and follow-up
+rounds of a turn execute through ``tool_registry``; per-tool latency
+histograms are exposed at ``/api/whatsapp/admin/tools/metrics``.
+"""
+
+import importlib
+import json
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Tuple, Type
+
+from fastapi import HTTPException
+from pydantic import BaseModel
+
+from app.whatsapp.tool_executor import (
+    EVENT_STATE,
+    EXCLUSIVE,
+    EXCLUSIVE_ACCESS,
+    LEAD_SLOT_METADATA,
+    LEADS,
+    NOTE_STATE,
+    OUTBOUND,
+    SLOT_STATE,
+    ToolAccess,
+    execute_tool_calls,
+    tool_access,
+)
+from app.whatsapp.tools import (
+    AddLeadNoteRequest,
+    BookAppointmentRequest,
+    CancelAppointmentRequest,
+    CloseChatSessionRequest,
+    CreateAdmissionsLeadRequest,
+    GetLeadStatusRequest,
+    GetNextEventRequest,
+    GetRequirementsRequest,
+    RegisterEventRequest,
+    RescheduleAppointmentRequest,
+    SearchSlotsRequest,
+    UpdateAdmissionsLeadRequest,
+)
+
+UNKNOWN_TOOL_TEXT = "No se pudo ejecutar la accion solicitada."
+
+_ROUTER = "app.whatsapp.process_router"
+
+
+# ── Declarations ─────────────────────────────────────────────────
+
+
+@dataclass(frozen=True)
+class ToolSpec:
+    name: str
+    request_model: Type[BaseModel]
+    handler: str  # "module:function", called as handler(args, **context)
+    error_message: str
+    # Turn values passed to the handler as keyword arguments
+    context: Tuple[str, ...] = ("org", "chat")
+    access: ToolAccess = EXCLUSIVE_ACCESS
+    # Writes business data or sends messages (clears the turn memo)
+    side_effects: bool = False
+    # Identical calls within one turn reuse the first result
+    cacheable: bool = False
+    # Seconds before the model gets a timeout message.  Only for tools that
+    # write nothing: a timed-out call keeps running after the turn returns.
+    timeout: Optional[float] = None
+    # Message for non-HTTP errors (defaults to "<error_message>: <exc>")
+    fallback_error: Optional[str] = None
+    marks_lead_note: Optional[Callable[[Any], bool]] = None
+
+    def __post_init__(self) -> None:
+        if self.timeout is not None and (self.access.writes or self.side_effects):
+            raise ValueError(f"Tool {self.name} writes state and cannot have a timeout")
+
+
+TOOL_SPECS: Tuple[ToolSpec, ...] = (
+    ToolSpec(
+        name="create_admissions_lead",
+        request_model=CreateAdmissionsLeadRequest,
+        handler=f"{_ROUTER}:_create_lead_and_register_pending_event",
+        context=("org", "chat", "session_id"),
+        access=tool_access(writes=(LEADS, EVENT_STATE, NOTE_STATE, OUTBOUND)),
+        side_effects=True,
+        error_message="No se pudo crear el lead",
+        fallback_error="No se pudo crear el lead: datos incompletos o invalidos.",
+    ),
+    ToolSpec(
+        name="update_admissions_lead",
+        request_model=UpdateAdmissionsLeadRequest,
+        handler=f"{_ROUTER}:_update_admissions_lead",
+        access=tool_access(writes=(LEADS,)),
+        side_effects=True,
+        error_message="No se pudo actualizar el lead",
+        fallback_error="No se pudo actualizar el lead: datos invalidos.",
+        marks_lead_note=lambda args: bool(args.notes),
+    ),
+    ToolSpec(
+        name="add_lead_note",
+        request_model=AddLeadNoteRequest,
+        handler=f"{_ROUTER}:_add_lead_note",
+        access=tool_access(writes=(LEADS, NOTE_STATE)),
+        side_effects=True,
+        error_message="No se pudo agregar la nota",
+        fallback_error="No se pudo agregar la nota al lead.",
+        marks_lead_note=lambda args: True,
+    ),
+    ToolSpec(
+        name="get_next_event",
+        request_model=GetNextEventRequest,
+        handler=f"{_ROUTER}:_get_next_event",
+        access=tool_access(reads=(LEADS,), writes=(EVENT_STATE,)),
+        cacheable=True,
+        error_message="Error al buscar eventos",
+    ),
+    ToolSpec(
+        name="register_event",
+        request_model=RegisterEventRequest,
+        handler=f"{_ROUTER}:_register_event",
+        context=("org", "chat", "session_id"),
+        access=tool_access(writes=(LEADS, EVENT_STATE, OUTBOUND)),
+        side_effects=True,
+        error_message="Error al registrar evento",
+    ),
+    ToolSpec(
+        name="get_admission_requirements",
+        request_model=GetRequirementsRequest,
+        handler=f"{_ROUTER}:_send_requirements_if_requested",
+        context=("org", "chat", "session_id", "combined_user"),
+        access=tool_access(writes=(OUTBOUND,)),
+        side_effects=True,
+        error_message="Error al enviar requisitos",
+    ),
+    ToolSpec(
+        name="search_availability_slots",
+        request_model=SearchSlotsRequest,
+        handler=f"{_ROUTER}:_search_availability_slots",
+        # Clearing stale slot options also touches the lead's metadata.
+        access=tool_access(reads=(LEADS,), writes=(SLOT_STATE, LEAD_SLOT_METADATA)),
+        cacheable=True,
+        error_message="Error al buscar horarios",
+    ),
+    ToolSpec(
+        name="book_appointment",
+        request_model=BookAppointmentRequest,
+        handler=f"{_ROUTER}:_book_appointment",
+        access=tool_access(writes=(LEADS, SLOT_STATE, LEAD_SLOT_METADATA)),
+        side_effects=True,
+        error_message="Error al agendar cita",
+    ),
+    ToolSpec(
+        name="reschedule_appointment",
+        request_model=RescheduleAppointmentRequest,
+        handler=f"{_ROUTER}:_reschedule_appointment",
+        access=tool_access(writes=(LEADS, SLOT_STATE, LEAD_SLOT_METADATA)),
+        side_effects=True,
+        error_message="Error al reagendar cita",
+    ),
+    ToolSpec(
+        name="cancel_appointment",
+        request_model=CancelAppointmentRequest,
+        handler=f"{_ROUTER}:_cancel_appointment",
+        access=tool_access(writes=(LEADS,)),
+        side_effects=True,
+        error_message="Error al cancelar cita",
+    ),
+    ToolSpec(
+        name="close_chat_session",
+        request_model=CloseChatSessionRequest,
+        handler=f"{_ROUTER}:_close_chat_session",
+        context=("org", "chat", "session_id"),
+        access=tool_access(writes=(EXCLUSIVE,)),
+        side_effects=True,
+        error_message="Error al cerrar la sesión",
+    ),
+    ToolSpec(
+        name="get_lead_status",
+        request_model=GetLeadStatusRequest,
+        handler=f"{_ROUTER}:_get_lead_status",
+        access=tool_access(reads=(LEADS,)),
+        cacheable=True,
+        timeout=15.0,
+        error_message="Error al consultar estado",
+    ),
+)
+
+
+# ── Per-turn state ───────────────────────────────────────────────
+
+
+class ToolMemo:
+    """Results of cacheable tools for one turn, keyed by name + arguments."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._results: Dict[Tuple[str, str], str] = {}
+
+    def get(self, key: Tuple[str, str]) -> Optional[str]:
+        with self._lock:
+            return self._results.get(key)
+
+    def store(self, key: Tuple[str, str], output: str) -> None:
+        with self._lock:
+            self._results[key] = output
+
+    def clear(self) -> None:
+        with self._lock:
+            self._results.clear()
+
+
+@dataclass
+class ToolContext:
+    org: Dict[str, Any]
+    chat: Dict[str, Any]
+    session_id: str
+    combined_user: str = ""
+    memo: ToolMemo = field(default_factory=ToolMemo)
+
+
+@dataclass
+class ToolResult:
+    name: str
+    call_id: Optional[str]
+    output: str
+    note_added: bool = False
+    cached: bool = False
+
+    def as_output_item(self) -> Dict[str, Any]:
+        return {
+            "type": "function_call_output",
+            "call_id": self.call_id,
+            "output": self.output,
+        }
+
+
+# ── Metrics ──────────────────────────────────────────────────────
+
+LATENCY_BUCKETS_MS = (50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class ToolMetrics:
+    """Latency histogram and counters per tool since process start."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._tools: Dict[str, Dict[str, Any]] = {}
+
+    def _tool(self, name: str) -> Dict[str, Any]:
+        tool = self._tools.get(name)
+        if tool is None:
+            tool = {
+                "count": 0,
+                "errors": 0,
+                "timeouts": 0,
+                "memo_hits": 0,
+                "total_ms": 0.0,
+                "max_ms": 0.0,
+                "buckets": [0] * (len(LATENCY_BUCKETS_MS) + 1),
+            }
+            self._tools[name] = tool
+        return tool
+
+    def record(self, name: str, elapsed_ms: float, ok: bool) -> None:
+        index = next(
+            (i for i, bound in enumerate(LATENCY_BUCKETS_MS) if elapsed_ms <= bound),
+            len(LATENCY_BUCKETS_MS),
+        )
+        with self._lock:
+            tool = self._tool(name)
+            tool["count"] += 1
+            tool["total_ms"] += elapsed_ms
+            tool["max_ms"] = max(tool["max_ms"], elapsed_ms)
+            tool["buckets"][index] += 1
+            if not ok:
+                tool["errors"] += 1
+
+    def record_memo_hit(self, name: str) -> None:
+        with self._lock:
+            self._tool(name)["memo_hits"] += 1
+
+    def record_timeout(self, name: str) -> None:
+        with self._lock:
+            self._tool(name)["timeouts"] += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        labels = [f"le_{bound}ms" for bound in LATENCY_BUCKETS_MS] + ["inf"]
+        with self._lock:
+            return {
+                name: {
+                    "count": tool["count"],
+                    "errors": tool["errors"],
+                    "timeouts": tool["timeouts"],
+                    "memo_hits": tool["memo_hits"],
+                    "avg_ms": round(tool["total_ms"] / tool["count"], 1) if tool["count"] else None,
+                    "max_ms": round(tool["max_ms"], 1),
+                    "total_ms": round(tool["total_ms"], 1),
+                    "histogram": dict(zip(labels, tool["buckets"])),
+                }
+                for name, tool in sorted(
+                    self._tools.items(), key=lambda item: -item[1]["total_ms"]
+                )
+            }
+
+
+tool_metrics = ToolMetrics()
+
+
+# ── Registry ─────────────────────────────────────────────────────
+
+
+def _memo_key(name: str, arguments: Optional[str]) -> Tuple[str, str]:
+    try:
+        normalized = json.dumps(json.loads(arguments or "{}"), sort_keys=True)
+    except ValueError:
+        normalized = arguments or ""
+    return name, normalized
+
+
+class ToolRegistry:
+    def __init__(self, specs: Tuple[ToolSpec, ...]) -> None:
+        self._specs = {spec.name: spec for spec in specs}
+        self._handlers: Dict[str, Callable[..., str]] = {}
+
+    def get(self, name: Optional[str]) -> Optional[ToolSpec]:
+        return self._specs.get(name or "")
+
+    def names(self) -> List[str]:
+        return list(self._specs)
+
+    def _handler(self, spec: ToolSpec) -> Callable[..., str]:
+        handler = self._handlers.get(spec.name)
+        if handler is None:
+            module_name, func_name = spec.handler.split(":")
+            handler = getattr(importlib.import_module(module_name), func_name)
+            self._handlers[spec.name] = handler
+        return handler
+
+    # Hooks for execute_tool_calls
+
+    def access_for(self, call: Any) -> ToolAccess:
+        spec = self.get(call.name)
+        return spec.access if spec else EXCLUSIVE_ACCESS
+
+    def timeout_for(self, call: Any) -> Optional[float]:
+        spec = self.get(call.name)
+        return spec.timeout if spec else None
+
+    def on_timeout(self, call: Any) -> ToolResult:
+        spec = self.get(call.name)
+        tool_metrics.record_timeout(call.name)
+        print("[admissions] tool timeout", {"tool_name": call.name})
+        return ToolResult(
+            name=call.name,
+            call_id=call.call_id,
+            output=f"{spec.error_message}: la consulta tardo demasiado, intenta de nuevo.",
+        )
+
+    # Execution
+
+    def run(self, call: Any, ctx: ToolContext) -> ToolResult:
+        tool_name = call.name
+        tool_args_json = call.arguments
+        print(
+            "[admissions] tool call received",
+            {"tool_name": tool_name, "args": tool_args_json},
+        )
+        spec = self.get(tool_name)
+        if spec is None:
+            return ToolResult(name=tool_name, call_id=call.call_id, output=UNKNOWN_TOOL_TEXT)
+
+        memo_key = _memo_key(tool_name, tool_args_json) if spec.cacheable else None
+        if memo_key:
+            cached = ctx.memo.get(memo_key)
+            if cached is not None:
+                tool_metrics.record_memo_hit(tool_name)
+                print("[admissions] tool result (memoized)", {"tool_name": tool_name})
+                return ToolResult(
+                    name=tool_name, call_id=call.call_id, output=cached, cached=True
+                )
+
+        ok = False
+        note_added = False
+        started = time.perf_counter()
+        try:
+            tool_args = spec.request_model.model_validate_json(tool_args_json)
+            kwargs = {key: getattr(ctx, key) for key in spec.context}
+            tool_result = self._handler(spec)(tool_args, **kwargs)
+            note_added = bool(spec.marks_lead_note and spec.marks_lead_note(tool_args))
+            ok = True
+        except HTTPException as exc:
+            tool_result = (
+                f"{spec.error_message}: {exc.detail}"
+                if spec.fallback_error
+                else f"{spec.error_message}: {str(exc)}"
+            )
+        except Exception as exc:
+            tool_result = spec.fallback_error or f"{spec.error_message}: {str(exc)}"
+        tool_metrics.record(tool_name, (time.perf_counter() - started) * 1000, ok)
+
+        if ok and spec.side_effects:
+            ctx.memo.clear()
+        elif ok and memo_key:
+            ctx.memo.store(memo_key, tool_result)
+
+        print(
+            "[admissions] tool result",
+            {"tool_name": tool_name, "result": tool_result},
+        )
+        return ToolResult(
+            name=tool_name,
+            call_id=call.call_id,
+            output=tool_result,
+            note_added=note_added,
+        )
+
+    def execute(self, calls: List[Any], ctx: ToolContext) -> List[ToolResult]:
+        """Run the calls of one model response; results keep call order."""
+        return execute_tool_calls(
+            calls,
+            lambda call: self.run(call, ctx),
+            access_for=self.access_for,
+            timeout_for=self.timeout_for,
+            on_timeout=self.on_timeout,
+        )
+
+
+tool_registry = ToolRegistry(TOOL_SPECS)
@@ -0,0 +1,120 @@
+"""
+Turn bootstrap: everything a WhatsApp turn needs before calling the model.
+
+``get_turn_context`` (Postgres) loads the chat, organization, active session
+(creating it when needed), the most recent session messages plus the
+rolling history summary, leads and scheduled appointments in a single
+round-trip.  ``TurnContext`` is the typed view shared by the sync and async
+pipelines and the helpers they call.
+"""
+
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+from fastapi import HTTPException
+
+from app.core.config import settings
+from app.core.supabase import (
+    get_async_supabase_client,
+    get_supabase_client,
+    get_supabase_data,
+    get_supabase_error,
+)
+from app.whatsapp.lead_repository import invalidate_chat_leads
+
+
+@dataclass
+class TurnContext:
+    chat: Dict[str, Any]
+    org: Dict[str, Any]
+    session_id: str
+    session_created: bool = False
+    last_inbound_message_id: Optional[str] = None
+    # Most recent messages not yet folded into ``history_summary``
+    messages: List[Dict[str, Any]] = field(default_factory=list)
+    history_summary: Optional[str] = None
+    # All messages after the summary (may exceed ``len(messages)``)
+    unsummarized_count: int = 0
+    leads: List[Dict[str, Any]] = field(default_factory=list)
+    appointments: List[Dict[str, Any]] = field(default_factory=list)
+
+    @property
+    def lead(self) -> Optional[Dict[str, Any]]:
+        """The most recent (primary) lead for the chat."""
+        return self.leads[0] if self.leads else None
+
+    @property
+    def appointments_by_lead(self) -> Dict[str, Dict[str, Any]]:
+        """Latest scheduled appointment per lead id."""
+        appt_map: Dict[str, Dict[str, Any]] = {}
+        for appt in self.appointments:
+            appt_map.setdefault(appt.get("lead_id"), appt)
+        return appt_map
+
+    @classmethod
+    def from_payload(cls, payload: Optional[Dict[str, Any]]) -> "TurnContext":
+        if not payload or not payload.get("chat"):
+            raise HTTPException(status_code=404, detail="Chat not found")
+        if not payload.get("organization"):
+            raise HTTPException(status_code=404, detail="Organization not found")
+        return cls(
+            chat=payload["chat"],
+            org=payload["organization"],
+            session_id=payload.get("session_id"),
+            session_created=bool(payload.get("session_created")),
+            last_inbound_message_id=payload.get("last_inbound_wa_message_id"),
+            messages=payload.get("messages") or [],
+            history_summary=payload.get("history_summary"),
+            unsummarized_count=int(payload.get("unsummarized_count") or 0),
+            leads=payload.get("leads") or [],
+            appointments=payload.get("appointments") or [],
+        )
+
+
+def _context_from_response(response: Any, chat_id: str) -> TurnContext:
+    error = get_supabase_error(response)
+    if error:
+        print("[turn_context] get_turn_context failed", {"chat_id": chat_id, "error": str(error)})
+        raise HTTPException(status_code=500, detail="Failed to load turn context")
+    ctx = TurnContext.from_payload(get_supabase_data(response))
+    print(
+        "[turn_context] loaded",
+        {
+            "chat_id": chat_id,
+            "session_id": ctx.session_id,
+            "session_created": ctx.session_created,
+            "messages": len(ctx.messages),
+            "leads": len(ctx.leads),
+        },
+    )
+    return ctx
+
+
+def _rpc_params(chat_id: str) -> Dict[str, Any]:
+    return {
+        "p_chat_id": chat_id,
+        "p_message_limit": settings.history_fetch_limit,
+        "p_min_messages": settings.history_max_messages,
+    }
+
+
+def load_turn_context(chat_id: str) -> TurnContext:
+    supabase = get_supabase_client()
+    response = supabase.rpc("get_turn_context", _rpc_params(chat_id)).execute()
+    return _context_from_response(response, chat_id)
+
+
+async def load_turn_context_async(chat_id: str) -> TurnContext:
+    supabase = await get_async_supabase_client()
+    response = await supabase.rpc("get_turn_context", _rpc_params(chat_id)).execute()
+    return _context_from_response(response, chat_id)
+
+
+def get_turn_context(chat: Dict[str, Any]) -> Optional[TurnContext]:
+    """Return the context attached to *chat* for the current turn, if any."""
+    return chat.get("_turn_context")
+
+
+def invalidate_turn_leads(chat: Dict[str, Any]) -> None:
+    """A write made the bootstrap leads outdated; the repository reloads them."""
+    invalidate_chat_leads(chat)
@@ -0,0 +1,153 @@
+-- Single round-trip bootstrap for a WhatsApp turn.
+-- Loads chat + organization, ensures an active chat session, backfills
+-- chat_session_id on orphan messages and returns the session messages,
+-- the chat's leads (wa_chat_id, falling back to wa_id) and their scheduled
+-- appointments as one JSON document.
+
+create or replace function public.get_turn_context(p_chat_id uuid)
+returns jsonb
+language plpgsql
+security definer
+set search_path = public
+as $$
+declare
+  v_chat public.chats%rowtype;
+  v_org jsonb;
+  v_session_id uuid;
+  v_session_created boolean := false;
+  v_last_inbound text;
+  v_messages jsonb;
+  v_leads jsonb;
+  v_lead_ids uuid[];
+  v_appointments jsonb;
+begin
+  select *
+    into v_chat
+  from public.chats c
+  where c.id = p_chat_id;
+
+  if not found then
+    return null;
+  end if;
+
+  select jsonb_build_object(
+           'id', o.id,
+           'name', o.name,
+           'bot_name', o.bot_name,
+           'bot_instructions', o.bot_instructions,
+           'bot_tone', o.bot_tone,
+           'bot_language', o.bot_language,
+           'bot_model', o.bot_model,
+           'phone_number_id', o.phone_number_id
+         )
+    into v_org
+  from public.organizations o
+  where o.id = v_chat.organization_id;
+
+  if v_org is null then
+    return jsonb_build_object(
+      'chat', jsonb_build_object('id', v_chat.id, 'organization_id', v_chat.organization_id),
+      'organization', null
+    );
+  end if;
+
+  select m.wa_message_id
+    into v_last_inbound
+  from public.messages m
+  where m.chat_id = v_chat.id
+    and m.direction = 'inbound'
+  order by m.created_at desc
+  limit 1;
+
+  select s.id
+    into v_session_id
+  from public.chat_sessions s
+  where s.id = v_chat.active_session_id
+    and s.status = 'active';
+
+  if v_session_id is null then
+    insert into public.chat_sessions (chat_id, organization_id, status, created_at, updated_at)
+    values (
+      v_chat.id,
+      v_chat.organization_id,
+      'active',
+      timezone('utc'::text, now()),
+      timezone('utc'::text, now())
+    )
+    returning id into v_session_id;
+
+    update public.chats
+       set active_session_id = v_session_id,
+           updated_at = timezone('utc'::text, now())
+     where id = v_chat.id;
+
+    v_session_created := true;
+  end if;
+
+  update public.messages
+     set chat_session_id = v_session_id
+   where chat_id = v_chat.id
+     and chat_session_id is null;
+
+  select coalesce(jsonb_agg(to_jsonb(x) order by x.created_at desc), '[]'::jsonb)
+    into v_messages
+  from (
+    select m.role, m.body, m.created_at, m.wa_timestamp
+    from public.messages m
+    where m.chat_session_id = v_session_id
+  ) x;
+
+  select coalesce(jsonb_agg(to_jsonb(x) order by x.created_at desc), '[]'::jsonb),
+         array_agg(x.id)
+    into v_leads, v_lead_ids
+  from (
+    select l.id, l.lead_number, l.status, l.metadata, l.notes, l.contact_id,
+           l.student_first_name, l.student_middle_name,
+           l.student_last_name_paternal, l.student_last_name_maternal,
+           l.student_dob, l.grade_interest, l.current_school,
+           l.contact_name, l.contact_email, l.contact_phone, l.created_at
+    from public.leads l
+    where l.organization_id = v_chat.organization_id
+      and (
+        l.wa_chat_id = v_chat.id
+        or (
+          l.wa_id = v_chat.wa_id
+          and not exists (
+            select 1
+            from public.leads l2
+            where l2.organization_id = v_chat.organization_id
+              and l2.wa_chat_id = v_chat.id
+          )
+        )
+      )
+  ) x;
+
+  select coalesce(jsonb_agg(to_jsonb(x) order by x.created_at desc), '[]'::jsonb)
+    into v_appointments
+  from (
+    select a.id, a.lead_id, a.slot_id, a.starts_at, a.ends_at, a.status, a.created_at
+    from public.appointments a
+    where a.lead_id = any(coalesce(v_lead_ids, array[]::uuid[]))
+      and a.status = 'scheduled'
+  ) x;
+
+  return jsonb_build_object(
+    'chat', jsonb_build_object(
+      'id', v_chat.id,
+      'wa_id', v_chat.wa_id,
+      'organization_id', v_chat.organization_id,
+      'active_session_id', v_session_id,
+      'state_context', v_chat.state_context
+    ),
+    'organization', v_org,
+    'session_id', v_session_id,
+    'session_created', v_session_created,
+    'last_inbound_wa_message_id', v_last_inbound,
+    'messages', v_messages,
+    'leads', v_leads,
+    'appointments', v_appointments
+  );
+end;
+$$;
+
+grant execute on function public.get_turn_context(uuid) to service_role;
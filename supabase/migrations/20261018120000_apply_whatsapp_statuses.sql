@@ -0,0 +1,81 @@
+-- Bulk WhatsApp status ingestion: one call per webhook instead of one
+-- UPDATE per status entry.  Statuses never move backwards (a late
+-- "delivered" after "read" only fills delivered_at), and status details are
+-- merged into messages.payload instead of replacing it.
+
+create or replace function public.whatsapp_status_rank(p_status text)
+returns integer
+language sql
+immutable
+as $$
+  select case p_status
+    when 'sent' then 1
+    when 'delivered' then 2
+    when 'read' then 3
+    when 'failed' then 4
+    when 'deleted' then 5
+    else 0
+  end;
+$$;
+
+create or replace function public.apply_whatsapp_statuses(p_statuses jsonb)
+returns integer
+language plpgsql
+security definer
+set search_path = public
+as $$
+declare
+  v_updated integer;
+begin
+  with incoming as (
+    select distinct on (s.wa_message_id)
+      s.wa_message_id,
+      s.status,
+      s.status_detail,
+      s.sent_at,
+      s.delivered_at,
+      s.read_at
+    from jsonb_to_recordset(coalesce(p_statuses, '[]'::jsonb)) as s(
+      wa_message_id text,
+      status text,
+      status_detail jsonb,
+      sent_at timestamptz,
+      delivered_at timestamptz,
+      read_at timestamptz
+    )
+    where s.wa_message_id is not null
+    order by s.wa_message_id, public.whatsapp_status_rank(s.status) desc
+  )
+  update public.messages m
+  set
+    status = case
+      when public.whatsapp_status_rank(i.status) > public.whatsapp_status_rank(m.status)
+        then i.status
+      else m.status
+    end,
+    sent_at = coalesce(m.sent_at, i.sent_at),
+    delivered_at = coalesce(m.delivered_at, i.delivered_at),
+    read_at = coalesce(m.read_at, i.read_at),
+    payload = case
+      when public.whatsapp_status_rank(i.status) >= public.whatsapp_status_rank(m.status)
+        then case
+          when jsonb_typeof(m.payload) = 'object' then m.payload
+          else '{}'::jsonb
+        end || jsonb_build_object('status_detail', i.status_detail)
+      else m.payload
+    end
+  from incoming i
+  where m.wa_message_id = i.wa_message_id
+    and (
+      public.whatsapp_status_rank(i.status) > public.whatsapp_status_rank(m.status)
+      or (m.sent_at is null and i.sent_at is not null)
+      or (m.delivered_at is null and i.delivered_at is not null)
+      or (m.read_at is null and i.read_at is not null)
+    );
+
+  get diagnostics v_updated = row_count;
+  return v_updated;
+end;
+$$;
+
+grant execute on function public.apply_whatsapp_statuses(jsonb) to service_role;
@@ -0,0 +1,119 @@
+-- Batched inbound ingestion: every message of a webhook is stored in one
+-- transaction.  Chats are upserted with RETURNING (no re-select), duplicates
+-- are skipped by the messages_wa_message_id_key constraint, and the
+-- debounce queue is accumulated once per chat with the new texts in order.
+
+create or replace function public.ingest_whatsapp_messages(
+  p_organization_id uuid,
+  p_phone_number text,
+  p_messages jsonb
+)
+returns jsonb
+language plpgsql
+security definer
+set search_path = public
+as $$
+declare
+  v_result jsonb;
+begin
+  with incoming as (
+    select m.ordinality as position, m.value as item
+    from jsonb_array_elements(coalesce(p_messages, '[]'::jsonb))
+      with ordinality as m(value, ordinality)
+    where coalesce(m.value->>'wa_id', '') <> ''
+  ),
+  chat_input as (
+    select distinct on (i.item->>'wa_id')
+      i.item->>'wa_id' as wa_id,
+      i.item->>'name' as name
+    from incoming i
+    order by i.item->>'wa_id', i.position desc
+  ),
+  upserted_chats as (
+    insert into public.chats (wa_id, name, phone_number, organization_id, updated_at)
+    select ci.wa_id, ci.name, p_phone_number, p_organization_id, timezone('utc', now())
+    from chat_input ci
+    on conflict (wa_id, organization_id) do update
+      set name = excluded.name,
+          phone_number = excluded.phone_number,
+          updated_at = excluded.updated_at
+    returning id, wa_id
+  ),
+  inserted as (
+    insert into public.messages (
+      chat_id,
+      chat_session_id,
+      wa_message_id,
+      body,
+      type,
+      status,
+      direction,
+      role,
+      payload,
+      wa_timestamp,
+      sender_name,
+      media_id,
+      media_mime_type,
+      created_at
+    )
+    select
+      c.id,
+      null,
+      i.item->>'wa_message_id',
+      i.item->>'body',
+      i.item->>'type',
+      'received',
+      'inbound',
+      'user',
+      i.item->'payload',
+      (i.item->>'wa_timestamp')::timestamptz,
+      i.item->>'name',
+      i.item->>'media_id',
+      i.item->>'media_mime_type',
+      (i.item->>'wa_timestamp')::timestamptz
+    from incoming i
+    join upserted_chats c on c.wa_id = i.item->>'wa_id'
+    order by i.position
+    on conflict (wa_message_id) do nothing
+    returning id, chat_id, wa_message_id, body, media_id, created_at
+  ),
+  queued as (
+    insert into public.message_queue (chat_id, combined_text, last_added_at)
+    select
+      ins.chat_id,
+      coalesce(string_agg(nullif(ins.body, ''), ' ' order by ins.created_at, ins.id), ''),
+      now()
+    from inserted ins
+    group by ins.chat_id
+    on conflict (chat_id) do update
+      set combined_text = case
+            when message_queue.combined_text is null or message_queue.combined_text = '' then excluded.combined_text
+            when excluded.combined_text is null or excluded.combined_text = '' then message_queue.combined_text
+            else message_queue.combined_text || ' ' || excluded.combined_text
+          end,
+          last_added_at = now()
+    returning chat_id
+  )
+  select jsonb_build_object(
+    'chat_ids', coalesce((select jsonb_agg(distinct q.chat_id) from queued q), '[]'::jsonb),
+    'messages', coalesce(
+      (
+        select jsonb_agg(jsonb_build_object(
+          'id', ins.id,
+          'chat_id', ins.chat_id,
+          'wa_message_id', ins.wa_message_id,
+          'media_id', ins.media_id
+        ))
+        from inserted ins
+      ),
+      '[]'::jsonb
+    ),
+    'received', (select count(*) from incoming)
+  )
+  into v_result;
+
+  return v_result;
+end;
+$$;
+
+grant execute on function public.ingest_whatsapp_messages(uuid, text, jsonb) to service_role;
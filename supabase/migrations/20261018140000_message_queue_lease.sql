@@ -0,0 +1,138 @@
+-- Lease-based claiming of message_queue rows for the in-process debounce
+-- scheduler (app/whatsapp/debounce.py).  Several API workers can hold a
+-- timer for the same chat; only the one whose quiet window has really
+-- elapsed in the database and that wins the lease processes the batch.
+-- An expired lease (crashed worker) can be taken over.
+
+alter table public.message_queue
+  add column if not exists lease_owner text,
+  add column if not exists lease_expires_at timestamptz;
+
+create or replace function public.claim_message_queue(
+  p_chat_id uuid,
+  p_owner text,
+  p_quiet_ms integer,
+  p_lease_seconds integer default 120
+)
+returns jsonb
+language plpgsql
+security definer
+set search_path = public
+as $$
+declare
+  v_queue public.message_queue%rowtype;
+  v_wait_ms integer;
+  v_lease_until timestamptz;
+begin
+  select *
+    into v_queue
+  from public.message_queue q
+  where q.chat_id = p_chat_id
+  for update;
+
+  if not found then
+    return jsonb_build_object('status', 'empty');
+  end if;
+
+  if coalesce(v_queue.combined_text, '') = '' and not v_queue.is_processing then
+    delete from public.message_queue where chat_id = p_chat_id;
+    return jsonb_build_object('status', 'empty');
+  end if;
+
+  -- A newer message arrived (possibly on another worker): keep waiting.
+  v_wait_ms := p_quiet_ms - floor(extract(epoch from (now() - v_queue.last_added_at)) * 1000)::integer;
+  if v_wait_ms > 0 then
+    return jsonb_build_object('status', 'pending', 'wait_ms', v_wait_ms);
+  end if;
+
+  if v_queue.is_processing then
+    -- Rows locked by the edge function have no lease; give them one
+    -- lease period from the last message before taking them over.
+    v_lease_until := coalesce(
+      v_queue.lease_expires_at,
+      v_queue.last_added_at + make_interval(secs => p_lease_seconds)
+    );
+    if v_lease_until > now() then
+      return jsonb_build_object(
+        'status', 'busy',
+        'wait_ms', ceil(extract(epoch from (v_lease_until - now())) * 1000)::integer
+      );
+    end if;
+  end if;
+
+  update public.message_queue
+  set is_processing = true,
+      lease_owner = p_owner,
+      lease_expires_at = now() + make_interval(secs => p_lease_seconds)
+  where chat_id = p_chat_id;
+
+  return jsonb_build_object(
+    'status', 'claimed',
+    'combined_text', v_queue.combined_text,
+    'last_added_at', v_queue.last_added_at
+  );
+end;
+$$;
+
+create or replace function public.release_message_queue(
+  p_chat_id uuid,
+  p_owner text,
+  p_processed_text text,
+  p_success boolean
+)
+returns jsonb
+language plpgsql
+security definer
+set search_path = public
+as $$
+declare
+  v_queue public.message_queue%rowtype;
+  v_remaining text;
+begin
+  select *
+    into v_queue
+  from public.message_queue q
+  where q.chat_id = p_chat_id
+  for update;
+
+  if not found then
+    return jsonb_build_object('status', 'empty');
+  end if;
+
+  if v_queue.lease_owner is distinct from p_owner then
+    return jsonb_build_object('status', 'lost');
+  end if;
+
+  if not p_success then
+    update public.message_queue
+    set is_processing = false,
+        lease_owner = null,
+        lease_expires_at = null
+    where chat_id = p_chat_id;
+    return jsonb_build_object('status', 'released');
+  end if;
+
+  -- Messages accumulated while the turn was running stay queued.
+  if v_queue.combined_text <> coalesce(p_processed_text, '')
+     and left(v_queue.combined_text, length(coalesce(p_processed_text, ''))) = coalesce(p_processed_text, '') then
+    v_remaining := btrim(substr(v_queue.combined_text, length(coalesce(p_processed_text, '')) + 1));
+  end if;
+
+  if coalesce(v_remaining, '') = '' then
+    delete from public.message_queue where chat_id = p_chat_id;
+    return jsonb_build_object('status', 'done');
+  end if;
+
+  update public.message_queue
+  set combined_text = v_remaining,
+      is_processing = false,
+      lease_owner = null,
+      lease_expires_at = null
+  where chat_id = p_chat_id;
+
+  return jsonb_build_object('status', 'requeued', 'combined_text', v_remaining);
+end;
+$$;
+
+grant execute on function public.claim_message_queue(uuid, text, integer, integer) to service_role;
+grant execute on function public.release_message_queue(uuid, text, text, boolean) to service_role;
@@ -0,0 +1,320 @@
+-- Durable work queue for chat turns.
+--
+-- A chat_jobs row means "process the pending message_queue text of this
+-- chat".  Workers claim jobs with FOR UPDATE SKIP LOCKED and hold a lease
+-- (visibility timeout) while the turn runs; an expired lease makes the job
+-- claimable again, failures are retried with exponential backoff and jobs
+-- that run out of attempts move to chat_jobs_dead_letter.  At most one
+-- queued/running job exists per chat, so two replicas never answer the same
+-- batch.
+
+create table if not exists public.chat_jobs (
+  id bigint generated always as identity primary key,
+  chat_id uuid not null references public.chats(id) on delete cascade,
+  status text not null default 'queued',
+  attempts integer not null default 0,
+  max_attempts integer not null default 5,
+  run_after timestamptz not null default now(),
+  lease_owner text,
+  lease_expires_at timestamptz,
+  last_error text,
+  created_at timestamptz not null default now(),
+  updated_at timestamptz not null default now(),
+  constraint chat_jobs_status_check check (status in ('queued', 'running'))
+);
+
+create unique index if not exists chat_jobs_active_chat_idx
+  on public.chat_jobs (chat_id);
+
+create index if not exists chat_jobs_claim_idx
+  on public.chat_jobs (status, run_after);
+
+create index if not exists chat_jobs_lease_idx
+  on public.chat_jobs (lease_expires_at)
+  where status = 'running';
+
+alter table public.chat_jobs enable row level security;
+
+create table if not exists public.chat_jobs_dead_letter (
+  id bigint generated always as identity primary key,
+  job_id bigint not null,
+  chat_id uuid not null,
+  attempts integer not null,
+  last_error text,
+  combined_text text,
+  job_created_at timestamptz,
+  failed_at timestamptz not null default now()
+);
+
+create index if not exists chat_jobs_dead_letter_chat_idx
+  on public.chat_jobs_dead_letter (chat_id, failed_at desc);
+
+alter table public.chat_jobs_dead_letter enable row level security;
+
+-- Move a job to the dead-letter table (caller holds the row lock).
+create or replace function public.dead_letter_chat_job(p_job_id bigint, p_error text)
+returns void
+language plpgsql
+security definer
+set search_path = public
+as $$
+begin
+  with moved as (
+    delete from public.chat_jobs j
+    where j.id = p_job_id
+    returning j.*
+  )
+  insert into public.chat_jobs_dead_letter (
+    job_id, chat_id, attempts, last_error, combined_text, job_created_at
+  )
+  select m.id, m.chat_id, m.attempts, coalesce(p_error, m.last_error), q.combined_text, m.created_at
+  from moved m
+  left join public.message_queue q on q.chat_id = m.chat_id;
+end;
+$$;
+
+create or replace function public.enqueue_chat_job(
+  p_chat_id uuid,
+  p_quiet_ms integer default 0,
+  p_max_attempts integer default 5
+)
+returns jsonb
+language plpgsql
+security definer
+set search_path = public
+as $$
+declare
+  v_queue public.message_queue%rowtype;
+  v_wait_ms integer;
+  v_job_id bigint;
+begin
+  select *
+    into v_queue
+  from public.message_queue q
+  where q.chat_id = p_chat_id;
+
+  if not found or coalesce(v_queue.combined_text, '') = '' then
+    return jsonb_build_object('status', 'empty');
+  end if;
+
+  v_wait_ms := p_quiet_ms - floor(extract(epoch from (now() - v_queue.last_added_at)) * 1000)::integer;
+  if v_wait_ms > 0 then
+    return jsonb_build_object('status', 'pending', 'wait_ms', v_wait_ms);
+  end if;
+
+  insert into public.chat_jobs (chat_id, max_attempts)
+  values (p_chat_id, greatest(p_max_attempts, 1))
+  on conflict (chat_id) do nothing
+  returning id into v_job_id;
+
+  if v_job_id is null then
+    -- The active job picks the new text up (or re-queues it on completion).
+    return jsonb_build_object('status', 'exists');
+  end if;
+
+  return jsonb_build_object('status', 'queued', 'job_id', v_job_id);
+end;
+$$;
+
+create or replace function public.claim_chat_jobs(
+  p_owner text,
+  p_limit integer,
+  p_lease_seconds integer default 120
+)
+returns jsonb
+language plpgsql
+security definer
+set search_path = public
+as $$
+declare
+  v_expired bigint;
+  v_jobs jsonb;
+begin
+  -- Abandoned jobs (worker died mid-turn) that are out of attempts.
+  for v_expired in
+    select j.id
+    from public.chat_jobs j
+    where j.status = 'running'
+      and j.lease_expires_at < now()
+      and j.attempts >= j.max_attempts
+    for update skip locked
+  loop
+    perform public.dead_letter_chat_job(v_expired, 'lease expired');
+  end loop;
+
+  with candidates as (
+    select j.id
+    from public.chat_jobs j
+    where (j.status = 'queued' and j.run_after <= now())
+       or (j.status = 'running' and j.lease_expires_at < now())
+    order by j.run_after, j.id
+    for update skip locked
+    limit greatest(p_limit, 0)
+  ),
+  claimed as (
+    update public.chat_jobs j
+    set status = 'running',
+        attempts = j.attempts + 1,
+        lease_owner = p_owner,
+        lease_expires_at = now() + make_interval(secs => p_lease_seconds),
+        updated_at = now()
+    from candidates c
+    where j.id = c.id
+    returning j.id, j.chat_id, j.attempts, j.max_attempts
+  )
+  select coalesce(
+           jsonb_agg(jsonb_build_object(
+             'id', c.id,
+             'chat_id', c.chat_id,
+             'attempts', c.attempts,
+             'max_attempts', c.max_attempts,
+             'combined_text', coalesce(q.combined_text, ''),
+             'last_added_at', q.last_added_at
+           )),
+           '[]'::jsonb
+         )
+    into v_jobs
+  from claimed c
+  left join public.message_queue q on q.chat_id = c.chat_id;
+
+  return v_jobs;
+end;
+$$;
+
+create or replace function public.extend_chat_job_lease(
+  p_job_id bigint,
+  p_owner text,
+  p_lease_seconds integer default 120
+)
+returns boolean
+language plpgsql
+security definer
+set search_path = public
+as $$
+begin
+  update public.chat_jobs
+  set lease_expires_at = now() + make_interval(secs => p_lease_seconds),
+      updated_at = now()
+  where id = p_job_id
+    and status = 'running'
+    and lease_owner = p_owner;
+  return found;
+end;
+$$;
+
+create or replace function public.complete_chat_job(
+  p_job_id bigint,
+  p_owner text,
+  p_processed_text text
+)
+returns jsonb
+language plpgsql
+security definer
+set search_path = public
+as $$
+declare
+  v_job public.chat_jobs%rowtype;
+  v_queue public.message_queue%rowtype;
+  v_processed text := coalesce(p_processed_text, '');
+  v_remaining text;
+begin
+  select *
+    into v_job
+  from public.chat_jobs j
+  where j.id = p_job_id
+  for update;
+
+  if not found or v_job.lease_owner is distinct from p_owner then
+    return jsonb_build_object('status', 'lost');
+  end if;
+
+  delete from public.chat_jobs where id = p_job_id;
+
+  select *
+    into v_queue
+  from public.message_queue q
+  where q.chat_id = v_job.chat_id
+  for update;
+
+  if not found then
+    return jsonb_build_object('status', 'done');
+  end if;
+
+  -- Keep whatever text was accumulated while the turn was running.
+  if v_queue.combined_text <> v_processed
+     and left(v_queue.combined_text, length(v_processed)) = v_processed then
+    v_remaining := btrim(substr(v_queue.combined_text, length(v_processed) + 1));
+  end if;
+
+  if coalesce(v_remaining, '') = '' then
+    delete from public.message_queue where chat_id = v_job.chat_id;
+    return jsonb_build_object('status', 'done');
+  end if;
+
+  update public.message_queue
+  set combined_text = v_remaining,
+      is_processing = false,
+      lease_owner = null,
+      lease_expires_at = null
+  where chat_id = v_job.chat_id;
+
+  return jsonb_build_object(
+    'status', 'requeued',
+    'chat_id', v_job.chat_id,
+    'combined_text', v_remaining
+  );
+end;
+$$;
+
+create or replace function public.fail_chat_job(
+  p_job_id bigint,
+  p_owner text,
+  p_error text,
+  p_backoff_seconds integer default 5
+)
+returns jsonb
+language plpgsql
+security definer
+set search_path = public
+as $$
+declare
+  v_job public.chat_jobs%rowtype;
+  v_run_after timestamptz;
+begin
+  select *
+    into v_job
+  from public.chat_jobs j
+  where j.id = p_job_id
+  for update;
+
+  if not found or v_job.lease_owner is distinct from p_owner then
+    return jsonb_build_object('status', 'lost');
+  end if;
+
+  if v_job.attempts >= v_job.max_attempts then
+    perform public.dead_letter_chat_job(p_job_id, p_error);
+    return jsonb_build_object('status', 'dead');
+  end if;
+
+  v_run_after := now() + make_interval(
+    secs => least(p_backoff_seconds * power(2, greatest(v_job.attempts - 1, 0)), 600)
+  );
+
+  update public.chat_jobs
+  set status = 'queued',
+      run_after = v_run_after,
+      lease_owner = null,
+      lease_expires_at = null,
+      last_error = p_error,
+      updated_at = now()
+  where id = p_job_id;
+
+  return jsonb_build_object('status', 'retry', 'run_after', v_run_after);
+end;
+$$;
+
+grant execute on function public.enqueue_chat_job(uuid, integer, integer) to service_role;
+grant execute on function public.claim_chat_jobs(text, integer, integer) to service_role;
+grant execute on function public.extend_chat_job_lease(bigint, text, integer) to service_role;
+grant execute on function public.complete_chat_job(bigint, text, text) to service_role;
+grant execute on function public.fail_chat_job(bigint, text, text, integer) to service_role;
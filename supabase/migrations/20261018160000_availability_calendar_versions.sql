@@ -0,0 +1,60 @@
+-- Change counter for each organization's availability calendar.
+--
+-- The bot keeps an in-memory calendar of bookable slots per organization
+-- (app/whatsapp/slot_calendar.py).  Any insert/update/delete on
+-- availability_slots (bookings and cancellations update appointments_count,
+-- the dashboard edits or blocks slots) bumps the organization's version, so
+-- replicas only reload the calendar when this one-row lookup changes.  A
+-- NOTIFY is sent as well for listeners that prefer push over polling.
+
+create table if not exists public.availability_calendar_versions (
+  organization_id uuid primary key references public.organizations(id) on delete cascade,
+  version bigint not null default 0,
+  updated_at timestamptz not null default now()
+);
+
+alter table public.availability_calendar_versions enable row level security;
+
+create or replace function public.bump_availability_calendar_version()
+returns trigger
+language plpgsql
+security definer
+set search_path = public
+as $$
+declare
+  v_org_id uuid;
+begin
+  if tg_op = 'DELETE' then
+    v_org_id := old.organization_id;
+  else
+    v_org_id := new.organization_id;
+  end if;
+
+  insert into public.availability_calendar_versions (organization_id, version, updated_at)
+  values (v_org_id, 1, now())
+  on conflict (organization_id) do update
+    set version = availability_calendar_versions.version + 1,
+        updated_at = now();
+
+  perform pg_notify('availability_slots_changed', v_org_id::text);
+
+  if tg_op = 'UPDATE' and old.organization_id is distinct from new.organization_id then
+    update public.availability_calendar_versions
+       set version = version + 1,
+           updated_at = now()
+     where organization_id = old.organization_id;
+  end if;
+
+  return null;
+end;
+$$;
+
+drop trigger if exists availability_slots_bump_calendar_version on public.availability_slots;
+create trigger availability_slots_bump_calendar_version
+  after insert or update or delete on public.availability_slots
+  for each row execute function public.bump_availability_calendar_version();
+
+-- Range scans used to (re)load a calendar.
+create index if not exists availability_slots_org_starts_idx
+  on public.availability_slots (organization_id, starts_at)
+  where is_active and not is_blocked;
@@ -0,0 +1,150 @@
+-- Bookable availability slots, filtered entirely in Postgres.
+--
+-- Replaces the Python loop of search_availability_slots (weekday, business
+-- hours, capacity, morning/afternoon) and finally applies the per-org
+-- appointment_settings (days, hours, timezone, overbooking) and
+-- appointment_blackouts.  Dates and hours are evaluated in the
+-- organization's timezone (Torreón, UTC-6, when no settings row exists).
+-- Returns at most p_limit rows (null = no limit, used to warm the bot's
+-- in-memory calendar).
+
+-- Backs the range scan below; supersedes the partial index added for the
+-- calendar loader.
+drop index if exists public.availability_slots_org_starts_idx;
+create index if not exists availability_slots_search_idx
+  on public.availability_slots (organization_id, is_active, is_blocked, starts_at);
+
+create or replace function public.search_availability_slots(
+  p_org_id uuid,
+  p_start_date date,
+  p_end_date date,
+  p_preferred_time text default null,
+  p_limit integer default 8
+)
+returns table(
+  id uuid,
+  starts_at timestamptz,
+  ends_at timestamptz,
+  max_appointments integer,
+  appointments_count integer,
+  local_date date,
+  half_day text
+)
+language plpgsql
+stable
+security definer
+set search_path = public
+as $$
+declare
+  v_tz text := 'America/Monterrey';
+  v_days smallint[] := array[1, 2, 3, 4, 5]::smallint[];
+  v_start_time time := time '08:00';
+  v_end_time time := time '15:00';
+  v_overbooking boolean := false;
+  v_preferred text := lower(btrim(coalesce(p_preferred_time, '')));
+begin
+  select
+    coalesce(nullif(s.timezone, ''), v_tz),
+    s.days_of_week,
+    s.start_time,
+    s.end_time,
+    s.allow_overbooking
+  into v_tz, v_days, v_start_time, v_end_time, v_overbooking
+  from public.appointment_settings s
+  where s.organization_id = p_org_id;
+
+  if not found then
+    v_tz := 'America/Monterrey';
+    v_days := array[1, 2, 3, 4, 5]::smallint[];
+    v_start_time := time '08:00';
+    v_end_time := time '15:00';
+    v_overbooking := false;
+  end if;
+
+  return query
+  with candidates as (
+    select
+      a.id,
+      a.starts_at,
+      a.ends_at,
+      a.max_appointments,
+      a.appointments_count,
+      (a.starts_at at time zone v_tz) as local_start,
+      (a.ends_at at time zone v_tz) as local_end
+    from public.availability_slots a
+    where a.organization_id = p_org_id
+      and a.is_active
+      and not a.is_blocked
+      and a.starts_at >= (p_start_date::timestamp at time zone v_tz)
+      and a.starts_at < ((p_end_date + 1)::timestamp at time zone v_tz)
+      and a.starts_at > now()
+      and (v_overbooking or a.appointments_count < a.max_appointments)
+  )
+  select
+    c.id,
+    c.starts_at,
+    c.ends_at,
+    c.max_appointments,
+    c.appointments_count,
+    c.local_start::date,
+    case when c.local_start::time < time '12:00' then 'morning' else 'afternoon' end
+  from candidates c
+  where extract(dow from c.local_start)::smallint = any(v_days)
+    and c.local_start::time >= v_start_time
+    and c.local_start::time < v_end_time
+    and (
+      v_preferred not in ('morning', 'afternoon')
+      or (v_preferred = 'morning' and c.local_start::time < time '12:00')
+      or (v_preferred = 'afternoon' and c.local_start::time >= time '12:00')
+    )
+    and not exists (
+      select 1
+      from public.appointment_blackouts b
+      where b.organization_id = p_org_id
+        and b.date = c.local_start::date
+        and b.start_time < c.local_end::time
+        and b.end_time > c.local_start::time
+    )
+  order by c.starts_at asc
+  limit p_limit;
+end;
+$$;
+
+grant execute on function public.search_availability_slots(uuid, date, date, text, integer) to service_role;
+
+-- Blackouts and settings change the bookable calendar too.
+create or replace function public.bump_availability_calendar_version_from_config()
+returns trigger
+language plpgsql
+security definer
+set search_path = public
+as $$
+declare
+  v_org_id uuid;
+begin
+  if tg_op = 'DELETE' then
+    v_org_id := old.organization_id;
+  else
+    v_org_id := new.organization_id;
+  end if;
+
+  insert into public.availability_calendar_versions (organization_id, version, updated_at)
+  values (v_org_id, 1, now())
+  on conflict (organization_id) do update
+    set version = availability_calendar_versions.version + 1,
+        updated_at = now();
+
+  perform pg_notify('availability_slots_changed', v_org_id::text);
+  return null;
+end;
+$$;
+
+drop trigger if exists appointment_blackouts_bump_calendar_version on public.appointment_blackouts;
+create trigger appointment_blackouts_bump_calendar_version
+  after insert or update or delete on public.appointment_blackouts
+  for each row execute function public.bump_availability_calendar_version_from_config();
+
+drop trigger if exists appointment_settings_bump_calendar_version on public.appointment_settings;
+create trigger appointment_settings_bump_calendar_version
+  after insert or update or delete on public.appointment_settings
+  for each row execute function public.bump_availability_calendar_version_from_config();
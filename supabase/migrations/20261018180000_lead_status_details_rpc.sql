@@ -0,0 +1,77 @@
+-- Status details for all of a chat's leads in one call.
+--
+-- get_lead_status used to run two queries per lead (next scheduled
+-- appointment and the last status changes), so a family with several
+-- siblings paid 2N round-trips.  This returns one row per requested lead
+-- with its next scheduled appointment and its last p_history_limit history
+-- rows (ranked with row_number() per lead) as JSON.
+
+create index if not exists lead_status_history_lead_created_idx
+  on public.lead_status_history (lead_id, created_at desc);
+
+create or replace function public.get_lead_status_details(
+  p_lead_ids uuid[],
+  p_history_limit integer default 3
+)
+returns table(
+  lead_id uuid,
+  next_appointment jsonb,
+  history jsonb
+)
+language sql
+stable
+security definer
+set search_path = public
+as $$
+  with ids as (
+    select distinct unnest(coalesce(p_lead_ids, array[]::uuid[])) as lead_id
+  ),
+  next_appointments as (
+    select distinct on (a.lead_id)
+      a.lead_id,
+      jsonb_build_object(
+        'id', a.id,
+        'starts_at', a.starts_at,
+        'ends_at', a.ends_at,
+        'status', a.status
+      ) as appointment
+    from public.appointments a
+    join ids on ids.lead_id = a.lead_id
+    where a.status = 'scheduled'
+    order by a.lead_id, a.starts_at asc
+  ),
+  ranked_history as (
+    select
+      h.lead_id,
+      h.previous_status,
+      h.new_status,
+      h.created_at,
+      row_number() over (partition by h.lead_id order by h.created_at desc) as rn
+    from public.lead_status_history h
+    join ids on ids.lead_id = h.lead_id
+  ),
+  recent_history as (
+    select
+      r.lead_id,
+      jsonb_agg(
+        jsonb_build_object(
+          'previous_status', r.previous_status,
+          'new_status', r.new_status,
+          'created_at', r.created_at
+        )
+        order by r.created_at desc
+      ) as history
+    from ranked_history r
+    where r.rn <= greatest(coalesce(p_history_limit, 3), 0)
+    group by r.lead_id
+  )
+  select
+    ids.lead_id,
+    na.appointment,
+    coalesce(rh.history, '[]'::jsonb)
+  from ids
+  left join next_appointments na on na.lead_id = ids.lead_id
+  left join recent_history rh on rh.lead_id = ids.lead_id;
+$$;
+
+grant execute on function public.get_lead_status_details(uuid[], integer) to service_role;
@@ -0,0 +1,162 @@
+-- Book or reschedule the shared campus visit of a family in one transaction.
+--
+-- After book_admission_appointment / reschedule_admission_appointment the
+-- bot used to update every sibling lead to visit_scheduled one by one and,
+-- for each non-primary sibling, insert a lead_activities note and append it
+-- to leads.notes (1 + 3N round-trips, not atomic).  These wrappers run the
+-- existing RPC and the sibling updates in the same transaction.
+--
+-- p_lead_ids lists the chat's leads with the primary lead first; the
+-- appointment record belongs to the primary lead.
+
+create or replace function public.book_family_appointment(
+  p_org_id uuid,
+  p_lead_ids uuid[],
+  p_slot_id uuid,
+  p_notes text default null,
+  p_type text default 'Campus visit',
+  p_created_by_profile_id uuid default null
+)
+returns table(
+  success boolean,
+  message text,
+  appointment_id uuid,
+  starts_at timestamptz,
+  ends_at timestamptz
+)
+language plpgsql
+security definer
+set search_path = public
+as $$
+declare
+  v_primary_id uuid := p_lead_ids[1];
+  v_booking record;
+  v_primary_number text;
+  v_note text;
+begin
+  if v_primary_id is null then
+    return query select false, 'No se encontró el lead para esta organización.'::text, null::uuid, null::timestamptz, null::timestamptz;
+    return;
+  end if;
+
+  select *
+    into v_booking
+  from public.book_admission_appointment(
+    p_org_id,
+    v_primary_id,
+    p_slot_id,
+    p_notes,
+    p_type,
+    p_created_by_profile_id
+  );
+
+  if v_booking is null or not v_booking.success then
+    return query select
+      coalesce(v_booking.success, false),
+      v_booking.message,
+      v_booking.appointment_id,
+      v_booking.starts_at,
+      v_booking.ends_at;
+    return;
+  end if;
+
+  update public.leads
+     set status = 'visit_scheduled',
+         updated_at = timezone('utc'::text, now())
+   where id = any(p_lead_ids)
+     and organization_id = p_org_id;
+
+  select l.lead_number::text
+    into v_primary_number
+  from public.leads l
+  where l.id = v_primary_id;
+
+  v_note := format(
+    'Visita agendada (compartida con lead %s) para %s',
+    coalesce(v_primary_number, 'sin folio'),
+    to_char(v_booking.starts_at at time zone 'UTC', 'YYYY-MM-DD"T"HH24:MI:SS"+00:00"')
+  );
+
+  -- Same rules as append_lead_note: skip leads that already carry the note.
+  with siblings as (
+    select l.id
+    from public.leads l
+    where l.id = any(p_lead_ids)
+      and l.id <> v_primary_id
+      and l.organization_id = p_org_id
+      and position(v_note in coalesce(l.notes, '')) = 0
+    for update
+  ),
+  activities as (
+    insert into public.lead_activities (organization_id, lead_id, type, subject, notes, created_at)
+    select p_org_id, s.id, 'note', 'Cita Agendada', v_note, timezone('utc'::text, now())
+    from siblings s
+    returning lead_id
+  )
+  update public.leads l
+     set notes = case
+           when nullif(btrim(coalesce(l.notes, '')), '') is null then v_note
+           else btrim(l.notes) || E'\n' || v_note
+         end,
+         updated_at = timezone('utc'::text, now())
+    from activities a
+   where l.id = a.lead_id;
+
+  return query select true, v_booking.message, v_booking.appointment_id, v_booking.starts_at, v_booking.ends_at;
+end;
+$$;
+
+create or replace function public.reschedule_family_appointment(
+  p_org_id uuid,
+  p_appointment_id uuid,
+  p_new_slot_id uuid,
+  p_lead_ids uuid[],
+  p_notes text default null,
+  p_type text default null
+)
+returns table(
+  success boolean,
+  message text,
+  appointment_id uuid,
+  starts_at timestamptz,
+  ends_at timestamptz
+)
+language plpgsql
+security definer
+set search_path = public
+as $$
+declare
+  v_result record;
+begin
+  select *
+    into v_result
+  from public.reschedule_admission_appointment(
+    p_org_id,
+    p_appointment_id,
+    p_new_slot_id,
+    p_notes,
+    p_type
+  );
+
+  if v_result is null or not v_result.success then
+    return query select
+      coalesce(v_result.success, false),
+      v_result.message,
+      v_result.appointment_id,
+      v_result.starts_at,
+      v_result.ends_at;
+    return;
+  end if;
+
+  update public.leads
+     set status = 'visit_scheduled',
+         updated_at = timezone('utc'::text, now())
+   where id = any(coalesce(p_lead_ids, array[]::uuid[]))
+     and organization_id = p_org_id;
+
+  return query select true, v_result.message, v_result.appointment_id, v_result.starts_at, v_result.ends_at;
+end;
+$$;
+
+grant execute on function public.book_family_appointment(uuid, uuid[], uuid, text, text, uuid) to authenticated, service_role;
+grant execute on function public.reschedule_family_appointment(uuid, uuid, uuid, uuid[], text, text) to authenticated, service_role;
@@ -0,0 +1,24 @@
+-- WhatsApp media ids of documents stored in Supabase Storage.
+--
+-- Requirement and event PDFs were downloaded from Storage and uploaded to
+-- the Graph API on every send.  The bot now keeps the media id returned by
+-- the upload per phone number, Storage object and content hash (the
+-- object's ETag), and only uploads again after expires_at or when the
+-- document changes (app/whatsapp/media_cache.py).
+
+create table if not exists public.whatsapp_media_cache (
+  phone_number_id text not null,
+  storage_bucket text not null,
+  file_path text not null,
+  content_hash text not null,
+  media_id text not null,
+  mime_type text,
+  expires_at timestamptz not null,
+  created_at timestamptz not null default now(),
+  primary key (phone_number_id, storage_bucket, file_path, content_hash)
+);
+
+create index if not exists whatsapp_media_cache_expires_idx
+  on public.whatsapp_media_cache (expires_at);
+
+alter table public.whatsapp_media_cache enable row level security;
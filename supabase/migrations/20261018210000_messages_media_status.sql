@@ -0,0 +1,33 @@
+-- Inbound media is copied to Storage after the message row is stored
+-- (app/whatsapp/media_pipeline.py).  media_status tracks that transfer:
+-- 'pending' when the row is inserted, then 'ready' or 'failed'.
+
+alter table public.messages
+  add column if not exists media_status text
+  check (media_status in ('pending', 'ready', 'failed'));
+
+create or replace function public.set_inbound_media_pending()
+returns trigger
+language plpgsql
+as $$
+begin
+  if new.direction = 'inbound'
+     and new.media_id is not null
+     and new.media_path is null
+     and new.media_status is null then
+    new.media_status := 'pending';
+  end if;
+  return new;
+end;
+$$;
+
+drop trigger if exists messages_set_inbound_media_pending on public.messages;
+create trigger messages_set_inbound_media_pending
+  before insert on public.messages
+  for each row execute function public.set_inbound_media_pending();
+
+-- Transfers interrupted by a restart stay pending; the pipeline's sweep
+-- (MediaPipeline.sweep) looks them up through this index.
+create index if not exists messages_media_pending_idx
+  on public.messages (created_at)
+  where media_status = 'pending';
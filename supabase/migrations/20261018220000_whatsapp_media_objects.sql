@@ -0,0 +1,25 @@
+-- Content-addressed storage for inbound WhatsApp media.
+--
+-- Parents forward the same birth certificate or receipt several times;
+-- each copy used to be stored under chats/<chat_id>/<media_id>-<name>.
+-- Objects are now stored once at sha256/<ab>/<hash>.<ext>; this table maps
+-- the SHA-256 of the content to that path, so repeated files skip the
+-- upload and their messages reference the shared object.
+
+create table if not exists public.whatsapp_media_objects (
+  sha256 text primary key check (sha256 ~ '^[0-9a-f]{64}$'),
+  storage_bucket text not null,
+  storage_path text not null,
+  size_bytes bigint,
+  mime_type text,
+  created_at timestamptz not null default now()
+);
+
+alter table public.whatsapp_media_objects enable row level security;
+
+alter table public.messages
+  add column if not exists media_sha256 text;
+
+create index if not exists messages_media_sha256_idx
+  on public.messages (media_sha256)
+  where media_sha256 is not null;
@@ -0,0 +1,191 @@
+-- One turn at a time per chat, across workers (app/whatsapp/chat_lock.py).
+--
+-- The debounce scheduler, the chat_jobs worker, the edge-function fallback
+-- and manual /process calls can all start a turn for the same chat.  Turns
+-- overlap through several PostgREST requests, so a session advisory lock
+-- cannot be held for the whole turn; instead a transaction-level advisory
+-- lock serializes these functions per chat and the turn holds a lease row,
+-- extended by a heartbeat while the turn runs.
+--
+-- A turn requested while another one holds the lease is folded into
+-- pending_text; the holder gets it back from release_chat_turn_lock and runs
+-- a single follow-up turn.
+--
+-- Duplicates are recognised by batch id (message_queue.last_added_at of the
+-- debounced batch), never by text: a parent may well answer "si" to two
+-- questions in a row.  A batch that is running, folded, or was the last one
+-- answered successfully is dropped.  Requests without a batch id (manual
+-- /process calls) are never treated as duplicates.
+
+create table if not exists public.chat_turn_locks (
+  chat_id uuid primary key references public.chats(id) on delete cascade,
+  owner text,
+  locked_until timestamptz,
+  current_batches text[] not null default '{}',
+  pending_text text,
+  pending_batches text[] not null default '{}',
+  last_batches text[] not null default '{}',
+  last_finished_at timestamptz,
+  updated_at timestamptz not null default now()
+);
+
+alter table public.chat_turn_locks enable row level security;
+
+create or replace function public.acquire_chat_turn_lock(
+  p_chat_id uuid,
+  p_owner text,
+  p_text text default null,
+  p_batch_id text default null,
+  p_lease_seconds integer default 180,
+  p_fold boolean default false
+)
+returns jsonb
+language plpgsql
+security definer
+set search_path = public
+as $$
+declare
+  v_lock public.chat_turn_locks%rowtype;
+  v_text text := nullif(btrim(coalesce(p_text, '')), '');
+  v_batch text := nullif(btrim(coalesce(p_batch_id, '')), '');
+begin
+  perform pg_advisory_xact_lock(hashtextextended('chat_turn_lock:' || p_chat_id::text, 0));
+
+  select *
+    into v_lock
+  from public.chat_turn_locks l
+  where l.chat_id = p_chat_id;
+
+  if found and v_lock.owner is not null and v_lock.locked_until > now() then
+    if v_batch is not null
+       and (v_batch = any(v_lock.current_batches) or v_batch = any(v_lock.pending_batches)) then
+      return jsonb_build_object('status', 'duplicate');
+    end if;
+
+    if not p_fold then
+      return jsonb_build_object(
+        'status', 'busy',
+        'wait_ms', ceil(extract(epoch from (v_lock.locked_until - now())) * 1000)::integer
+      );
+    end if;
+
+    if v_text is not null then
+      update public.chat_turn_locks
+         set pending_text = case
+               when pending_text is null then v_text
+               else pending_text || E'\n' || v_text
+             end,
+             pending_batches = case
+               when v_batch is null then pending_batches
+               else array_append(pending_batches, v_batch)
+             end,
+             updated_at = now()
+       where chat_id = p_chat_id;
+    end if;
+    return jsonb_build_object('status', 'coalesced');
+  end if;
+
+  if found and v_batch is not null and v_batch = any(v_lock.last_batches) then
+    return jsonb_build_object('status', 'duplicate');
+  end if;
+
+  -- Text folded into a holder that died stays pending and is handed to this
+  -- turn on release.
+  insert into public.chat_turn_locks (chat_id, owner, locked_until, current_batches, updated_at)
+  values (
+    p_chat_id,
+    p_owner,
+    now() + make_interval(secs => p_lease_seconds),
+    case when v_batch is null then '{}'::text[] else array[v_batch] end,
+    now()
+  )
+  on conflict (chat_id) do update
+    set owner = excluded.owner,
+        locked_until = excluded.locked_until,
+        current_batches = excluded.current_batches,
+        updated_at = now();
+
+  return jsonb_build_object('status', 'acquired');
+end;
+$$;
+
+-- Keep the lease of a running turn alive (chat_lock.py heartbeat).
+create or replace function public.extend_chat_turn_lock(
+  p_chat_id uuid,
+  p_owner text,
+  p_lease_seconds integer default 180
+)
+returns boolean
+language plpgsql
+security definer
+set search_path = public
+as $$
+begin
+  perform pg_advisory_xact_lock(hashtextextended('chat_turn_lock:' || p_chat_id::text, 0));
+
+  update public.chat_turn_locks
+     set locked_until = now() + make_interval(secs => p_lease_seconds),
+         updated_at = now()
+   where chat_id = p_chat_id
+     and owner = p_owner
+     and locked_until > now();
+  return found;
+end;
+$$;
+
+create or replace function public.release_chat_turn_lock(
+  p_chat_id uuid,
+  p_owner text,
+  p_success boolean default true,
+  p_lease_seconds integer default 180
+)
+returns jsonb
+language plpgsql
+security definer
+set search_path = public
+as $$
+declare
+  v_lock public.chat_turn_locks%rowtype;
+  v_pending text;
+begin
+  perform pg_advisory_xact_lock(hashtextextended('chat_turn_lock:' || p_chat_id::text, 0));
+
+  select *
+    into v_lock
+  from public.chat_turn_locks l
+  where l.chat_id = p_chat_id;
+
+  if not found or v_lock.owner is distinct from p_owner then
+    return jsonb_build_object('status', 'lost');
+  end if;
+
+  v_pending := nullif(btrim(coalesce(v_lock.pending_text, '')), '');
+  if v_pending is not null then
+    -- Keep the lease and hand the folded requests to the holder.
+    update public.chat_turn_locks
+       set locked_until = now() + make_interval(secs => p_lease_seconds),
+           current_batches = pending_batches,
+           pending_text = null,
+           pending_batches = '{}',
+           last_batches = case when p_success then current_batches else last_batches end,
+           last_finished_at = now(),
+           updated_at = now()
+     where chat_id = p_chat_id;
+    return jsonb_build_object('status', 'rerun', 'combined_text', v_pending);
+  end if;
+
+  update public.chat_turn_locks
+     set owner = null,
+         locked_until = null,
+         current_batches = '{}',
+         last_batches = case when p_success then current_batches else last_batches end,
+         last_finished_at = now(),
+         updated_at = now()
+   where chat_id = p_chat_id;
+  return jsonb_build_object('status', 'released');
+end;
+$$;
+
+grant execute on function public.acquire_chat_turn_lock(uuid, text, text, text, integer, boolean) to service_role;
+grant execute on function public.extend_chat_turn_lock(uuid, text, integer) to service_role;
+grant execute on function public.release_chat_turn_lock(uuid, text, boolean, integer) to service_role;
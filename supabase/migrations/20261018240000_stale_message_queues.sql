@@ -0,0 +1,34 @@
+-- Batches stranded in message_queue (app/whatsapp/debounce.py sweep).
+--
+-- The debounce window only lives in asyncio timers of the API process.  A
+-- restart or deploy inside the window leaves text in message_queue with no
+-- timer and no chat_jobs row.  This lists chats whose window is long over,
+-- that nobody holds a lease on and that have no active job, so the sweep
+-- can hand them to the normal claim/enqueue path.
+
+create index if not exists message_queue_last_added_idx
+  on public.message_queue (last_added_at);
+
+create or replace function public.list_stale_message_queues(
+  p_quiet_ms integer,
+  p_max_age_seconds integer default 3600,
+  p_limit integer default 100
+)
+returns table (chat_id uuid, last_added_at timestamptz)
+language sql
+stable
+security definer
+set search_path = public
+as $$
+  select q.chat_id, q.last_added_at
+  from public.message_queue q
+  where coalesce(q.combined_text, '') <> ''
+    and q.last_added_at < now() - make_interval(secs => p_quiet_ms / 1000.0)
+    and q.last_added_at > now() - make_interval(secs => p_max_age_seconds)
+    and (q.lease_expires_at is null or q.lease_expires_at < now())
+    and not exists (select 1 from public.chat_jobs j where j.chat_id = q.chat_id)
+  order by q.last_added_at
+  limit greatest(p_limit, 0);
+$$;
+
+grant execute on function public.list_stale_message_queues(integer, integer, integer) to service_role;